@@ -2,22 +2,28 @@ from __future__ import print_function
 import json
 import os
 import argparse
-import matplotlib.pyplot as plt
 import numbers
 import itertools
 import csv
 import sys
 import textwrap
 import re
-from matplotlib.font_manager import FontProperties
-import matplotlib.ticker as ticker
+import runner
+
+# The plots require matplotlib, unlike the grades and the summaries
+try:
+  import matplotlib.pyplot as plt
+  from matplotlib.font_manager import FontProperties
+  import matplotlib.ticker as ticker
+except ImportError:
+  plt = None
 
 OUTCOME_TYPES = ['successes', 'errors', 'failures', 'aborted', 'skipped',
-    'expectedFailures', 'unexpectedSuccesses']
+    'expectedFailures', 'unexpectedSuccesses', 'limitExceeded']
 
 OUTCOME_COLORS = {'errors': 'm', 'failures': 'r', 'skipped': 'c',
     'successes': 'g', 'aborted': 'y', 'expectedFailures': 'b',
-    'unexpectedSuccesses': 'k'}
+    'unexpectedSuccesses': 'k', 'limitExceeded': '0.5'}
 
 class GroupStatistics(object):
   '''Represents the computed statistics for a single group of one or more
@@ -35,6 +41,8 @@ class GroupStatistics(object):
     self.unexpectedSuccesses = results_dict['unexpectedSuccesses']
     self.aborted = results_dict['aborted']
     self.expectedFailures = results_dict['expectedFailures']
+    # Results written before resource limits existed have no such outcome
+    self.limitExceeded = results_dict.get('limitExceeded', {})
     self.allTests = results_dict['allTests']
 
   def format_group(self):
@@ -75,7 +83,8 @@ class GroupStatistics(object):
 
   def unsuccessful_count(self):
     return len(self.errors) + len(self.failures) + len(self.skipped) + \
-        len(self.unexpectedSuccesses) + len(self.aborted)
+        len(self.unexpectedSuccesses) + len(self.aborted) + \
+        len(self.limitExceeded)
 
   def success_count(self):
     return self.test_count() - self.unsuccessful_count()
@@ -87,7 +96,7 @@ class GroupStatistics(object):
       return ''
     output = '{} ({}/{})\n\n'.format(name.upper(), len(item), self.test_count())
     if isinstance(item, dict):
-      for k, v in item.iteritems():
+      for k, v in item.items():
         mod_name, class_name, func_name = k.split('.')
         output += '{0}.{1}:\n'.format(class_name, func_name)
         if self.allTests[k] is not None and len(self.allTests[k]) > 0:
@@ -110,6 +119,7 @@ class GroupStatistics(object):
     output += self.pretty_print_category('errors')
     output += self.pretty_print_category('failures')
     output += self.pretty_print_category('aborted')
+    output += self.pretty_print_category('limitExceeded')
     output += self.pretty_print_category('skipped')
     output += self.pretty_print_category('unexpectedSuccesses')
     return output
@@ -124,6 +134,16 @@ class GroupStatistics(object):
     with open(filename) as result_file:
       return cls(re.findall('([a-z]+[0-9]+)', base), json.load(result_file))
 
+  @classmethod
+  def from_events(cls, filename):
+    '''Create a GroupStatistics instance from the event stream written by the
+    runner, which may belong to a run that is still in progress or that was
+    interrupted. Tests that have not completed are counted as aborted.'''
+    base = os.path.split(os.path.split(os.path.abspath(filename))[0])[1]
+    assert os.path.isfile(filename), filename
+    return cls(re.findall('([a-z]+[0-9]+)', base),
+        runner.summarize_events(filename))
+
 
 class StatisticsSet(object):
   '''A collection of statistics for multiple groups.'''
@@ -132,15 +152,19 @@ class StatisticsSet(object):
     self.instances = list(instances)
 
   @classmethod
-  def from_directory(cls, root_dir, result_file_path):
+  def from_directory(cls, root_dir, result_file_path, include_partial=False):
     '''Return a list of GroupStatistics for all the groups in a given
-    directory.'''
+    directory. If 'include_partial' is True, the groups whose tests have not
+    completed are included based on the progress in their event streams.'''
     assert os.path.isdir(root_dir)
     stat_list = []
     for f in os.listdir(root_dir):
       path = os.path.join(root_dir, f, result_file_path)
+      events_path = runner.events_path_for(path)
       if os.path.isfile(path):
         stat_list.append(GroupStatistics.from_file(path))
+      elif include_partial and os.path.isfile(events_path):
+        stat_list.append(GroupStatistics.from_events(events_path))
     return cls(stat_list)
 
   def get_test_performance(self, test_identifier):
@@ -157,7 +181,7 @@ class StatisticsSet(object):
     '''Format the outcomes of a particular test in terms of outcomes for the
     groups in this set.'''
     output = test_identifier + '\n\n'
-    for c, f in self.get_test_performance(test_identifier).iteritems():
+    for c, f in self.get_test_performance(test_identifier).items():
       if len(f) > 0:
         output += c.upper() + '\n'
       for g in f:
@@ -200,6 +224,8 @@ class StatisticsSet(object):
 
   def plot_error_type_vs_students(self, filename):
     assert len(self.instances) > 0
+    if plt is None:
+      raise Exception('Plotting the results requires matplotlib')
     bins = self.get_histogram()
     fig = plt.figure()
     p = fig.add_subplot(111)
@@ -234,13 +260,15 @@ class StatisticsSet(object):
 
   def plot_error_count_vs_students(self, filename):
     assert len(self.instances) > 0
+    if plt is None:
+      raise Exception('Plotting the results requires matplotlib')
     bins = {i: 0 for i in range(len(self.instances[0].allTests) + 1)}
     for i in self.instances:
       bins[i.unsuccessful_count()] += 1
     fig = plt.figure()
     p = fig.add_subplot(111)
-    p.bar(range(len(bins)), bins.values())
-    labels = bins.keys()
+    p.bar(range(len(bins)), list(bins.values()))
+    labels = list(bins.keys())
     p.set_xticks(range(len(bins)))
     p.set_xticklabels(labels)
     p.set_title('Distribution of the number of errors made by the students')
@@ -253,7 +281,7 @@ class StatisticsSet(object):
     p = GradeFileProcessor(csv_file)
     for g in self.instances:
       subs_values = dict()
-      for func_name, rec_name in mapping.iteritems():
+      for func_name, rec_name in mapping.items():
         if weights_map == None or not func_name in weights_map:
           subs_values[rec_name] = getattr(g, func_name)(1, 0)
         else:
@@ -264,9 +292,18 @@ class StatisticsSet(object):
     p.dump(output_file)
 
 
+def open_csv(filename, mode):
+  '''Open the CSV file 'filename' for reading or writing, with 'mode' 'r' or
+  'w', as the csv module expects: in binary mode on Python 2, and in text mode
+  without translating the newlines on Python 3.'''
+  if sys.version_info[0] < 3:
+    return open(filename, mode + 'b')
+  return open(filename, mode, newline='')
+
+
 class GradeFileProcessor(object):
   def __init__(self, filename):
-    with open(filename, 'r') as input_file:
+    with open_csv(filename, 'r') as input_file:
       contents = list(csv.reader(input_file))
       assert len(contents) > 0, 'The CSV file {} is empty.'.format(filename)
 
@@ -297,11 +334,11 @@ class GradeFileProcessor(object):
   def update_records(self, record_ids, subs_values, additionalSources=[]):
     # If the record_ids is a single value, make it a list with one item.
 
-    if not hasattr(record_ids, '__iter__'):
+    if not isinstance(record_ids, (list, tuple, set)):
       record_ids = [record_ids]
     for rec_id in record_ids:
       row_index = self.contents_index_map[rec_id]
-      for k, v in subs_values.iteritems():
+      for k, v in subs_values.items():
         assert self.contains_column(k), 'Column {} does not exist.'.format(k)
         if isinstance(v, numbers.Number):
           maxVal = self.contents_list[row_index][ \
@@ -321,14 +358,14 @@ class GradeFileProcessor(object):
             if maxVal < curr:
               maxVal = curr
           if v < maxVal:
-            v = curr
+            v = maxVal
           if abs(trueVal - v) > 1e-5:
             print('WARN: The score for {0} was {1} but has decreased to {2}'.\
                 format(rec_id, v, trueVal))
         self.contents_list[row_index][self.headers_index_map[k]] = v
 
   def dump(self, filename):
-    with open(filename, 'wb') as out_file:
+    with open_csv(filename, 'w') as out_file:
       w = csv.writer(out_file)
       w.writerow(self.headers_list)
       w.writerows(self.contents_list)
@@ -384,6 +421,10 @@ if __name__ == '__main__':
       'grades to only increase (i.e. never decrease).', default=False,
       action='store_true')
 
+  parser.add_argument('-i', '--include-partial', help='Include the groups ' +
+      'whose tests are still running or were interrupted, based on the ' +
+      'progress recorded by the runner.', default=False, action='store_true')
+
   if len(sys.argv) == 1:
     parser.print_help()
     exit(-2)
@@ -391,7 +432,7 @@ if __name__ == '__main__':
   args = parser.parse_args()
 
   stat = StatisticsSet.from_directory(args.test_results_directory,
-      args.result_filename)
+      args.result_filename, args.include_partial)
 
   if args.csv_result_file != None and len(args.csv_result_file) != 0:
     for filename in args.csv_result_file:
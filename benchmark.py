@@ -0,0 +1,305 @@
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+import analysis
+import extract
+import forkserver
+import parallel
+import runner
+
+
+# The kinds of synthetic solutions: correct, wrong, looping forever and
+# killing the process that grades them
+KINDS = ('pass', 'fail', 'hang', 'crash')
+
+SOLUTIONS = {
+  'pass': 'def solve(n):\n  return sum(range(n))\n',
+  'fail': 'def solve(n):\n  return sum(range(n + 1))\n',
+  'hang': 'def solve(n):\n  while True:\n    pass\n',
+  'crash': 'import os\n\ndef solve(n):\n  os._exit(70)\n'}
+
+# The synthetic test module, which the benchmark writes next to the corpus
+TEST_MODULE_NAME = 'bench_tests'
+TEST_MODULE = '''import unittest
+import solution
+
+
+class SolutionTest(unittest.TestCase):
+  time_limit = 0.5
+
+  def test_small(self):
+    self.assertEqual(solution.solve(10), 45)
+
+  def test_medium(self):
+    self.assertEqual(solution.solve(1000), 499500)
+
+  def test_large(self):
+    self.assertEqual(solution.solve(100000), 4999950000)
+'''
+
+STAGES = ('extract', 'runner', 'parallel', 'analysis')
+
+
+def pick(rng, sequence):
+  '''Return an element of 'sequence' drawn by 'rng'. Only random() draws the
+  same numbers with Python 2 and 3 for the same seed, unlike choice.'''
+  return sequence[int(rng.random() * len(sequence))]
+
+
+def group_names(count, rng):
+  '''Return 'count' distinct names of CMS submission directories, of single
+  students and of groups of two, made of NetIDs like abc123.'''
+  names = set()
+  while len(names) < count:
+    netids = ['{0}{1}'.format(''.join(pick(rng, 'abcdefghijklmnopqrstuvwxyz')
+        for _ in range(pick(rng, (2, 3)))), pick(rng, range(1, 10000)))
+        for _ in range(pick(rng, (1, 1, 2)))]
+    names.add(netids[0] if len(netids) == 1 else
+        'group_of_{0}_{1}'.format(*netids))
+  return sorted(names)
+
+
+def zip_bytes(files):
+  '''Return a zip archive of 'files', a dictionary mapping paths to
+  contents.'''
+  data = io.BytesIO()
+  with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+    for path, contents in sorted(files.items()):
+      archive.writestr(path, contents)
+  return data.getvalue()
+
+
+def generate_corpus(directory, groups, nested=0.2, file_size=4096, mix=None,
+    seed=0):
+  '''Write a synthetic CMS submission zip file of 'groups' submissions to
+  'directory', along with the synthetic test module, and return the path of
+  the zip file and a dictionary mapping each kind of solution to the number of
+  submissions of that kind. The kinds are drawn with the weights in 'mix',
+  which maps each of KINDS to its weight. Each submission has a filler file of
+  'file_size' bytes, and a fraction 'nested' of them are zipped, some twice.'''
+  rng = random.Random(seed)
+  mix = mix or {'pass': 0.7, 'fail': 0.2, 'hang': 0.05, 'crash': 0.05}
+  kinds = [k for k in KINDS if mix.get(k, 0) > 0]
+  counts = dict.fromkeys(KINDS, 0)
+  path = os.path.join(directory, 'submissions.zip')
+  with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+    for name in group_names(groups, rng):
+      kind = weighted_choice(rng, kinds, mix)
+      counts[kind] += 1
+      files = {'solution.py': SOLUTIONS[kind],
+          'README.txt': ''.join(pick(rng, 'abcdefgh \n')
+          for _ in range(file_size))}
+      if rng.random() < nested:
+        files = {'submission.zip': zip_bytes(files)}
+        if rng.random() < 0.5:
+          files = {'outer.zip': zip_bytes(files)}
+      for p, contents in sorted(files.items()):
+        archive.writestr('{0}/{1}/{2}'.format(extract.SUBMISSION_DIR_NAME,
+            name, p), contents)
+  with open(os.path.join(directory, TEST_MODULE_NAME + '.py'), 'w') as f:
+    f.write(TEST_MODULE)
+  return path, counts
+
+
+def weighted_choice(rng, kinds, weights):
+  '''Return one of 'kinds' drawn by 'rng' with the given 'weights'.'''
+  x = rng.random() * sum(weights[k] for k in kinds)
+  for k in kinds:
+    x -= weights[k]
+    if x < 0:
+      return k
+  return kinds[-1]
+
+
+def bench_extract(corpus, destination):
+  extract.process_submission(corpus, destination, True, True, ['*'])
+
+
+def bench_runner(destination, **options):
+  server = forkserver.ForkServer(TEST_MODULE_NAME, **options)
+  server.grade(forkserver.submission_dirs(destination))
+
+
+def bench_parallel(destination, jobs, **options):
+  scheduler = parallel.BatchScheduler(TEST_MODULE_NAME, jobs=jobs, **options)
+  scheduler.grade(forkserver.submission_dirs(destination))
+
+
+def bench_analysis(destination, breakdown):
+  stats = analysis.StatisticsSet.from_directory(destination, 'results.json')
+  stats.get_histogram()
+  stats.write_test_breakdown(breakdown)
+
+
+def run_benchmark(sizes, stages=STAGES, jobs=None, keep=None, repeat=3,
+    **corpus_options):
+  '''Time each of the 'stages' on a synthetic corpus of each of the 'sizes',
+  generated by generate_corpus with 'corpus_options', and return the results:
+  the environment of the benchmark, and the number of seconds each stage took
+  at each size, the best and the median of 'repeat' runs. The runner stage
+  grades the submissions one after the other, the parallel stage with a
+  parallel.BatchScheduler of 'jobs' jobs. The corpora are written under
+  'keep', if specified, or removed.'''
+  options = dict(overwrite_existing_results=True, processes=0, threads=4)
+  results = {'commit': git_commit(), 'python': platform.python_version(),
+      'platform': platform.platform(), 'hostSpeed': runner.host_speed(),
+      'jobs': jobs or parallel.multiprocessing.cpu_count(), 'results': []}
+  cwd = os.getcwd()
+  console = runner.console
+  for size in sizes:
+    directory = tempfile.mkdtemp(dir=keep)
+    try:
+      corpus, counts = generate_corpus(directory, size, **corpus_options)
+      destination = os.path.join(directory, 'code')
+      # The test module is imported from the working directory
+      os.chdir(directory)
+      runner.console = open(os.devnull, 'w')
+      stage_functions = {
+          'extract': lambda: bench_extract(corpus, destination),
+          'runner': lambda: bench_runner(destination, **options),
+          'parallel': lambda: bench_parallel(destination, jobs, **options),
+          'analysis': lambda: bench_analysis(destination,
+              os.path.join(directory, 'breakdown.txt'))}
+      # The stages that are not timed but that a timed stage depends on run
+      # untimed: the analysis reads the results of the parallel grading
+      required = set(stages)
+      if 'analysis' in stages and 'runner' not in stages:
+        required.add('parallel')
+      if len(required) > 0:
+        required.add('extract')
+      for stage in STAGES:
+        if stage not in required:
+          continue
+        samples = []
+        for _ in range(repeat if stage in stages else 1):
+          start_time = time.time()
+          stage_functions[stage]()
+          samples.append(max(time.time() - start_time, 1e-9))
+        if stage not in stages:
+          continue
+        samples.sort()
+        elapsed = samples[0]
+        results['results'].append({'stage': stage, 'size': size,
+            'seconds': elapsed, 'median': samples[len(samples) // 2],
+            'samples': samples, 'perSecond': size / elapsed, 'kinds': counts})
+        console.write('{0:>8} {1:>10} {2:>10.2f} s {3:>10.1f}/s\n'.format(
+            size, stage, elapsed, size / elapsed))
+    finally:
+      runner.console.close()
+      runner.console = console
+      os.chdir(cwd)
+      if keep is None:
+        shutil.rmtree(directory)
+  return results
+
+
+def git_commit():
+  '''Return the commit of the autograder being benchmarked, if known.'''
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline, tolerance=0.1, threshold=0.05):
+  '''Compare the best times of the 'results' of run_benchmark to those of the
+  'baseline', and return a line for each stage and size that both timed,
+  along with whether any of them is slower than the baseline by more than
+  'tolerance', as a fraction, and by more than 'threshold' seconds, below
+  which the difference is noise.'''
+  previous = {(r['stage'], r['size']): r['seconds']
+      for r in baseline['results']}
+  lines = []
+  regressed = False
+  for r in results['results']:
+    before = previous.get((r['stage'], r['size']))
+    if before is None:
+      continue
+    ratio = r['seconds'] / max(before, 1e-9)
+    slower = ratio > 1 + tolerance and r['seconds'] - before > threshold
+    regressed = regressed or slower
+    lines.append('{0:>8} {1:>10} {2:>10.2f} s -> {3:>8.2f} s ({4:+.0%}){5}'.
+        format(r['size'], r['stage'], before, r['seconds'], ratio - 1,
+        '  REGRESSION' if slower else ''))
+  return lines, regressed
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Time the stages of grading ' +
+    'on synthetic CMS submissions, with passing, failing, hanging and ' +
+    'crashing solutions: their extraction, their grading one after the ' +
+    'other and in parallel, and the analysis of the results.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  parser.add_argument('-s', '--sizes', help='The numbers of submissions to ' +
+    'time the stages on.', nargs='+', default=[100, 1000, 10000], type=int)
+
+  parser.add_argument('-S', '--stages', help='The stages to time.',
+    nargs='+', choices=STAGES, default=list(STAGES))
+
+  parser.add_argument('-N', '--repeat', help='The number of times each ' +
+    'stage is timed. The best time is kept.', default=3, type=int)
+
+  parser.add_argument('-j', '--jobs', help='The number of submissions the ' +
+    'parallel stage grades at the same time. Defaults to the number of CPUs.',
+    default=None, type=int)
+
+  parser.add_argument('--nested', help='The fraction of the submissions ' +
+    'that are zipped, some of them twice.', default=0.2, type=float)
+
+  parser.add_argument('--file-size', help='The size in bytes of the filler ' +
+    'file of each submission.', default=4096, type=int)
+
+  parser.add_argument('--mix', help='The weights of the kinds of ' +
+    'solutions, ' + ', '.join(KINDS) + '.', nargs=len(KINDS),
+    default=[0.7, 0.2, 0.05, 0.05], type=float)
+
+  parser.add_argument('--seed', help='The seed of the synthetic corpus.',
+    default=0, type=int)
+
+  parser.add_argument('-o', '--output', help='The file to write the results ' +
+    'to as JSON.', default='benchmark.json')
+
+  parser.add_argument('-b', '--baseline', help='The results of an earlier ' +
+    'benchmark to compare with. The exit code is 1 if a stage got slower.',
+    default=None)
+
+  parser.add_argument('--tolerance', help='The fraction by which a stage ' +
+    'may be slower than in the baseline.', default=0.1, type=float)
+
+  parser.add_argument('--threshold', help='The number of seconds by which a ' +
+    'stage may be slower than in the baseline, whatever the fraction.',
+    default=0.05, type=float)
+
+  parser.add_argument('-k', '--keep', help='Keep the corpora and their ' +
+    'results in this directory.', default=None)
+
+  args = parser.parse_args()
+
+  # The tests import the autograder and the solutions from the working
+  # directory, as runner.py does
+  results = run_benchmark(args.sizes, args.stages, args.jobs, args.keep,
+      args.repeat, nested=args.nested, file_size=args.file_size,
+      mix=dict(zip(KINDS, args.mix)), seed=args.seed)
+  with open(args.output, 'w') as output:
+    json.dump(results, output, indent=2, sort_keys=True)
+  if args.baseline is not None:
+    with open(args.baseline) as baseline_file:
+      lines, regressed = compare(results, json.load(baseline_file),
+          args.tolerance, args.threshold)
+    print('\n'.join(lines))
+    if regressed:
+      exit(1)
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,336 @@
+import ast
+import errno
+import hashlib
+import json
+import os
+import re
+import sys
+import unittest
+import runner
+
+
+# The extensions of the files that never affect the outcome of the tests
+IGNORED_EXTENSIONS = ('.pyc', '.pyo')
+
+# Stands in for the path of the submission directory in the cached summaries,
+# so that a summary can be reused for identical submissions of other groups
+# without revealing their directory
+ROOT_PLACEHOLDER = '<submission>'
+
+
+def find_module_file(name, search_path):
+  '''Return the path of the source of the top-level module 'name' within the
+  directories in 'search_path', or None if it cannot be found there.'''
+  for d in search_path:
+    for candidate in (os.path.join(d, name + '.py'),
+        os.path.join(d, name, '__init__.py')):
+      if os.path.isfile(candidate):
+        return candidate
+  return None
+
+
+def imported_names(path):
+  '''Return the names of the top-level modules imported by the source file at
+  'path'.'''
+  with open(path) as source:
+    tree = ast.parse(source.read(), path)
+  names = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      names.update(a.name.split('.')[0] for a in node.names)
+    elif isinstance(node, ast.ImportFrom) and node.module is not None and \
+        not node.level:
+      names.add(node.module.split('.')[0])
+  return names
+
+
+def local_dependencies(path):
+  '''Return the paths of the source files of 'path' and of the modules it
+  imports, recursively, that live in the same directory as it. These are the
+  helpers that come with a test module, as opposed to the installed packages
+  and the student's code.'''
+  directory = os.path.dirname(os.path.abspath(path))
+  found = set()
+  pending = [os.path.abspath(path)]
+  while len(pending) > 0:
+    p = pending.pop()
+    if p in found:
+      continue
+    found.add(p)
+    for name in imported_names(p):
+      dependency = find_module_file(name, [directory])
+      if dependency is not None:
+        pending.append(os.path.abspath(dependency))
+  return sorted(found)
+
+
+def hash_file(digest, path):
+  '''Update 'digest' with the contents of the file at 'path'.'''
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+
+
+def hash_tree(root, ignored=()):
+  '''Return a hash of the names and contents of the files in the tree at
+  'root', ignoring the files and directories whose paths relative to it are
+  in 'ignored'.'''
+  digest = hashlib.sha1()
+  for local_root, dirs, files in os.walk(root):
+    dirs[:] = sorted(d for d in dirs if os.path.relpath(
+        os.path.join(local_root, d), root) not in ignored)
+    for f in sorted(files):
+      path = os.path.join(local_root, f)
+      relative = os.path.relpath(path, root)
+      if relative in ignored or f.endswith(IGNORED_EXTENSIONS):
+        continue
+      digest.update(relative.encode('utf-8') + b'\0')
+      hash_file(digest, path)
+      digest.update(b'\0')
+  return digest.hexdigest()
+
+
+def is_test_case(module, name):
+  '''Return True if 'name' is a unittest.TestCase subclass in 'module'.'''
+  cls = getattr(module, name, None)
+  return isinstance(cls, type) and issubclass(cls, unittest.TestCase)
+
+
+def without_tests(class_node):
+  '''Return a copy of the ast.ClassDef 'class_node' without its test
+  methods.'''
+  stripped = ast.ClassDef(**{f: getattr(class_node, f)
+      for f in class_node._fields})
+  stripped.body = [n for n in class_node.body
+      if not (isinstance(n, ast.FunctionDef) and n.name.startswith('test'))]
+  return stripped
+
+
+def test_fingerprints(module, tests):
+  '''Return a dictionary mapping the identifier of each test in 'tests', all
+  of which come from the test module 'module', to a fingerprint of the code
+  it depends on: the source of its test method, of the fixtures and helpers of
+  its class and of its base classes in 'module', of the code of 'module'
+  outside of its TestCase classes, and of the helper modules imported by
+  'module' from its directory. The fingerprints are computed on the syntax
+  trees, so they do not change with comments or formatting. The fingerprint of
+  a test whose source is not available is None.'''
+  path = getattr(module, '__file__', None)
+  if path is None:
+    return {t.id(): None for t in tests}
+  path = os.path.splitext(path)[0] + '.py'
+  if not os.path.isfile(path):
+    return {t.id(): None for t in tests}
+  with open(path) as source:
+    tree = ast.parse(source.read(), path)
+
+  # Everything outside of the TestCase classes affects every test
+  classes = {}
+  shared = hashlib.sha1()
+  for node in tree.body:
+    if isinstance(node, ast.ClassDef) and is_test_case(module, node.name):
+      classes[node.name] = node
+    else:
+      shared.update(ast.dump(node).encode('utf-8'))
+  for p in local_dependencies(path):
+    if p != os.path.abspath(path):
+      hash_file(shared, p)
+
+  fingerprints = {}
+  for t in tests:
+    digest = shared.copy()
+    method = None
+    for cls in type(t).__mro__:
+      node = classes.get(cls.__name__)
+      if node is None or cls.__module__ != module.__name__:
+        continue
+      digest.update(ast.dump(without_tests(node)).encode('utf-8'))
+      for n in node.body:
+        if method is None and isinstance(n, ast.FunctionDef) and \
+            n.name == t._testMethodName:
+          method = n
+    if method is None:
+      fingerprints[t.id()] = None
+    else:
+      digest.update(ast.dump(method).encode('utf-8'))
+      fingerprints[t.id()] = digest.hexdigest()
+  return fingerprints
+
+
+def replace_root(summary, old, new):
+  '''Return a copy of 'summary' in which the paths that start with the
+  directory 'old', in the details of the outcomes and in the output of the
+  tests, such as the tracebacks, start with 'new' instead. Only whole path
+  components are replaced, so that a relative 'old' such as '.' does not
+  change anything else.'''
+  pattern = re.compile(r'(?<![\w.{0}-]){1}(?={0})'.format(
+      re.escape(os.sep), re.escape(old)))
+  def replace(value):
+    if isinstance(value, dict):
+      return dict((k, replace(v)) for k, v in value.items())
+    if isinstance(value, list):
+      return [replace(v) for v in value]
+    if isinstance(value, (type(u''), str)):
+      return pattern.sub(lambda match: new, value)
+    return value
+  summary = dict(summary)
+  for field in runner.DETAILED_OUTCOMES + ('output',):
+    if field in summary:
+      summary[field] = replace(summary[field])
+  return summary
+
+
+def records_from_summary(summary):
+  '''Return the records, in the format of SynchronizedTestResult.records, of
+  the tests in 'summary', as loaded from a result file.'''
+  records = {}
+  fingerprints = summary.get('fingerprints', {})
+  budgets = summary.get('timeBudget', {}).get('tests', {})
+  timings = summary.get('timings', {}).get('tests', {})
+  outputs = summary.get('output', {})
+  for test_id in summary['allTests']:
+    records[test_id] = {'outcome': None, 'detail': None,
+        'fingerprint': fingerprints.get(test_id)}
+  for outcome in runner.LIST_OUTCOMES:
+    for test_id in summary[outcome]:
+      records.setdefault(test_id, {})['outcome'] = outcome
+  for outcome in runner.DETAILED_OUTCOMES:
+    for test_id, detail in summary[outcome].items():
+      records.setdefault(test_id, {}).update(outcome=outcome, detail=detail)
+  for test_id, record in records.items():
+    if test_id in budgets:
+      record['timeLimit'] = budgets[test_id]['limit']
+      record['elapsed'] = budgets[test_id]['elapsed']
+    if test_id in timings:
+      record['timing'] = timings[test_id]
+    if test_id in outputs:
+      record['output'] = outputs[test_id]
+  return records
+
+
+class ResultCache(object):
+  '''A cache of test summaries keyed on the contents of the submission and of
+  everything else that determines its results: the test module and its local
+  helpers, the runner itself and the time limits. A submission whose inputs are
+  byte-identical to those of an earlier run, of the same group or of another,
+  is given the cached summary instead of being graded again.
+
+  Summaries with aborted tests are never cached, since whether a test runs out
+  of time depends on the load of the host as much as on its inputs.'''
+
+  def __init__(self, cache_dir, module, search_path=None, **options):
+    ''''module' is the name of the test module, looked up in 'search_path'
+    (sys.path by default), and 'options' are the settings of the runner that
+    affect the outcomes of the tests, such as the time limits.'''
+    self.cache_dir = cache_dir
+    if module.endswith('.py'):
+      module = module[:-3]
+    path = find_module_file(module, sys.path if search_path is None else
+        search_path)
+    if path is None:
+      raise Exception('Cannot find the test module {0}'.format(module))
+    digest = hashlib.sha1()
+    runner_path = os.path.splitext(os.path.abspath(runner.__file__))[0] + '.py'
+    for p in local_dependencies(path) + [runner_path]:
+      digest.update(os.path.basename(p).encode('utf-8') + b'\0')
+      hash_file(digest, p)
+    # The timeout profile is identified by its contents
+    if options.get('timeout_profile') is not None:
+      options = dict(options)
+      hash_file(digest, options.pop('timeout_profile'))
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    self.inputs_digest = digest.hexdigest()
+
+  def key(self, test_root, ignored=()):
+    '''Return the cache key of the submission in 'test_root', ignoring the
+    files whose paths relative to it are in 'ignored', such as the results of
+    earlier runs.'''
+    digest = hashlib.sha1(self.inputs_digest.encode('utf-8'))
+    digest.update(hash_tree(test_root, ignored).encode('utf-8'))
+    return digest.hexdigest()
+
+  def submission_key(self, test_root, result_file_path='results.json',
+      redir_console=None):
+    '''Return the cache key of the submission in 'test_root' as graded by the
+    runner with these options, ignoring the files it writes, see
+    written_paths. Every entry point computes the key of a submission this
+    way, so that they share the cached results.'''
+    return self.key(test_root, written_paths(test_root, result_file_path,
+        redir_console, self.cache_dir))
+
+  def path_for(self, key):
+    '''Return the path of the cached summary for 'key'.'''
+    return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+  def load(self, key, test_root):
+    '''Return the cached summary for 'key' as it applies to the submission in
+    'test_root', or None if there is none.'''
+    try:
+      with open(self.path_for(key)) as cached:
+        summary = json.load(cached)
+    except (IOError, ValueError):
+      # A missing or corrupt summary, e.g. one truncated by a full disk, is a
+      # miss
+      return None
+    return replace_root(summary, ROOT_PLACEHOLDER, os.path.abspath(test_root))
+
+  def store(self, key, test_root, summary):
+    '''Cache 'summary', the summary of the tests of the submission in
+    'test_root', under 'key', unless some of its tests were aborted.'''
+    if len(summary['aborted']) > 0:
+      return
+    path = self.path_for(key)
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    # The tracebacks name the student's files relative to 'test_root' as it
+    # was given to the runner, or absolute
+    for root in (os.path.abspath(test_root), os.path.normpath(test_root)):
+      summary = replace_root(summary, root, ROOT_PLACEHOLDER)
+    with open(path + '.tmp', 'w') as cached:
+      json.dump(summary, cached, indent=True)
+    os.rename(path + '.tmp', path)
+
+  def restore(self, test_root, result_file_path='results.json',
+      redir_console=None):
+    '''If the summary of the submission in 'test_root' is cached, write it to
+    the result file at 'result_file_path', relative to 'test_root', and
+    return it. Otherwise return None. 'redir_console' is the file the console
+    of the runner is redirected to, if any.'''
+    key = self.submission_key(test_root, result_file_path, redir_console)
+    summary = self.load(key, test_root)
+    if summary is not None:
+      runner.write_summary(summary, os.path.join(test_root, result_file_path))
+    return summary
+
+
+def ignored_paths(test_root, paths):
+  '''Return the paths relative to 'test_root' of those of the files at 'paths',
+  also relative to 'test_root' unless absolute, that are inside of it. These
+  are the files and directories written by the runner, which are not part of
+  the submission.'''
+  ignored = set()
+  for p in paths:
+    if p is not None:
+      relative = os.path.relpath(os.path.join(test_root, p), test_root)
+      if not relative.startswith(os.pardir):
+        ignored.add(relative)
+  return ignored
+
+
+def written_paths(test_root, result_file_path='results.json',
+    redir_console=None, cache_dir=None):
+  '''Return the paths relative to 'test_root' of the files that the runner
+  writes inside of it when grading it: the result file at 'result_file_path',
+  relative to 'test_root' unless absolute, and the files that accompany it,
+  and the console redirection 'redir_console' and the result cache
+  'cache_dir', relative to the working directory, if they are inside of it.
+  The cache may be kept inside of the submission it caches.'''
+  paths = runner.output_paths(result_file_path)
+  paths += [os.path.abspath(p) for p in (redir_console, cache_dir)
+      if p is not None]
+  return ignored_paths(test_root, paths)
+
+# vim: set ts=2 sw=2 expandtab:
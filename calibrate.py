@@ -0,0 +1,134 @@
+from __future__ import print_function
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import forkserver
+import metrics
+import runner
+
+
+def calibrate(module, reference_root, runs=5, percentile=99, factor=3.0,
+    floor=1.0, **options):
+  '''Grade the reference solution in 'reference_root' with the tests in
+  'module' 'runs' times, and return the timeout profile of the tests, which
+  runner.load_timeout_profile reads: the 'percentile'th percentile of the
+  runtime of each test, along with the 'factor' and the 'floor' of the time
+  limits, and the speed of this host. 'options' are the keyword arguments
+  passed to runner.process_one_submission. The tests that do not pass with
+  the reference solution are reported, since their runtime is not that of a
+  correct submission.'''
+  runtimes = collections.defaultdict(list)
+  failing = set()
+  directory = tempfile.mkdtemp()
+  try:
+    result_file_path = os.path.join(directory, 'results.json')
+    worker = forkserver.Worker(module, result_file_path=result_file_path,
+        overwrite_existing_results=True, **options)
+    for run in range(runs):
+      if worker.grade_one(reference_root) != 0:
+        raise Exception('Failed to grade the reference solution')
+      with open(result_file_path) as result_file:
+        summary = json.load(result_file)
+      for test_id, budget in summary['timeBudget']['tests'].items():
+        runtimes[test_id].append(budget['elapsed'])
+      failing.update(t for t in summary['allTests']
+          if not any(t in summary[o] for o in runner.PASSING_OUTCOMES))
+      runner.displayln('Run {0}/{1}: {2:.3f} s'.format(run + 1, runs,
+          summary['timeBudget']['suite']['elapsed']))
+  finally:
+    shutil.rmtree(directory)
+  for test_id in sorted(failing):
+    runner.displayln(('Warning: {0} does not pass with the reference ' +
+        'solution').format(test_id))
+
+  tests = {}
+  for test_id, samples in runtimes.items():
+    samples.sort()
+    value = metrics.percentile(samples, percentile)
+    tests[test_id] = {'percentile': value, 'max': samples[-1],
+        'limit': max(floor, factor * value)}
+  return {'module': module, 'hostSpeed': runner.host_speed(), 'runs': runs,
+      'percentile': percentile, 'factor': factor, 'floor': floor,
+      'tests': tests}
+
+
+def format_profile(profile):
+  '''Format the time limits of a timeout profile as a table.'''
+  lines = ['{0:>10} {1:>10} {2:>10}  {3}'.format(
+      'p{0:g} (s)'.format(profile['percentile']), 'Max (s)', 'Limit (s)',
+      'Test')]
+  for test_id in sorted(profile['tests'],
+      key=lambda t: -profile['tests'][t]['limit']):
+    test = profile['tests'][test_id]
+    lines.append('{0:>10.3f} {1:>10.3f} {2:>10.3f}  {3}'.format(
+        test['percentile'], test['max'], test['limit'], test_id))
+  return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Calibrate the time limits ' +
+    'of the tests of a module by running them several times against the ' +
+    'reference solution. Each test is given the chosen percentile of its ' +
+    'runtime times a factor, but no less than a floor, scaled by the speed ' +
+    'of the host that grades, relative to that of this host. The profile is ' +
+    'used with the --timeout-profile option of runner.py and of the batch ' +
+    'scripts.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  parser.add_argument('module', help='The module containing tests to be run.')
+
+  parser.add_argument('reference_root', help='The directory containing the ' +
+    'reference solution.')
+
+  parser.add_argument('-O', '--output', help='The file to write the timeout ' +
+    'profile to.', default='timeouts.json')
+
+  parser.add_argument('-N', '--runs', help='The number of times the tests ' +
+    'are run.', default=5, type=int)
+
+  parser.add_argument('-P', '--percentile', help='The percentile of the ' +
+    'runtime of each test the limit is based on.', default=99, type=float)
+
+  parser.add_argument('-k', '--factor', help='The factor applied to the ' +
+    'percentile of the runtime of each test.', default=3.0, type=float)
+
+  parser.add_argument('--floor', help='The min number of seconds a test is ' +
+    'allowed to run.', default=1.0, type=float)
+
+  parser.add_argument('-t', '--timeout', help='The max number of seconds ' +
+    'all the tests together are allowed to run.', default=600, type=float)
+
+  parser.add_argument('-p', '--processes', help='Run the tests in this many ' +
+    'worker processes instead of threads, as they will be when grading.',
+    default=0, type=int)
+
+  parser.add_argument('-n', '--threads', help='The number of worker threads ' +
+    'that run the tests, when not running them in processes.', default=8,
+    type=int)
+
+  runner.add_resource_limit_arguments(parser)
+
+  if len(sys.argv) == 1:
+    parser.print_help()
+    exit(-2)
+
+  args = parser.parse_args()
+
+  # The test module is imported relative to the working directory, as
+  # runner.py does
+  sys.path.append(os.getcwd())
+
+  # The host is measured before the tests load it
+  runner.host_speed()
+  profile = calibrate(args.module, args.reference_root, args.runs,
+      args.percentile, args.factor, args.floor, timeout=args.timeout,
+      processes=args.processes, threads=args.threads,
+      resource_limits=runner.resource_limits_from_args(args))
+  with open(args.output, 'w') as output:
+    json.dump(profile, output, indent=2, sort_keys=True)
+  print(format_profile(profile))
+
+# vim: set ts=2 sw=2 expandtab:
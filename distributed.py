@@ -0,0 +1,712 @@
+from __future__ import print_function
+import argparse
+import binascii
+import collections
+import hmac
+import io
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import cache
+import forkserver
+import parallel
+import runner
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.request import Request, urlopen
+  from urllib.error import HTTPError, URLError
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urllib2 import Request, urlopen, HTTPError, URLError
+
+
+# The environment variable from which the coordinator and the workers read
+# the token that authenticates the workers, unless it is given explicitly
+TOKEN_VARIABLE = 'AUTOGRADER_TOKEN'
+
+
+def zip_files(root, paths):
+  '''Return a zip archive of the files at 'paths', relative to 'root'.'''
+  data = io.BytesIO()
+  with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+    for p in paths:
+      archive.write(os.path.join(root, p), p)
+  return data.getvalue()
+
+
+def files_under(root, paths=None, ignored=()):
+  '''Return the paths relative to 'root' of the files in the tree at 'root',
+  or only of those at or under 'paths' if specified, skipping the files and
+  directories whose relative paths are in 'ignored'.'''
+  found = []
+  for local_root, dirs, files in os.walk(root):
+    dirs[:] = sorted(d for d in dirs if os.path.relpath(
+        os.path.join(local_root, d), root) not in ignored)
+    for f in sorted(files):
+      relative = os.path.relpath(os.path.join(local_root, f), root)
+      if relative in ignored:
+        continue
+      if paths is None or any(relative == p or
+          relative.startswith(os.path.join(p, '')) for p in paths):
+        found.append(relative)
+  return found
+
+
+def unzip_into(data, root, allowed=None):
+  '''Extract the zip archive 'data' into the directory 'root'. Members that
+  would land outside of 'root', or that are neither one of the relative paths
+  in 'allowed' nor under one of them, if specified, are refused.'''
+  with zipfile.ZipFile(io.BytesIO(data)) as archive:
+    for name in archive.namelist():
+      path = os.path.normpath(name)
+      if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+        raise Exception('Refusing to extract {0}'.format(name))
+      if allowed is not None and not any(path == a or
+          path.startswith(os.path.join(a, '')) for a in allowed):
+        raise Exception('Refusing to extract {0}'.format(name))
+    archive.extractall(root)
+
+
+class CoordinatorServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+  '''Serves the protocol between a Coordinator and its RemoteWorkers:
+
+    GET  /batch              the test module, the options of the runner and
+                             the heartbeat interval, as JSON
+    POST /jobs/next          assigns a job to the worker named in the JSON
+                             body, replying with its 'job' identifier and its
+                             'name', or 204 if none is available yet, or 410
+                             if the batch is over
+    GET  /jobs/ID/bundle     a zip archive of the submission of job ID
+    POST /jobs/ID/heartbeat  keeps job ID assigned to the worker
+    POST /jobs/ID/result     a zip archive of the results of job ID, with
+                             the exit code of the grading in the X-Exit-Code
+                             header, or 400 if it is missing
+
+  The worker is named by the X-Worker header of the requests about a job. A
+  request about a job that is no longer assigned to the worker gets 409.
+  Every request must carry the token of the coordinator in its X-Token
+  header, or it gets 403.'''
+
+  def log_message(self, format, *args):
+    pass
+
+  def reply(self, code, body=b'', content_type='application/json'):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def reply_json(self, value):
+    self.reply(200, json.dumps(value).encode('utf-8'))
+
+  def job_path(self):
+    '''Return the job identifier and the action of a /jobs/ID/ACTION path, or
+    (None, None) if the path is not of this form.'''
+    parts = self.path.strip('/').split('/')
+    if len(parts) == 3 and parts[0] == 'jobs':
+      return parts[1], parts[2]
+    return None, None
+
+  def authorized(self):
+    '''Return True if the request carries the token of the coordinator, and
+    reply 403 otherwise.'''
+    token = self.headers.get('X-Token') or ''
+    if hmac.compare_digest(token.encode('utf-8'),
+        self.server.coordinator.token.encode('utf-8')):
+      return True
+    self.reply(403)
+    return False
+
+  def do_GET(self):
+    coordinator = self.server.coordinator
+    if not self.authorized():
+      return
+    job_id, action = self.job_path()
+    if self.path == '/batch':
+      self.reply_json(coordinator.batch())
+    elif action == 'bundle':
+      data = coordinator.bundle(job_id, self.headers.get('X-Worker'))
+      if data is None:
+        self.reply(409)
+      else:
+        self.reply(200, data, 'application/zip')
+    else:
+      self.reply(404)
+
+  def do_POST(self):
+    coordinator = self.server.coordinator
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if not self.authorized():
+      return
+    job_id, action = self.job_path()
+    if self.path == '/jobs/next':
+      job = coordinator.next_job(json.loads(body.decode('utf-8'))['worker'])
+      if job is None:
+        self.reply(410 if coordinator.finished() else 204)
+      else:
+        self.reply_json(job)
+    elif action == 'heartbeat':
+      alive = coordinator.heartbeat(job_id, self.headers.get('X-Worker'))
+      self.reply(200 if alive else 409)
+    elif action == 'result':
+      try:
+        exitcode = int(self.headers.get('X-Exit-Code'))
+      except (TypeError, ValueError):
+        self.reply(400)
+        return
+      accepted = coordinator.complete(job_id, self.headers.get('X-Worker'),
+          exitcode, self.headers.get('X-Test-Root'), body)
+      self.reply(200 if accepted else 409)
+    else:
+      self.reply(404)
+
+
+class Coordinator(object):
+  '''Owns the queue of the submissions of a batch, and hands them out to the
+  RemoteWorkers that connect to it over HTTP, on this host or on others. The
+  workers download each submission, grade it, and upload its results, which
+  are written to the submission directory here, as if it had been graded
+  locally.
+
+  A worker sends heartbeats for the jobs it is running. A job whose worker
+  has not been heard from for three heartbeat intervals is considered lost,
+  and is queued again, as is a job whose grading failed, up to 'retries'
+  times. The progress of the batch is recorded in the same 'journal' as
+  parallel.BatchScheduler, and the submissions that were graded according to
+  it are skipped when resuming.
+
+  The coordinator only listens on the local host by default, since anyone who
+  can reach it and knows its 'token' can download the submissions and
+  upload results. The token is random unless specified.'''
+
+  def __init__(self, module, test_roots, address=('127.0.0.1', 8000),
+      retries=2, heartbeat=10.0, journal=None, resume=False, token=None,
+      **options):
+    ''''options' are the keyword arguments passed to
+    runner.process_one_submission for every submission.'''
+    self.module = module
+    self.token = token or binascii.hexlify(os.urandom(16)).decode('ascii')
+    self.options = options
+    self.retries = retries
+    self.heartbeat_interval = heartbeat
+    self.result_file_path = options.get('result_file_path', 'results.json')
+
+    # Grades nothing itself, but consults the result cache, if any
+    self.local = forkserver.Worker(module, **options)
+
+    # The workers need not see the files of this host, so they are sent the
+    # contents of the timeout profile, if any
+    self.timeout_profile = None
+    if options.get('timeout_profile') is not None:
+      with open(options['timeout_profile']) as profile_file:
+        self.timeout_profile = json.load(profile_file)
+
+    # Map the identifier of each job to its state, in the format of the
+    # events of the journal, and to the times it started and was last heard
+    # from while running
+    self.jobs = collections.OrderedDict()
+    self.pending = collections.deque()
+    previous = {}
+    if resume and journal is not None and os.path.isfile(journal):
+      previous = parallel.replay_journal(journal)
+    for i, test_root in enumerate(parallel.longest_first(list(test_roots),
+        self.result_file_path)):
+      job = {'job': test_root, 'state': 'queued', 'attempt': 0}
+      if previous.get(test_root, {}).get('state') == 'done':
+        job = dict(previous[test_root], resumed=True)
+      self.jobs[str(i)] = job
+      if job['state'] == 'queued':
+        self.pending.append(str(i))
+
+    self.lock = threading.Condition()
+    self.journal = None
+    if journal is not None:
+      self.journal = runner.EventStream(journal, 'a' if resume else 'w')
+    self.server = CoordinatorServer(address, CoordinatorHandler)
+    self.server.coordinator = self
+
+  def record(self, job_id):
+    '''Record the state of job 'job_id' in the journal, if any. The caller
+    must hold the lock.'''
+    if self.journal is not None:
+      self.journal.write({k: v for k, v in self.jobs[job_id].items()
+          if k not in ('worker', 'started', 'seen', 'completing')})
+
+  def batch(self):
+    '''Return the description of the batch sent to the workers, including
+    the contents of the timeout profile, if any, which each worker scales to
+    the speed of its own host.'''
+    options = {k: v for k, v in self.options.items()
+        if k not in ('cache_dir', 'timeout_profile')}
+    batch = {'module': self.module, 'options': options,
+        'heartbeat': self.heartbeat_interval}
+    if self.timeout_profile is not None:
+      batch['timeoutProfile'] = self.timeout_profile
+    return batch
+
+  def finished(self):
+    with self.lock:
+      return all(j['state'] in ('done', 'failed') for j in self.jobs.values())
+
+  def next_job(self, worker):
+    '''Assign the next pending job to 'worker' and return its description, or
+    return None if there is none.'''
+    while True:
+      with self.lock:
+        if len(self.pending) == 0:
+          return None
+        job_id = self.pending.popleft()
+        job = self.jobs[job_id]
+        if job['attempt'] > 0:
+          return self.assign(job_id, worker)
+      # The job is neither pending nor running while its submission is hashed
+      # to look up its cached results, which only this thread does
+      restored = self.local.restore(job['job'])
+      with self.lock:
+        if not restored:
+          return self.assign(job_id, worker)
+        job.update(state='done', exitcode=0, elapsed=0.0, cached=True)
+        self.record(job_id)
+        self.lock.notify_all()
+
+  def assign(self, job_id, worker):
+    '''Assign the job 'job_id', which is no longer pending, to 'worker' and
+    return its description. The caller must hold the lock.'''
+    job = self.jobs[job_id]
+    now = time.time()
+    job.pop('exitcode', None)
+    job.pop('elapsed', None)
+    job.update(state='running', worker=worker, started=now, seen=now,
+        attempt=job['attempt'] + 1)
+    self.record(job_id)
+    return {'job': job_id, 'name': os.path.basename(
+        os.path.abspath(job['job']))}
+
+  def assigned(self, job_id, worker):
+    '''Return the running job 'job_id' if it is assigned to 'worker', or None
+    otherwise. The caller must hold the lock.'''
+    job = self.jobs.get(job_id)
+    if job is None or job['state'] != 'running' or job['worker'] != worker:
+      return None
+    return job
+
+  def heartbeat(self, job_id, worker):
+    '''Record that 'worker' is still running job 'job_id', and return False
+    if the job is no longer assigned to it.'''
+    with self.lock:
+      job = self.assigned(job_id, worker)
+      if job is not None:
+        job['seen'] = time.time()
+      return job is not None
+
+  def bundle(self, job_id, worker):
+    '''Return a zip archive of the submission of job 'job_id', without the
+    results of earlier runs, or None if the job is not assigned to
+    'worker'.'''
+    with self.lock:
+      job = self.assigned(job_id, worker)
+      if job is None:
+        return None
+      test_root = job['job']
+    ignored = cache.ignored_paths(test_root,
+        runner.output_paths(self.result_file_path))
+    return zip_files(test_root, files_under(test_root, ignored=ignored))
+
+  def end_attempt(self, job_id, exitcode):
+    '''Record that the current attempt at job 'job_id' ended with 'exitcode',
+    or was lost if it is None, and queue the job again if it failed and may
+    be retried. The caller must hold the lock.'''
+    job = self.jobs[job_id]
+    job['elapsed'] = time.time() - job.pop('started')
+    job['exitcode'] = exitcode
+    if exitcode == 0:
+      job['state'] = 'done'
+    elif job['attempt'] <= self.retries:
+      job['state'] = 'queued'
+      self.pending.append(job_id)
+    else:
+      job['state'] = 'failed'
+    self.record(job_id)
+    self.lock.notify_all()
+
+  def complete(self, job_id, worker, exitcode, worker_root, data):
+    '''Write the results of job 'job_id', a zip archive of the files written
+    by the runner in the directory 'worker_root' of 'worker', to the
+    submission directory. Return False if the job is no longer assigned to
+    'worker', in which case its results are discarded.'''
+    with self.lock:
+      job = self.assigned(job_id, worker)
+      if job is None or job.get('completing'):
+        return False
+      # The results are written without holding the lock, during which the
+      # job is not considered lost
+      job['completing'] = True
+      test_root = job['job']
+    try:
+      unzip_into(data, test_root, runner.output_paths(self.result_file_path))
+      # The tracebacks name the files of the submission in the directory
+      # where the worker graded it
+      for p in runner.output_paths(self.result_file_path)[:2]:
+        path = os.path.join(test_root, p)
+        if os.path.isfile(path):
+          with open(path) as f:
+            text = f.read()
+          with open(path, 'w') as f:
+            f.write(text.replace(json.dumps(worker_root)[1:-1],
+                json.dumps(os.path.normpath(test_root))[1:-1]))
+      if exitcode == 0:
+        self.local.store(test_root)
+    except:
+      with self.lock:
+        job.pop('completing')
+        job['seen'] = time.time()
+      raise
+    with self.lock:
+      job.pop('completing')
+      self.end_attempt(job_id, exitcode)
+    return True
+
+  def requeue_lost_jobs(self):
+    '''Queue again the running jobs whose workers have not sent a heartbeat
+    for three heartbeat intervals.'''
+    with self.lock:
+      deadline = time.time() - 3 * self.heartbeat_interval
+      for job_id, job in self.jobs.items():
+        if job['state'] == 'running' and job['seen'] < deadline and \
+            not job.get('completing'):
+          self.end_attempt(job_id, None)
+
+  def serve(self):
+    '''Serve the workers until every job is done or has failed, and return a
+    dictionary mapping each submission directory to the exit code of its
+    last attempt, which is None if its worker was lost.'''
+    server = threading.Thread(target=self.server.serve_forever)
+    server.daemon = True
+    server.start()
+    try:
+      while not self.finished():
+        with self.lock:
+          self.lock.wait(self.heartbeat_interval)
+        self.requeue_lost_jobs()
+      # Let the idle workers learn that the batch is over
+      time.sleep(self.heartbeat_interval)
+    finally:
+      self.server.shutdown()
+      self.server.server_close()
+      if self.journal is not None:
+        self.journal.close()
+    return {j['job']: j.get('exitcode') for j in self.jobs.values()}
+
+  def summary(self):
+    '''Return a description of the outcome of the batch.'''
+    jobs = list(self.jobs.values())
+    failed = [j for j in jobs if j['state'] == 'failed']
+    lines = [('Graded {0} submissions: {1} succeeded ({2} cached, ' +
+        '{3} resumed), {4} failed, {5} retried').format(len(jobs),
+        len(jobs) - len(failed), len([j for j in jobs if j.get('cached')]),
+        len([j for j in jobs if j.get('resumed')]), len(failed),
+        len([j for j in jobs if j['attempt'] > 1]))]
+    if len(failed) > 0:
+      lines.append('Failed submissions:')
+      lines.extend('  {0} (exit code {1}, {2} attempts)'.format(j['job'],
+          j['exitcode'], j['attempt']) for j in failed)
+    return '\n'.join(lines)
+
+
+class RemoteWorker(forkserver.ForkServer):
+  '''Grades the submissions handed out by the Coordinator at 'url', which
+  requires its 'token', running up to 'slots' of them at the same time, each
+  in a child process forked from this one as in a ForkServer. Each slot is a
+  worker of its own for the coordinator. The test module, which must be
+  importable from the working directory, and the options of the runner are
+  those of the coordinator. The submissions are unpacked in 'workdir', a
+  temporary directory by default, and removed once graded.'''
+
+  def __init__(self, url, token, slots=1, preload=(), workdir=None):
+    self.url = url.rstrip('/')
+    self.token = token
+    self.slots = slots
+    self.workdir = workdir or tempfile.mkdtemp(prefix='cuautograde-')
+    self.name = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+    batch = json.loads(self.call('/batch')[1].decode('utf-8'))
+    self.heartbeat_interval = batch['heartbeat']
+    options = {str(k): v for k, v in batch['options'].items()}
+    if batch.get('timeoutProfile') is not None:
+      if not os.path.isdir(self.workdir):
+        os.makedirs(self.workdir)
+      options['timeout_profile'] = os.path.join(self.workdir,
+          'timeout-profile.json')
+      with open(options['timeout_profile'], 'w') as profile_file:
+        json.dump(batch['timeoutProfile'], profile_file)
+    forkserver.ForkServer.__init__(self, batch['module'], preload, **options)
+
+    # Maps the identifier of each job being graded to the process id of its
+    # child and the name of its slot
+    self.active = {}
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+
+  def call(self, path, body=None, headers=None, worker=None):
+    '''Send a request for 'path' to the coordinator on behalf of the slot
+    named 'worker', a POST with 'body' if specified, and return its status
+    code along with the body of its reply.'''
+    request = Request(self.url + path, body, dict(headers or {},
+        **{'X-Worker': worker or self.name, 'X-Token': self.token}))
+    try:
+      response = urlopen(request)
+      return response.getcode(), response.read()
+    except HTTPError as e:
+      return e.code, e.read()
+
+  def run_job(self, job_id, name, worker):
+    '''Download, grade and upload the results of the job 'job_id', whose
+    submission directory is named 'name', assigned to the slot named
+    'worker'.'''
+    status, data = self.call('/jobs/{0}/bundle'.format(job_id),
+        worker=worker)
+    if status != 200:
+      return
+    test_root = os.path.join(self.workdir, job_id, name)
+    try:
+      os.makedirs(test_root)
+      unzip_into(data, test_root)
+      with self.lock:
+        pid = self.fork(test_root)
+        self.active[job_id] = (pid, worker)
+      _, exitcode = self.wait(pid)
+      with self.lock:
+        self.active.pop(job_id)
+      result_file_path = self.options.get('result_file_path', 'results.json')
+      results = zip_files(test_root, files_under(test_root,
+          runner.output_paths(result_file_path)))
+      self.call('/jobs/{0}/result'.format(job_id), results, {
+          'X-Exit-Code': str(exitcode),
+          'X-Test-Root': os.path.abspath(test_root),
+          'Content-Type': 'application/zip'}, worker)
+    finally:
+      shutil.rmtree(os.path.join(self.workdir, job_id), ignore_errors=True)
+
+  def pull_jobs(self, slot):
+    '''The body of the slot 'slot': grade the jobs handed out by the
+    coordinator, until the batch is over or the coordinator is gone.'''
+    worker = '{0}-{1}'.format(self.name, slot)
+    while not self.done.is_set():
+      try:
+        status, data = self.call('/jobs/next', json.dumps(
+            {'worker': worker}).encode('utf-8'),
+            {'Content-Type': 'application/json'}, worker)
+      except (URLError, socket.error):
+        return
+      if status == 200:
+        job = json.loads(data.decode('utf-8'))
+        self.run_job(job['job'], job['name'], worker)
+      elif status == 204:
+        self.done.wait(min(1.0, self.heartbeat_interval))
+      else:
+        return
+
+  def send_heartbeats(self):
+    '''Send a heartbeat for every job being graded, once per heartbeat
+    interval, and kill the children of the jobs that the coordinator gave
+    to another worker in the meantime.'''
+    while not self.done.wait(self.heartbeat_interval):
+      with self.lock:
+        active = list(self.active.items())
+      for job_id, (pid, worker) in active:
+        try:
+          status, _ = self.call('/jobs/{0}/heartbeat'.format(job_id), b'',
+              worker=worker)
+        except (URLError, socket.error):
+          continue
+        if status == 409:
+          try:
+            os.kill(pid, signal.SIGKILL)
+          except OSError:
+            pass
+
+  def serve(self):
+    '''Grade jobs until the batch is over.'''
+    heartbeats = threading.Thread(target=self.send_heartbeats)
+    heartbeats.daemon = True
+    heartbeats.start()
+    slots = [threading.Thread(target=self.pull_jobs, args=(slot,))
+        for slot in range(self.slots)]
+    for s in slots:
+      s.daemon = True
+      s.start()
+    for s in slots:
+      while s.is_alive():
+        s.join(1.0)
+    self.done.set()
+
+
+def parse_address(address):
+  '''Return the (host, port) pair of an address of the form [HOST:]PORT, on
+  the local host if HOST is omitted.'''
+  host, _, port = address.rpartition(':')
+  return host or '127.0.0.1', int(port)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='This module grades a batch ' +
+    'of submissions on several hosts. A coordinator owns the queue of the ' +
+    'submissions, and workers, on the same host or on others, connect to ' +
+    'it over HTTP to download submissions, grade them and upload their ' +
+    'results.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  subparsers = parser.add_subparsers(dest='role')
+
+  coordinator = subparsers.add_parser('coordinator', help='Serve the ' +
+    'submissions of a batch to the workers.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  coordinator.add_argument('module', help='The module containing tests to ' +
+    'be run. The workers must be able to import it too.')
+
+  coordinator.add_argument('batch_root', help='The directory containing one ' +
+    'subdirectory per submission.')
+
+  coordinator.add_argument('-a', '--address', help='The [HOST:]PORT to ' +
+    'listen on. Only the local host can connect unless HOST is specified, ' +
+    'e.g. 0.0.0.0 for every interface.', default='127.0.0.1:8000')
+
+  coordinator.add_argument('--token', help='The token the workers must ' +
+    'present. Defaults to the {0} environment variable, or to a random ' +
+    'token, which is printed.'.format(TOKEN_VARIABLE), default=None)
+
+  coordinator.add_argument('--retries', help='The number of times a ' +
+    'submission whose grading failed, or whose worker was lost, is graded ' +
+    'again.', default=2, type=int)
+
+  coordinator.add_argument('--heartbeat', help='The number of seconds ' +
+    'between the heartbeats of the workers.', default=10.0, type=float)
+
+  coordinator.add_argument('--journal', help='The file in which the state ' +
+    'of each submission is recorded as the batch runs.', default=None)
+
+  coordinator.add_argument('-R', '--resume', help='Skip the submissions ' +
+    'that were graded according to the journal.', action='store_true',
+    default=False)
+
+  coordinator.add_argument('-r', '--result-file-path', help='The path to ' +
+    'the file, relative to each submission directory, to store the results ' +
+    'as JSON objects.', default='results.json')
+
+  coordinator.add_argument('-t', '--timeout', help='The max number of ' +
+    'seconds all the tests of a submission together are allowed to run.',
+    default=600, type=float)
+
+  coordinator.add_argument('-T', '--test-timeout', help='The max number of ' +
+    'seconds a test is allowed to run, unless it declares its own limit.',
+    default=None, type=float)
+
+  coordinator.add_argument('--timeout-profile', help='The profile of the ' +
+    'time limits of the tests written by calibrate.py, which is sent to the ' +
+    'workers.', default=None)
+
+  coordinator.add_argument('-o', '--overwrite-existing-results',
+    help='Indicates what action to take when a result file already exists',
+    action='store_true', default=False)
+
+  coordinator.add_argument('-p', '--processes', help='Run the tests of each ' +
+    'submission in this many worker processes instead of threads.',
+    default=0, type=int)
+
+  coordinator.add_argument('-n', '--threads', help='The number of worker ' +
+    'threads that run the tests, when not running them in processes.',
+    default=8, type=int)
+
+  coordinator.add_argument('-C', '--result-cache', help='The directory of ' +
+    'the cache of results, which is consulted before handing out a ' +
+    'submission.', default=None)
+
+  coordinator.add_argument('--output-limit', help='Capture what each test ' +
+    'prints, keeping at most this many characters from the start and the ' +
+    'end of it, and store it in the result file instead of the console.',
+    default=None, type=int)
+
+  runner.add_resource_limit_arguments(coordinator)
+
+  worker = subparsers.add_parser('worker', help='Grade the submissions ' +
+    'handed out by a coordinator.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  worker.add_argument('url', help='The URL of the coordinator, e.g. ' +
+    'http://host:8000.')
+
+  worker.add_argument('--token', help='The token of the coordinator. ' +
+    'Defaults to the {0} environment variable.'.format(TOKEN_VARIABLE),
+    default=None)
+
+  worker.add_argument('-j', '--jobs', help='The number of submissions to ' +
+    'grade at the same time.', default=1, type=int)
+
+  worker.add_argument('-l', '--preload', help='The modules to import once ' +
+    'before grading any submission.', nargs='+', default=[])
+
+  worker.add_argument('-w', '--workdir', help='The directory in which the ' +
+    'submissions are unpacked while they are graded.', default=None)
+
+  worker.add_argument('-f', '--fixture-cache', help='The directory in which ' +
+    'the fixtures built with fixtures.cached are shared between runs.',
+    default=None)
+
+  if len(sys.argv) == 1:
+    parser.print_help()
+    exit(-2)
+
+  args = parser.parse_args()
+
+  # The test module is imported relative to the working directory, as
+  # runner.py does
+  sys.path.append(os.getcwd())
+
+  if args.role == 'coordinator':
+    journal = args.journal
+    if journal is None:
+      journal = os.path.join(args.batch_root, 'batch.ndjson')
+    server = Coordinator(args.module,
+        forkserver.submission_dirs(args.batch_root),
+        parse_address(args.address), args.retries, args.heartbeat, journal,
+        args.resume, args.token or os.environ.get(TOKEN_VARIABLE),
+        result_file_path=args.result_file_path,
+        timeout=args.timeout,
+        overwrite_existing_results=args.overwrite_existing_results,
+        processes=args.processes, threads=args.threads,
+        test_timeout=args.test_timeout, cache_dir=args.result_cache,
+        resource_limits=runner.resource_limits_from_args(args),
+        output_limit=args.output_limit, timeout_profile=args.timeout_profile)
+    if args.token is None and TOKEN_VARIABLE not in os.environ:
+      print('Token of the workers: {0}'.format(server.token))
+      sys.stdout.flush()
+    exitcodes = server.serve()
+    print(server.summary())
+    if any(e != 0 for e in exitcodes.values()):
+      exit(1)
+  else:
+    if args.fixture_cache is not None:
+      import fixtures
+      fixtures.CACHE_DIR = args.fixture_cache
+    token = args.token or os.environ.get(TOKEN_VARIABLE)
+    if token is None:
+      parser.error('The token of the coordinator is required')
+    RemoteWorker(args.url, token, args.jobs, args.preload,
+        args.workdir).serve()
+
+# vim: set ts=2 sw=2 expandtab:
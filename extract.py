@@ -1,16 +1,42 @@
 #!/usr/bin/env python
 
 import argparse
+import errno
 import fnmatch
+import multiprocessing
 import os
+import posixpath
+import re
 import shutil
 import tempfile
+import traceback
 import zipfile
 
 
 # The conventional name of the folder within the CMS' submission.zip
 SUBMISSION_DIR_NAME = 'Submissions'
 
+# The directory of the destination in which the submissions are extracted
+# before they are moved to their own directory. It is hidden so that the
+# partial submissions left by an interrupted extraction are never graded, see
+# forkserver.submission_dirs.
+STAGING_DIR_NAME = '.extracting'
+
+# The max depth of the zip files nested within a zip file that are extracted.
+# Deeper ones are extracted as they are.
+MAX_DEPTH = 8
+
+# The size in bytes above which a nested zip file is spooled to a temporary
+# file, rather than held in memory, while it is extracted
+SPOOL_THRESHOLD = 16 * 1024 * 1024
+
+# The matchers compiled by file_matcher, by their patterns
+_matchers = {}
+
+# The CMS zip file opened by each process of process_submission, along with
+# the destination and the options of extract_student, see _init_worker
+_worker = None
+
 def clean_empty_directories(root):
   '''
   Recursively delete empty directories starting at the 'root'. This function
@@ -56,17 +82,97 @@ def walk_and_extract_archives(root):
   return archive_count
 
 
-def extract(root, destination=None):
+def member_path(destination, name):
+  '''
+  Return the path in 'destination' of the zip file member 'name', without the
+  drive, absolute and parent components that would take it outside of it, as
+  ZipFile.extractall does.
+  '''
+  parts = [p for p in os.path.splitdrive(name)[1].split('/')
+      if p not in ('', '.', '..')]
+  return os.path.join(destination, *parts) if len(parts) > 0 else None
+
+
+def file_matcher(fnmatch_patterns):
+  '''
+  Return a compiled regular expression that matches the file names that match
+  one of the 'fnmatch_patterns'. It is only compiled once for each list of
+  patterns.
+  '''
+  key = tuple(fnmatch_patterns)
+  if key not in _matchers:
+    _matchers[key] = re.compile('|'.join('(?:{0})'.format(fnmatch.translate(p))
+        for p in fnmatch_patterns))
+  return _matchers[key]
+
+
+def extract_archive(source_zip, destination, prefix='', max_depth=MAX_DEPTH,
+    spool_threshold=SPOOL_THRESHOLD, matcher=None):
+  '''
+  Extract the members of the open zip file 'source_zip' whose name starts with
+  'prefix' into the 'destination' directory, relative to 'prefix'. The members
+  that are zip files themselves are extracted in the same way, directly from
+  'source_zip', into the directory that contains them, up to 'max_depth'
+  levels of nesting. A nested zip file is read from memory, or from a
+  temporary file if it is larger than 'spool_threshold' bytes, so that only
+  the files it contains are written. If a 'matcher' is specified, see
+  file_matcher, only the files whose name it matches are written, all of them
+  directly in 'destination', as collapse_and_filter_directory would leave
+  them, and the other files are not even decompressed.
+  '''
+  for info in source_zip.infolist():
+    if not info.filename.startswith(prefix):
+      continue
+    name = info.filename[len(prefix):]
+    if matcher is not None:
+      name = posixpath.basename(name)
+    path = member_path(destination, name)
+    if path is None:
+      continue
+    if info.filename.endswith('/'):
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      continue
+    is_archive = max_depth > 0 and name.endswith('.zip')
+    if matcher is not None and not is_archive and matcher.match(name) is None:
+      continue
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+      os.makedirs(parent)
+    with source_zip.open(info) as member:
+      if is_archive:
+        with tempfile.SpooledTemporaryFile(spool_threshold) as spooled:
+          shutil.copyfileobj(member, spooled)
+          spooled.seek(0)
+          if zipfile.is_zipfile(spooled):
+            with zipfile.ZipFile(spooled) as inner_zip:
+              extract_archive(inner_zip, parent, '', max_depth - 1,
+                  spool_threshold, matcher)
+            continue
+          # A file that is not really a zip file is extracted as it is
+          if matcher is None or matcher.match(name) is not None:
+            spooled.seek(0)
+            with open(path, 'wb') as f:
+              shutil.copyfileobj(spooled, f)
+      else:
+        with open(path, 'wb') as f:
+          shutil.copyfileobj(member, f)
+
+
+def extract(root, destination=None, max_depth=MAX_DEPTH):
   '''
   Extract the zip file at 'root' into the directory 'destination', or to
-  the zip file's parent if 'destination' is None.
+  the zip file's parent if 'destination' is None, along with the zip files
+  nested within it.
   '''
   if root.endswith('.zip'):
     if destination == None:
       destination = os.path.basename(root)[:-4]
-    extract_zip(root, destination)
-  while walk_and_extract_archives(destination) > 0:
-    pass
+    with zipfile.ZipFile(root) as source_zip:
+      extract_archive(source_zip, destination, '', max_depth)
+  else:
+    while walk_and_extract_archives(destination) > 0:
+      pass
 
 
 def collapse_and_filter_directory(root, fnmatch_patterns):
@@ -105,25 +211,132 @@ def move(leftpath, rightpath, overwrite=False):
   return False
 
 
+def student_dirs(submission):
+  '''
+  Return the names of the directories of the students, or groups, in the CMS
+  'submission' zip file, its path or the open zip file.
+  '''
+  if not isinstance(submission, zipfile.ZipFile):
+    with zipfile.ZipFile(submission) as source_zip:
+      return student_dirs(source_zip)
+  prefix = SUBMISSION_DIR_NAME + '/'
+  students = set()
+  for name in submission.namelist():
+    if name.startswith(prefix) and '/' in name[len(prefix):]:
+      students.add(name[len(prefix):].split('/')[0])
+  return sorted(students)
+
+
+def extract_student(submission, student, destination, clean_empty, overwrite,
+    file_pattern, max_depth=MAX_DEPTH):
+  '''
+  Extract the directory of a single 'student' from the CMS 'submission' zip
+  file, its path or the open zip file, along with the zips nested up to
+  'max_depth' levels deep within it, see extract_archive, to the directory of
+  the same name in 'destination'. Only the files that match one of the
+  'file_pattern' fnmatch patterns are extracted, all in that directory. The
+  directory is replaced if it exists and 'overwrite' is set, and left as it is
+  otherwise. Return the path of that directory, which no longer exists if it
+  was empty and 'clean_empty' is set.
+  '''
+  existing_directory = os.path.join(destination, student)
+  if os.path.exists(existing_directory) and not overwrite:
+    return existing_directory
+  # The files are filtered as they are extracted, to a staging directory on
+  # the same file system as their final one, which replaces it once they are
+  # all written
+  staging = os.path.join(destination, STAGING_DIR_NAME)
+  try:
+    os.makedirs(staging)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  extract_dir = tempfile.mkdtemp(prefix=student + '-', dir=staging)
+  try:
+    prefix = '{0}/{1}/'.format(SUBMISSION_DIR_NAME, student)
+    matcher = file_matcher(file_pattern)
+    if isinstance(submission, zipfile.ZipFile):
+      extract_archive(submission, extract_dir, prefix, max_depth,
+          matcher=matcher)
+    else:
+      with zipfile.ZipFile(submission) as source_zip:
+        extract_archive(source_zip, extract_dir, prefix, max_depth,
+            matcher=matcher)
+    if os.path.exists(existing_directory):
+      shutil.rmtree(existing_directory)
+    os.rename(extract_dir, existing_directory)
+  finally:
+    if os.path.exists(extract_dir):
+      shutil.rmtree(extract_dir)
+  if clean_empty:
+    clean_empty_directories(existing_directory)
+  return existing_directory
+
+
+def try_extract_student(submission, student, destination, **options):
+  '''
+  Extract the directory of a single 'student' as extract_student does with
+  'options', and return None, or the traceback of the error that prevented
+  it, e.g. a corrupt zip file.
+  '''
+  try:
+    extract_student(submission, student, destination, **options)
+    return None
+  except Exception:
+    return traceback.format_exc()
+
+
+def _init_worker(submission, destination, options):
+  global _worker
+  _worker = (zipfile.ZipFile(submission), destination, options)
+
+
+def _extract_in_worker(student):
+  source_zip, destination, options = _worker
+  return student, try_extract_student(source_zip, student, destination,
+      **options)
+
+
 def process_submission(submission, destination, clean_empty, overwrite,
-    file_pattern):
-  '''
-  Extract and cleanup a standard submission.
-  '''
-  extract_dir = tempfile.mkdtemp()
-  extracted_root = os.path.join(extract_dir, SUBMISSION_DIR_NAME)
-  existing_root = os.path.join(destination)
-  extract(submission, extract_dir)
-  if not os.path.exists(existing_root):
-    os.makedirs(existing_root)
-  for f in os.listdir(extracted_root):
-      extracted_directory = os.path.join(extracted_root, f)
-      existing_directory = os.path.join(existing_root, f)
-      if move(extracted_directory, existing_directory, overwrite):
-        collapse_and_filter_directory(existing_directory, file_pattern)
-  shutil.rmtree(extract_dir)
+    file_pattern, max_depth=MAX_DEPTH, jobs=1):
+  '''
+  Extract and cleanup a standard submission, extracting the zip files nested
+  up to 'max_depth' levels deep within it, and the directories of 'jobs'
+  students at a time, each in its own process. The students whose directory
+  could not be extracted do not stop the others. Return a dictionary mapping
+  each of them to the traceback of its error.
+  '''
+  if not os.path.exists(destination):
+    os.makedirs(destination)
+  options = dict(clean_empty=False, overwrite=overwrite,
+      file_pattern=file_pattern, max_depth=max_depth)
+  errors = {}
+  pool = None
+  # The zip file is opened once, rather than once per student, by this
+  # process and by each of the pool
+  with zipfile.ZipFile(submission) as source_zip:
+    students = student_dirs(source_zip)
+    if jobs > 1 and len(students) > 1:
+      pool = multiprocessing.Pool(min(jobs, len(students)), _init_worker,
+          (submission, destination, options))
+      results = pool.imap(_extract_in_worker, students)
+    else:
+      results = ((s, try_extract_student(source_zip, s, destination,
+          **options)) for s in students)
+    try:
+      for student, error in results:
+        if error is not None:
+          errors[student] = error
+    finally:
+      if pool is not None:
+        pool.terminate()
+        pool.join()
+  staging = os.path.join(destination, STAGING_DIR_NAME)
+  if os.path.isdir(staging) and len(os.listdir(staging)) == 0:
+    os.rmdir(staging)
   if clean_empty:
     clean_empty_directories(destination)
+  return errors
 
 
 if __name__ == '__main__':
@@ -144,9 +357,22 @@ if __name__ == '__main__':
   parser.add_argument('-l', '--list-of-files-to-collect', help='The list of ' +
       'files to collect from the submissions.', nargs='+', default=['*'])
 
+  parser.add_argument('--max-depth', help='The max number of levels of zip ' +
+      'files nested within the submission of a student that are extracted.',
+      default=MAX_DEPTH, type=int)
+
+  parser.add_argument('-j', '--jobs', help='The number of students whose ' +
+      'submission is extracted at the same time, each in its own process.',
+      default=1, type=int)
+
   args = parser.parse_args()
 
-  process_submission(args.submission, args.destination,
-      args.clean_empty_directories, False, args.list_of_files_to_collect)
+  errors = process_submission(args.submission, args.destination,
+      args.clean_empty_directories, False, args.list_of_files_to_collect,
+      args.max_depth, args.jobs)
+  for student in sorted(errors):
+    print('Failed to extract {0}:\n{1}'.format(student, errors[student]))
+  if len(errors) > 0:
+    exit(1)
 
 # vim: set ts=2 sw=2 expandtab:
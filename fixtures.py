@@ -0,0 +1,137 @@
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# The directory in which the fixtures are stored, shared by all the processes
+# grading the same assignment
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'cuautograde-fixtures')
+
+# Maps the paths of the fixtures loaded by this process to the paths they are
+# stored at and their read-only views, or the pickled bytes of the fixtures
+# that are not mapped, so that a fixture is read at most once per process
+loaded = {}
+
+
+def module_hash(module):
+  '''Return a hash of the source of 'module', which is either a module or the
+  name of an imported module.'''
+  if not hasattr(module, '__file__'):
+    module = sys.modules[module]
+  path = module.__file__
+  if path.endswith('.pyc') or path.endswith('.pyo'):
+    path = path[:-1]
+  with open(path, 'rb') as source:
+    return hashlib.sha1(source.read()).hexdigest()
+
+
+def fixture_dir(module, cache_dir=None):
+  '''Return the directory holding the fixtures of the test module 'module'.
+  The directory changes whenever the module changes, so that fixtures built by
+  an older version of the tests are never used.'''
+  if cache_dir is None:
+    cache_dir = CACHE_DIR
+  name = getattr(module, '__name__', module)
+  return os.path.join(cache_dir, '{0}-{1}'.format(name, module_hash(module)))
+
+
+def write_fixture(value, path):
+  '''Write 'value' to 'path' in the format its type is mapped from, and return
+  the path actually written, which has an extension naming the format.'''
+  if numpy is not None and isinstance(value, numpy.ndarray):
+    path += '.npy'
+    with open(path + '.tmp', 'wb') as f:
+      numpy.save(f, value)
+  elif isinstance(value, (bytes, bytearray)):
+    path += '.bin'
+    with open(path + '.tmp', 'wb') as f:
+      f.write(value)
+  else:
+    path += '.pickle'
+    with open(path + '.tmp', 'wb') as f:
+      pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+  # Readers only ever see complete files
+  os.rename(path + '.tmp', path)
+  return path
+
+
+def read_fixture(path):
+  '''Return a read-only view of the fixture stored at 'path'. Arrays and raw
+  buffers are memory mapped, so that every process shares the same physical
+  copy, while other objects are returned pickled, see cached.'''
+  if path.endswith('.npy'):
+    return numpy.load(path, mmap_mode='r')
+  elif path.endswith('.bin'):
+    with open(path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        return b''
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  else:
+    with open(path, 'rb') as f:
+      return f.read()
+
+
+def find_fixture(path):
+  '''Return the path of the stored fixture whose name without the extension
+  is 'path', or None if it has not been built yet.'''
+  for extension in ('.npy', '.bin', '.pickle'):
+    if os.path.isfile(path + extension):
+      return path + extension
+  return None
+
+
+def cached(module, name, build, cache_dir=None):
+  '''Return a read-only view of the fixture 'name' of the test module
+  'module', calling 'build' to create it only if no process has built it for
+  the current version of the module yet. Intended to be called from
+  setUpClass, e.g.
+
+    cls.expected = fixtures.cached(__name__, 'expected', compute_expected)
+
+  numpy arrays and bytes are returned as memory-mapped, zero-copy views,
+  which are read-only and shared by every submission graded by the process,
+  and any other picklable value as a fresh unpickled copy on every call, so
+  that the changes the tests of a submission make to it are not seen by
+  those of the next.'''
+  directory = fixture_dir(module, cache_dir)
+  path = os.path.join(directory, name)
+  if path in loaded:
+    return unpickled(*loaded[path])
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  stored = find_fixture(path)
+  if stored is None:
+    # Only one process builds the fixture, the others wait for it
+    with open(path + '.lock', 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+        stored = find_fixture(path)
+        if stored is None:
+          stored = write_fixture(build(), path)
+      finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+  loaded[path] = (stored, read_fixture(stored))
+  return unpickled(*loaded[path])
+
+
+def unpickled(stored, view):
+  '''Return the fixture stored at 'stored' from the 'view' of it returned by
+  read_fixture, unpickling it if it is pickled.'''
+  if stored.endswith('.pickle'):
+    return pickle.loads(view)
+  return view
+
+# vim: set ts=2 sw=2 expandtab:
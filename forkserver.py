@@ -0,0 +1,299 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import sys
+import traceback
+import runner
+
+
+class Worker(object):
+  '''Grades many submissions against the same test module one after the
+  other in this long-lived process, paying for the interpreter startup and
+  for importing the heavy dependencies of the tests only once.
+
+  The worker imports the 'preload' modules (e.g. numpy, cv2 or a module of
+  shared fixtures) up front. Each submission is then graded with its own
+  scoped import path, and the test module and the student's modules are
+  imported afresh for it and unloaded afterwards, see
+  runner.SubmissionImports, while the dependencies of the tests remain loaded.
+
+  Since threads cannot be killed, the tests should run in worker processes
+  (the 'processes' option), so that a test that runs out of time does not
+  keep running in this process while the next submissions are graded.'''
+
+  def __init__(self, module, preload=(), **options):
+    ''''module' is the test module, and 'options' are the keyword arguments
+    passed to runner.process_one_submission for every submission.'''
+    self.module = module
+    self.options = options
+    for name in preload:
+      importlib.import_module(name)
+
+    # The result cache, if any, is consulted before grading, so that the
+    # submissions whose results are cached do not cost a run at all
+    self.cache = None
+    if options.get('cache_dir') is not None:
+      import cache
+      self.cache = cache.ResultCache(options['cache_dir'], module,
+          timeout=options.get('timeout', 600.0),
+          test_timeout=options.get('test_timeout'),
+          resource_limits=options.get('resource_limits'),
+          output_limit=options.get('output_limit'),
+          timeout_profile=options.get('timeout_profile'))
+
+    # The speed of the host, by which the calibrated time limits are scaled,
+    # is measured once for all the submissions, before the host gets busy
+    if options.get('timeout_profile') is not None:
+      runner.host_speed()
+
+  def restore(self, test_root):
+    '''Write the cached results of the submission in 'test_root', if any, and
+    return True if they were found. Profiled submissions are always graded.'''
+    if self.cache is None or self.options.get('profile', False):
+      return False
+    result_file_path = self.options.get('result_file_path', 'results.json')
+    if os.path.isfile(os.path.join(test_root, result_file_path)) and \
+        not self.options.get('overwrite_existing_results', False):
+      # Let the grading report that the results already exist
+      return False
+    summary = self.cache.restore(test_root, result_file_path,
+        self.options.get('redir_console'))
+    if summary is None:
+      return False
+    runner.display_summary(os.path.basename(os.path.abspath(test_root)) +
+        ' (cached)', summary, self.options.get('timings', False))
+    return True
+
+  def store(self, test_root):
+    '''Cache the results that were written in 'test_root' by grading the
+    submission outside of this process, if there is a result cache.'''
+    if self.cache is None:
+      return
+    result_file_path = self.options.get('result_file_path', 'results.json')
+    with open(os.path.join(test_root, result_file_path)) as result_file:
+      summary = json.load(result_file)
+    self.cache.store(self.cache.submission_key(test_root, result_file_path,
+        self.options.get('redir_console')), test_root, summary)
+
+  def grade_one(self, test_root, **options):
+    '''Grade the submission in 'test_root' in this process, and return 0 if
+    all of its tests completed, or 1 otherwise. 'options' override the options
+    of the worker for this submission. The console is restored once the
+    submission is graded.'''
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+      # Leave the random state as if this were a fresh interpreter
+      random.seed(runner.RANDOM_SEED)
+      runner.process_one_submission(self.module, test_root,
+          **dict(self.options, **options))
+      return 0
+    except:
+      traceback.print_exc(file=sys.stdout)
+      return 1
+    finally:
+      if sys.stdout is not stdout:
+        sys.stdout.close()
+      sys.stdout, sys.stderr = stdout, stderr
+
+  def grade(self, test_roots):
+    '''Grade each submission directory in 'test_roots' in turn. Return a
+    dictionary mapping each submission directory to its exit code, as
+    returned by grade_one.'''
+    exitcodes = {}
+    for test_root in test_roots:
+      if self.restore(test_root):
+        exitcodes[test_root] = 0
+      else:
+        exitcodes[test_root] = self.grade_one(test_root)
+    return exitcodes
+
+
+class ForkServer(Worker):
+  '''A Worker that forks a fresh child process for every submission, which
+  inherits the preloaded modules and grades the submission, so that several
+  submissions can be graded at the same time, and a submission that crashes
+  its process does not affect the others.'''
+
+  def __init__(self, module, preload=(), **options):
+    Worker.__init__(self, module, preload, **options)
+
+    # Maps the process id of each running child to its submission directory
+    self.children = {}
+
+  def fork(self, test_root, **options):
+    '''Start grading the submission in 'test_root' in a new child process,
+    with 'options' overriding those of the server, and return its process
+    id.'''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # Other threads may print, e.g. the stages of a pipeline, and the child
+    # must not inherit the lock of the console while they hold it
+    with runner.console_lock:
+      pid = os.fork()
+    if pid == 0:
+      exitcode = 1
+      try:
+        exitcode = self.grade_one(test_root, **options)
+      finally:
+        sys.stdout.flush()
+        os._exit(exitcode)
+    self.children[pid] = test_root
+    return pid
+
+  def wait(self, pid=-1, block=True):
+    '''Wait for the child whose process id is 'pid', or for any child, to
+    exit, and return its submission directory along with its exit code. If
+    'block' is False, return None at once if no child exited.'''
+    pid, status = os.waitpid(pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+      return None
+    test_root = self.children.pop(pid)
+    if os.WIFEXITED(status):
+      return test_root, os.WEXITSTATUS(status)
+    return test_root, -os.WTERMSIG(status)
+
+  def grade(self, test_roots, jobs=1):
+    '''Grade each submission directory in 'test_roots' in its own child,
+    running at most 'jobs' children at a time. Return a dictionary mapping
+    each submission directory to the exit code of its child.'''
+    exitcodes = {}
+    for test_root in test_roots:
+      if self.restore(test_root):
+        exitcodes[test_root] = 0
+        continue
+      if len(self.children) >= jobs:
+        root, exitcode = self.wait()
+        exitcodes[root] = exitcode
+      self.fork(test_root)
+    while len(self.children) > 0:
+      root, exitcode = self.wait()
+      exitcodes[root] = exitcode
+    return exitcodes
+
+
+def submission_dirs(batch_root):
+  '''Yield the submission directories to grade. If 'batch_root' is '-', they
+  are read from the standard input one per line, as they become available,
+  otherwise they are the subdirectories of 'batch_root', except the hidden
+  ones, such as the staging directory of extract.py.'''
+  if batch_root == '-':
+    for line in iter(sys.stdin.readline, ''):
+      if line.strip() != '':
+        yield line.strip()
+  else:
+    for d in sorted(os.listdir(batch_root)):
+      if not d.startswith('.') and os.path.isdir(os.path.join(batch_root, d)):
+        yield os.path.join(batch_root, d)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='This module is used to run ' +
+    'the tests of a single module on many submissions. It imports the ' +
+    'dependencies of the tests once, and then forks a fresh process to ' +
+    'grade each submission, or grades them one after the other in its own ' +
+    'process, in the same way as runner.py.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  parser.add_argument('module', help='The module containing tests to be run.')
+
+  parser.add_argument('batch_root', help='The directory containing one ' +
+    'subdirectory per submission, or - to read the submission directories ' +
+    'from the standard input, one per line.')
+
+  parser.add_argument('-l', '--preload', help='The modules to import once ' +
+    'before grading any submission.', nargs='+', default=[])
+
+  parser.add_argument('-j', '--jobs', help='The number of submissions to ' +
+    'grade at the same time.', default=1, type=int)
+
+  parser.add_argument('-i', '--in-process', help='Grade the submissions ' +
+    'one after the other in this process instead of forking a child for ' +
+    'each, which is faster when the suites are short. Use with --processes.',
+    action='store_true', default=False)
+
+  parser.add_argument('-r', '--result-file-path', help='The path to the file, '+
+    'relative to each submission directory, to store the results as JSON ' +
+    'objects.', default='results.json')
+
+  parser.add_argument('-t', '--timeout', help='The max number of seconds ' +
+    'all the tests together are allowed to run.', default=600, type=float)
+
+  parser.add_argument('-T', '--test-timeout', help='The max number of ' +
+    'seconds a test is allowed to run, unless it declares its own limit.',
+    default=None, type=float)
+
+  parser.add_argument('--timeout-profile', help='The profile of the time ' +
+    'limits of the tests written by calibrate.py.', default=None)
+
+  parser.add_argument('-o', '--overwrite-existing-results', help='Indicates ' +
+    'what action to take when a result file already exists',
+    action='store_true', default=False)
+
+  parser.add_argument('-v', '--verbose', help='Show the result of every test.',
+    action='store_true', default=False)
+
+  parser.add_argument('-p', '--processes', help='Run the tests of each ' +
+    'submission in this many worker processes instead of threads.',
+    default=0, type=int)
+
+  parser.add_argument('-n', '--threads', help='The number of worker threads ' +
+    'that run the tests, when not running them in processes.', default=8,
+    type=int)
+
+  parser.add_argument('-f', '--fixture-cache', help='The directory in which ' +
+    'the fixtures built with fixtures.cached are shared between runs.',
+    default=None)
+
+  parser.add_argument('-C', '--result-cache', help='The directory of the ' +
+    'cache of results. A submission whose files, test module and time ' +
+    'limits are identical to those of a cached run is not graded again.',
+    default=None)
+
+  parser.add_argument('--output-limit', help='Capture what each test ' +
+    'prints, keeping at most this many characters from the start and the ' +
+    'end of it, and store it in the result file instead of the console.',
+    default=None, type=int)
+
+  parser.add_argument('--profile', help='Run every test and class fixture ' +
+    'under cProfile, as with runner.py.', action='store_true', default=False)
+
+  runner.add_resource_limit_arguments(parser)
+
+  if len(sys.argv) == 1:
+    parser.print_help()
+    exit(-2)
+
+  args = parser.parse_args()
+
+  if args.fixture_cache is not None:
+    import fixtures
+    fixtures.CACHE_DIR = args.fixture_cache
+
+  # The preloaded modules, like the test module, may be imported relative to
+  # the working directory, as runner.py does
+  sys.path.append(os.getcwd())
+
+  options = dict(result_file_path=args.result_file_path, timeout=args.timeout,
+      overwrite_existing_results=args.overwrite_existing_results,
+      verbose=args.verbose, processes=args.processes, threads=args.threads,
+      test_timeout=args.test_timeout, cache_dir=args.result_cache,
+      resource_limits=runner.resource_limits_from_args(args),
+      output_limit=args.output_limit, profile=args.profile,
+      timeout_profile=args.timeout_profile)
+  if args.in_process:
+    worker = Worker(args.module, args.preload, **options)
+    exitcodes = worker.grade(submission_dirs(args.batch_root))
+  else:
+    server = ForkServer(args.module, args.preload, **options)
+    exitcodes = server.grade(submission_dirs(args.batch_root), args.jobs)
+  failed = sorted(k for k, v in exitcodes.items() if v != 0)
+  if len(failed) > 0:
+    print('Failed to completely grade {0} of {1} submissions:'.format(
+        len(failed), len(exitcodes)))
+    for f in failed:
+      print(f)
+    exit(1)
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,268 @@
+from __future__ import print_function
+import collections
+import json
+import os
+import threading
+import time
+import runner
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+# The prefix of the names of the Prometheus metrics
+PROMETHEUS_PREFIX = 'autograder_'
+
+
+def percentile(values, p):
+  '''Return the 'p'th percentile of the sorted list 'values', by the nearest
+  rank, or None if it is empty.'''
+  if len(values) == 0:
+    return None
+  return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+class BatchMetrics(object):
+  '''Live metrics of a batch of submissions, updated with the state changes
+  recorded by parallel.BatchScheduler, see update, and read from other
+  threads with snapshot.
+
+  The submissions that are being graded are assigned to the first of 'jobs'
+  slots that is free, so that the utilization of each slot, i.e. of each
+  worker of the batch, can be reported whatever runs the submissions. If
+  'total' is specified, it is the number of submissions in the batch, which
+  may not be queued yet, e.g. because they are still being extracted.'''
+
+  def __init__(self, jobs, total=None):
+    self.lock = threading.Lock()
+    self.start_time = time.time()
+    self.total = total
+
+    # The last state of each submission, the number of seconds each graded
+    # submission took, and the submissions whose results were cached
+    self.states = {}
+    self.latencies = []
+    self.cached = 0
+
+    # The submission in each slot, the time it started, and the number of
+    # seconds each slot was busy with the submissions that ended
+    self.slots = [None] * jobs
+    self.slot_started = [None] * jobs
+    self.slot_busy = [0.0] * jobs
+
+  def update(self, test_root, state, **details):
+    '''Record the new 'state' of the submission in 'test_root', one of the
+    states recorded by parallel.BatchScheduler.record, with its 'details'.'''
+    now = time.time()
+    with self.lock:
+      previous = self.states.get(test_root)
+      self.states[test_root] = state
+      if state == 'running' and None in self.slots:
+        slot = self.slots.index(None)
+        self.slots[slot] = test_root
+        self.slot_started[slot] = now
+      elif previous == 'running' and test_root in self.slots:
+        slot = self.slots.index(test_root)
+        self.slot_busy[slot] += now - self.slot_started[slot]
+        self.slots[slot] = None
+      if state in ('done', 'failed'):
+        if details.get('cached', False):
+          self.cached += 1
+        elif 'elapsed' in details:
+          self.latencies.append(details['elapsed'])
+
+  def snapshot(self):
+    '''Return the current metrics as a dictionary.'''
+    now = time.time()
+    with self.lock:
+      counts = collections.Counter(self.states.values())
+      latencies = sorted(self.latencies)
+      utilization = []
+      for slot, busy in enumerate(self.slot_busy):
+        if self.slots[slot] is not None:
+          busy += now - self.slot_started[slot]
+        utilization.append(busy / max(now - self.start_time, 1e-9))
+      cached = self.cached
+      total = self.total
+    elapsed = now - self.start_time
+    completed = counts['done'] + counts['failed']
+    if total is None:
+      total = len(self.states)
+    throughput = 60.0 * completed / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if completed > 0:
+      eta = (total - completed) * elapsed / completed
+    return {
+      'elapsed': elapsed,
+      'total': total,
+      'completed': completed,
+      'succeeded': counts['done'],
+      'failed': counts['failed'],
+      'cached': cached,
+      'running': counts['running'],
+      'queued': counts['queued'],
+      'throughputPerMinute': throughput,
+      'latency': {'p50': percentile(latencies, 50),
+          'p95': percentile(latencies, 95),
+          'max': latencies[-1] if len(latencies) > 0 else None},
+      'utilization': utilization,
+      'eta': eta}
+
+
+def format_status(snapshot):
+  '''Format a snapshot of BatchMetrics as a one-line status.'''
+  def seconds(value):
+    return '-' if value is None else '{0:.1f}s'.format(value)
+  latency = snapshot['latency']
+  utilization = snapshot['utilization']
+  return ('[{0:.0f}s] {1}/{2} done ({3} failed, {4} cached), {5} running, ' +
+      '{6} queued | {7:.1f}/min | latency p50 {8} p95 {9} max {10} | ' +
+      'utilization {11:.0%} | ETA {12}').format(snapshot['elapsed'],
+      snapshot['completed'], snapshot['total'], snapshot['failed'],
+      snapshot['cached'], snapshot['running'], snapshot['queued'],
+      snapshot['throughputPerMinute'], seconds(latency['p50']),
+      seconds(latency['p95']), seconds(latency['max']),
+      sum(utilization) / max(len(utilization), 1), seconds(snapshot['eta']))
+
+
+def format_prometheus(snapshot):
+  '''Format a snapshot of BatchMetrics in the Prometheus text format.'''
+  lines = []
+  def metric(name, kind, help, samples):
+    name = PROMETHEUS_PREFIX + name
+    lines.append('# HELP {0} {1}'.format(name, help))
+    lines.append('# TYPE {0} {1}'.format(name, kind))
+    for labels, value in samples:
+      if value is not None:
+        lines.append('{0}{1} {2}'.format(name, labels, value))
+  metric('submissions', 'gauge', 'The number of submissions in each state.',
+      [('{{state="{0}"}}'.format(k), snapshot[k]) for k in ('total',
+      'completed', 'succeeded', 'failed', 'cached', 'running', 'queued')])
+  metric('elapsed_seconds', 'gauge', 'The time since the batch started.',
+      [('', snapshot['elapsed'])])
+  metric('throughput_per_minute', 'gauge', 'The number of submissions ' +
+      'graded per minute.', [('', snapshot['throughputPerMinute'])])
+  metric('latency_seconds', 'gauge', 'The time it took to grade a ' +
+      'submission.', [('{{quantile="{0}"}}'.format(q),
+      snapshot['latency'][k]) for q, k in (('0.5', 'p50'), ('0.95', 'p95'),
+      ('1', 'max'))])
+  metric('worker_utilization', 'gauge', 'The fraction of the time each ' +
+      'worker was busy.', [('{{worker="{0}"}}'.format(i), u)
+      for i, u in enumerate(snapshot['utilization'])])
+  metric('eta_seconds', 'gauge', 'The estimated time until the batch ends.',
+      [('', snapshot['eta'])])
+  return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  '''Serves the metrics of the server's BatchMetrics: GET /metrics in the
+  Prometheus text format, and GET /metrics.json as JSON.'''
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    snapshot = self.server.metrics.snapshot()
+    if self.path == '/metrics':
+      body = format_prometheus(snapshot).encode('utf-8')
+      content_type = 'text/plain; version=0.0.4'
+    elif self.path == '/metrics.json':
+      body = json.dumps(snapshot).encode('utf-8')
+      content_type = 'application/json'
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class MetricsReporter(object):
+  '''Reports the BatchMetrics 'metrics' while a batch runs: every 'interval'
+  seconds, a status line is written to the console, unless 'console' is
+  False, and the metrics are written to the file at 'path', if specified, in
+  the Prometheus text format if its extension is .prom, or as JSON otherwise.
+  If 'port' is specified, the metrics are also served over HTTP on that port
+  of the local host, see MetricsHandler.'''
+
+  def __init__(self, metrics, interval=10.0, path=None, port=None,
+      console=True):
+    self.metrics = metrics
+    self.interval = interval
+    self.path = path
+    self.console = console
+    self.stopped = threading.Event()
+    self.thread = None
+    self.server = None
+    if port is not None:
+      self.server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+      self.server.metrics = metrics
+
+  def report(self):
+    '''Report the current metrics once.'''
+    snapshot = self.metrics.snapshot()
+    if self.console:
+      runner.displayln(format_status(snapshot))
+    if self.path is not None:
+      if self.path.endswith('.prom'):
+        text = format_prometheus(snapshot)
+      else:
+        text = json.dumps(snapshot, indent=2)
+      # Readers never see a partial file
+      with open(self.path + '.tmp', 'w') as metrics_file:
+        metrics_file.write(text)
+      os.rename(self.path + '.tmp', self.path)
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.report()
+
+  def start(self):
+    '''Start reporting in background threads.'''
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    if self.server is not None:
+      thread = threading.Thread(target=self.server.serve_forever)
+      thread.daemon = True
+      thread.start()
+
+  def stop(self):
+    '''Stop reporting, after reporting the final metrics.'''
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+    self.report()
+
+
+def add_metrics_arguments(parser):
+  '''Add the arguments of the metrics reported while a batch runs to the
+  argparse parser 'parser'.'''
+  parser.add_argument('--status-interval', help='The number of seconds ' +
+    'between the status lines written to the console, and between the ' +
+    'updates of the metrics file. 0 disables the status lines.',
+    default=10.0, type=float)
+
+  parser.add_argument('--metrics', help='The file to which the live ' +
+    'metrics of the batch are written, in the Prometheus text format if its ' +
+    'extension is .prom, or as JSON otherwise.', default=None)
+
+  parser.add_argument('--metrics-port', help='Serve the live metrics of ' +
+    'the batch over HTTP on this port of the local host, at /metrics and ' +
+    '/metrics.json.', default=None, type=int)
+
+
+def reporter_from_args(metrics, args):
+  '''Return the MetricsReporter of the BatchMetrics 'metrics' configured by
+  the arguments added by add_metrics_arguments, as parsed into 'args'.'''
+  return MetricsReporter(metrics, args.status_interval or 10.0, args.metrics,
+      args.metrics_port, args.status_interval > 0)
+
+# vim: set ts=2 sw=2 expandtab:
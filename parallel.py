@@ -2,57 +2,528 @@ from __future__ import print_function
 import time
 import collections
 import argparse
-import multiprocessing.pool
+import codecs
+import gc
+import importlib
+import json
+import multiprocessing
 import os
 import sys
-import process_isolation
+import shutil
+import stat
+import threading
+import cache
+import forkserver
+import metrics
 import runner
-import cv2
 
-print(sys.path)
 
-def run_jailed_test(module, deps, timeout, overwrite_existing_results, root):
-  context = process_isolation.default_context()
-  context.ensure_started()
+def run_sandbox(jail, worker, connection):
+  '''The body of a sandbox process of a SandboxPool: confine this process to
+  the directory 'jail', then grade the submissions received from
+  'connection' one after the other with the forkserver.Worker 'worker'. The
+  exit code of each is sent back along with whether the sandbox is still
+  clean enough to be reused. The sandbox stops when it receives None.'''
+  # The sandbox is forked while the pool holds the console lock, which is
+  # never released in this process
+  runner.console_lock = threading.Lock()
+  cwd = os.getcwd()
   try:
-    context.client.call(os.chroot, root)
-  except OSError:
-    print('This script must be run with superuser priviledges.')
-    exit(-1)
-  for d in deps:
-    context.load_module(d, path=sys.path)
-  context.load_module(module, path=sys.path)
-  runner = context.load_module('cuautograde.runner', path=sys.path)
-  return runner.process_one_submission(module, '/', timeout=timeout,
-      overwrite_existing_results=overwrite_existing_results)
-
-def run_jailed_test_helper(args):
-  run_jailed_test(*args)
-
-
-def run_batch(batch_root, module, deps, timeout, overwrite_existing_results):
-  roots = [os.path.join(batch_root, r) for r in os.listdir(batch_root)]
-  args = []
-  for r in roots:
-    a = (module, deps, timeout, overwrite_existing_results, r)
-    args.append(a)
-    run_jailed_test_helper(a)
-
-def _run_batch(batch_root, module, timeout, overwrite_existing_results):
-  roots = [os.path.join(batch_root, r) for r in os.listdir(batch_root)]
-  args = []
-  for r in roots:
-    args.append((module, timeout, overwrite_existing_results, r))
-  p = multiprocessing.pool.ThreadPool(processes=(2 * multiprocessing.cpu_count()))
-  results = p.map_async(run_jailed_test_helper, args)
-  p.close()
-  p.join()
-  res_dict = collections.defaultdict(list)
-  for r in results.get():
+    os.chroot(jail)
+    os.chdir(cwd)
+  except OSError as err:
+    connection.send(str(err))
+    return
+  connection.send(None)
+  # The grading joins the threads that ran its tests, unless they were
+  # abandoned while still running, see runner.InterruptibleThreadPool
+  threads = threading.active_count()
+  while True:
     try:
-      res_code = r.get()
-    except Exception as ex:
-      print(ex)
+      job = connection.recv()
+    except EOFError:
+      # The pool is gone
+      break
+    if job is None:
+      break
+    test_root, options = job
+    exitcode = worker.grade_one(test_root, **options)
+    # Reset what the tests may have changed in this process. A test that is
+    # still running in a thread cannot be stopped, so the sandbox is recycled.
+    os.chdir(cwd)
+    gc.collect()
+    connection.send((exitcode, threading.active_count() <= threads))
+
+
+class SandboxPool(object):
+  '''A pool of 'size' long-lived sandbox processes, each confined to the
+  chroot jail 'jail' (which requires superuser privileges), that grade
+  submissions one after the other with the forkserver.Worker 'worker'.
+
+  The sandboxes are forked from this process once the worker has imported its
+  dependencies, so that they start with the dependencies loaded and do not
+  need to find them in the jail. Since the sandboxes cannot see the files
+  outside of the jail, the test module and its local helpers, the 'files'
+  the tests read, and each submission are copied into the jail at their own
+  path under it, so that the results are the same as outside of it. A
+  submission is removed from the jail once its results are copied back.
+
+  A sandbox is recycled, i.e. replaced by a fresh one, after it graded
+  'max_jobs' submissions, when it crashes, and when a test left a thread
+  running in it.'''
+
+  def __init__(self, jail, worker, size=1, max_jobs=100, files=()):
+    self.jail = os.path.abspath(jail)
+    self.worker = worker
+    self.max_jobs = max_jobs
+    self.result_file_path = worker.options.get('result_file_path',
+        'results.json')
+
+    module = worker.module[:-3] if worker.module.endswith('.py') else \
+        worker.module
+    path = cache.find_module_file(module, sys.path)
+    if path is None:
+      raise Exception('Cannot find the test module {0}'.format(module))
+    for p in cache.local_dependencies(path) + list(files):
+      self.copy(p, self.inside(p))
+    # The console of the tests, and of their worker processes, is the null
+    # device
+    null = self.inside(os.devnull)
+    if not os.path.exists(null):
+      if not os.path.isdir(os.path.dirname(null)):
+        os.makedirs(os.path.dirname(null))
+      os.mknod(null, stat.S_IFCHR | 0o666, os.makedev(1, 3))
+    # The codecs are imported when first used, which the sandboxes cannot do,
+    # as is importlib.metadata by invalidate_caches on Python 3, which is
+    # called before grading each submission, see runner.SubmissionImports
+    for encoding in ('utf-8', 'ascii', 'latin-1'):
+      codecs.lookup(encoding)
+    if hasattr(importlib, 'invalidate_caches'):
+      importlib.invalidate_caches()
+
+    # Map the connection to each sandbox to its process, the number of
+    # submissions it graded and its slot, and
+    # the connection to each busy sandbox to the submission it is grading
+    self.sandboxes = {}
+    self.idle = []
+    self.busy = {}
+    for slot in range(size):
+      self.idle.append(self.start_sandbox(slot))
+
+  def inside(self, path):
+    '''Return the path in the jail of the file at 'path' outside of it.'''
+    return os.path.join(self.jail, os.path.abspath(path).lstrip(os.sep))
+
+  def copy(self, source, destination):
+    '''Copy the file or directory 'source' to 'destination', replacing
+    it.'''
+    if os.path.isdir(destination):
+      shutil.rmtree(destination)
+    if os.path.isdir(source):
+      shutil.copytree(source, destination, symlinks=True)
+    elif os.path.exists(source):
+      if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+      shutil.copy2(source, destination)
+
+  def start_sandbox(self, slot):
+    '''Start a sandbox in 'slot' and return the connection to it.'''
+    connection, child_connection = multiprocessing.Pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    process = multiprocessing.Process(target=run_sandbox,
+        args=(self.jail, self.worker, child_connection))
+    # The sandboxes are not daemons so that the tests can run in processes
+    with runner.console_lock:
+      process.start()
+    child_connection.close()
+    error = connection.recv()
+    if error is not None:
+      process.join()
+      raise Exception(('Cannot confine the sandbox to {0}, which requires ' +
+          'superuser privileges: {1}').format(self.jail, error))
+    self.sandboxes[connection] = {'process': process, 'jobs': 0,
+        'slot': slot}
+    return connection
+
+  def stop_sandbox(self, connection):
+    '''Stop the sandbox at the end of 'connection'.'''
+    process = self.sandboxes.pop(connection)['process']
+    try:
+      connection.send(None)
+    except (IOError, OSError):
+      pass
+    process.join(1)
+    if process.is_alive():
+      process.terminate()
+      process.join()
+    connection.close()
+
+  def start(self, test_root, **options):
+    '''Start grading the submission in 'test_root' in an idle sandbox, with
+    'options' overriding those of the worker, and return the connection to
+    the sandbox.'''
+    connection = self.idle.pop()
+    self.copy(test_root, self.inside(test_root))
+    # The result cache is outside of the jail
+    options = dict(options, cache_dir=None)
+    connection.send((test_root, options))
+    self.busy[connection] = test_root
+    return connection
+
+  def wait(self, timeout=None):
+    '''Wait for a busy sandbox to finish grading its submission, copy its
+    results back to the submission directory, and return the connection to
+    the sandbox along with the exit code of the grading, or None if no
+    sandbox finished within 'timeout' seconds.'''
+    ready = runner.wait_for_connections(list(self.busy), timeout)
+    if len(ready) == 0:
+      return None
+    connection = ready[0]
+    test_root = self.busy.pop(connection)
+    sandbox = self.sandboxes[connection]
+    sandbox['jobs'] += 1
+    try:
+      exitcode, clean = connection.recv()
+    except (EOFError, IOError):
+      sandbox['process'].join()
+      exitcode, clean = sandbox['process'].exitcode or 1, False
+    for p in runner.output_paths(self.result_file_path):
+      self.copy(os.path.join(self.inside(test_root), p),
+          os.path.join(test_root, p))
+    shutil.rmtree(self.inside(test_root), ignore_errors=True)
+    if clean and sandbox['jobs'] < self.max_jobs:
+      self.idle.append(connection)
+    else:
+      self.stop_sandbox(connection)
+      self.idle.append(self.start_sandbox(sandbox['slot']))
+    return connection, exitcode
+
+  def close(self):
+    '''Stop all the sandboxes.'''
+    for connection in list(self.sandboxes):
+      self.stop_sandbox(connection)
+    self.idle = []
+    self.busy = {}
+
+
+def run_jailed_test(module, test_root, jail, preload=(), files=(), **options):
+  '''Grade the submission in 'test_root' with the tests in 'module' in a
+  sandbox confined to 'jail', see SandboxPool, and return 0 if all of its
+  tests completed, or 1 otherwise. 'options' are the keyword arguments
+  passed to runner.process_one_submission.'''
+  worker = forkserver.Worker(module, preload, **options)
+  pool = SandboxPool(jail, worker, files=files)
+  try:
+    pool.start(test_root)
+    exitcode = pool.wait()[1]
+  finally:
+    pool.close()
+  if exitcode == 0:
+    worker.store(test_root)
+  return exitcode
+
+
+def expected_runtime(test_root, result_file_path='results.json'):
+  '''Return the number of seconds the tests of the submission in 'test_root'
+  and their class fixtures took the last time they ran, according to its
+  result file, or None if that is unknown.'''
+  try:
+    with open(os.path.join(test_root, result_file_path)) as result_file:
+      summary = json.load(result_file)
+  except (IOError, ValueError):
+    return None
+  elapsed = summary.get('timeBudget', {}).get('suite', {}).get('elapsed')
+  if elapsed is None:
+    return None
+  timings = summary.get('timings', {})
+  return elapsed + sum(sum(timings.get(func_name, {}).values())
+      for func_name in ('setUpClass', 'tearDownClass'))
+
+
+def replay_journal(path):
+  '''Return a dictionary mapping each submission directory in the journal at
+  'path', as written by BatchScheduler, to the last event recorded for it.'''
+  jobs = {}
+  for event in runner.read_events(path):
+    if 'job' in event:
+      jobs[event['job']] = event
+  return jobs
+
+
+def longest_first(test_roots, result_file_path='results.json'):
+  '''Return 'test_roots' ordered by decreasing expected runtime, so that the
+  longest submissions do not start last and delay the end of the batch. The
+  submissions whose runtime is unknown come first, in their original order.'''
+  expected = {r: expected_runtime(r, result_file_path) for r in test_roots}
+  return sorted(test_roots, key=lambda r: (expected[r] is not None,
+      -(expected[r] or 0.0)))
+
+
+class BatchScheduler(forkserver.ForkServer):
+  '''Grades a batch of submissions in a pool of 'jobs' child processes, one
+  submission per child, starting with the submissions that took the longest
+  the last time. A submission whose grading fails, e.g. because some of its
+  tests were aborted while the host was overloaded, is graded again up to
+  'retries' times, resuming from the tests that had not completed.
+
+  If 'jail' is specified, the submissions are instead graded in a SandboxPool
+  of 'jobs' sandboxes confined to that directory, which also receives the
+  'jail_files' the tests read, and each sandbox is recycled after grading
+  'recycle' submissions.
+
+  If 'journal' is specified, the state of each submission is recorded in the
+  event stream at that path as it changes: 'queued', 'running', 'done' or
+  'failed', along with the number of the attempt, and its exit code and
+  duration once it ended. An interrupted batch can then be resumed from the
+  journal, see grade.'''
+
+  def __init__(self, module, preload=(), jobs=None, retries=0, jail=None,
+      journal=None, jail_files=(), recycle=100, **options):
+    forkserver.ForkServer.__init__(self, module, preload, **options)
+    self.jobs = jobs or multiprocessing.cpu_count()
+    self.retries = retries
+    self.jail = jail
+    self.jail_files = jail_files
+    self.recycle = recycle
+    self.sandboxes = None
+    self.journal_path = journal
+    self.journal = None
+
+    # Map each submission directory to the number of times it was graded, the
+    # time its current attempt started and the number of seconds all its
+    # attempts took
+    self.attempts = collections.Counter()
+    self.started = {}
+    self.durations = collections.defaultdict(float)
+
+    # The submission directories whose results were taken from the cache, that
+    # were already graded according to the journal, and that were being
+    # graded when the interrupted batch stopped
+    self.cached = set()
+    self.resumed = set()
+    self.interrupted = set()
+
+    # The number of seconds the whole batch took, and the number of seconds
+    # all the attempts made by this scheduler took
+    self.elapsed = None
+    self.busy = 0.0
+
+    # The live metrics.BatchMetrics of the batch, if any, which are updated
+    # along with the journal
+    self.metrics = None
+
+  def record(self, test_root, state, **details):
+    '''Record the new 'state' of the submission in 'test_root' in the
+    journal and in the metrics, if any.'''
+    if self.metrics is not None:
+      self.metrics.update(test_root, state, **details)
+    if self.journal is not None:
+      self.journal.write(dict(details, job=test_root, state=state,
+          attempt=self.attempts[test_root]))
+
+  def launch(self, test_root, **options):
+    '''Start grading the submission in 'test_root', in a child or in a
+    sandbox, and return the key of the job in self.children.'''
+    if self.sandboxes is None:
+      return forkserver.ForkServer.fork(self, test_root, **options)
+    connection = self.sandboxes.start(test_root, **options)
+    self.children[connection] = test_root
+    return connection
+
+  def reap(self, pid=-1, block=True):
+    '''Wait for a job started by launch to end, and return its submission
+    directory along with its exit code, or None if 'block' is False and no
+    job ended.'''
+    if self.sandboxes is None:
+      return forkserver.ForkServer.wait(self, pid, block)
+    finished = self.sandboxes.wait(None if block else 0)
+    if finished is None:
+      return None
+    connection, exitcode = finished
+    test_root = self.children.pop(connection)
+    if exitcode == 0:
+      self.store(test_root)
+    return test_root, exitcode
+
+  def start_sandboxes(self):
+    '''Start the pool of sandboxes, if the submissions are graded in a
+    jail.'''
+    if self.jail is not None and self.sandboxes is None:
+      self.sandboxes = SandboxPool(self.jail, self, self.jobs, self.recycle,
+          self.jail_files)
+
+  def stop_sandboxes(self):
+    '''Stop the pool of sandboxes, if any.'''
+    if self.sandboxes is not None:
+      self.sandboxes.close()
+      self.sandboxes = None
+
+  def fork(self, test_root, **options):
+    self.attempts[test_root] += 1
+    self.started[test_root] = time.time()
+    self.record(test_root, 'running')
+    return self.launch(test_root, **options)
+
+  def wait(self, pid=-1, block=True):
+    finished = self.reap(pid, block)
+    if finished is None:
+      return None
+    test_root, exitcode = finished
+    elapsed = time.time() - self.started.pop(test_root)
+    self.durations[test_root] += elapsed
+    self.busy += elapsed
+    self.record(test_root, 'done' if exitcode == 0 else 'failed',
+        exitcode=exitcode, elapsed=elapsed)
+    return test_root, exitcode
+
+  def resume_jobs(self, test_roots, exitcodes):
+    '''Restore the state of the submissions in 'test_roots' from the journal,
+    recording the exit codes of those that need not be graded again in
+    'exitcodes', and return the others.'''
+    jobs = {}
+    if os.path.isfile(self.journal_path):
+      jobs = replay_journal(self.journal_path)
+    remaining = []
+    for test_root in test_roots:
+      job = jobs.get(test_root, {'state': 'queued', 'attempt': 0})
+      if job['state'] in ('done', 'failed'):
+        self.attempts[test_root] = job['attempt']
+        self.durations[test_root] = job.get('elapsed', 0.0)
+        if job['state'] == 'done' or job['attempt'] > self.retries:
+          self.resumed.add(test_root)
+          exitcodes[test_root] = job['exitcode']
+          continue
+      elif job['state'] == 'running':
+        # The attempt that was interrupted does not count
+        self.attempts[test_root] = job['attempt'] - 1
+        self.interrupted.add(test_root)
+      else:
+        self.attempts[test_root] = job['attempt']
+      remaining.append(test_root)
+    return remaining
+
+  def dispatch(self, test_root, exitcodes):
+    '''Start grading the submission in 'test_root', unless its results are
+    cached, in which case its exit code is recorded in 'exitcodes' and True is
+    returned.'''
+    if self.attempts[test_root] == 0 and test_root not in self.interrupted:
+      if self.restore(test_root):
+        self.cached.add(test_root)
+        exitcodes[test_root] = 0
+        self.record(test_root, 'done', exitcode=0, elapsed=0.0, cached=True)
+        return True
+      self.fork(test_root)
+    else:
+      # Retries only run the tests that did not complete
+      self.fork(test_root, resume=True, overwrite_existing_results=True)
+    return False
+
+  def collect(self, exitcodes, pending, block=True):
+    '''Wait for a submission to be graded and record its exit code in
+    'exitcodes'. If its grading failed and may be retried, it is appended to
+    'pending' and None is returned, otherwise its submission directory and
+    exit code are returned. If 'block' is False, return None at once if no
+    submission was graded.'''
+    finished = self.wait(block=block)
+    if finished is None:
+      return None
+    test_root, exitcode = finished
+    exitcodes[test_root] = exitcode
+    if exitcode != 0 and self.attempts[test_root] <= self.retries:
+      pending.append(test_root)
+      self.record(test_root, 'queued')
+      return None
+    return test_root, exitcode
+
+  def grade(self, test_roots, resume=False):
+    '''Grade each submission directory in 'test_roots'. Return a dictionary
+    mapping each submission directory to the exit code of its last attempt.
+
+    If 'resume' is True, the batch continues from the state recorded in the
+    journal: the submissions that were graded successfully are not graded
+    again, those that failed are retried unless they were already retried
+    'retries' times, and those that were being graded are resumed from the
+    tests that had not completed.'''
+    start_time = time.time()
+    exitcodes = {}
+    test_roots = list(test_roots)
+    if self.journal_path is not None:
+      if resume:
+        test_roots = self.resume_jobs(test_roots, exitcodes)
+      self.journal = runner.EventStream(self.journal_path,
+          'a' if resume else 'w')
+    pending = collections.deque(longest_first(test_roots,
+        self.options.get('result_file_path', 'results.json')))
+    for test_root in pending:
+      self.record(test_root, 'queued')
+    try:
+      self.start_sandboxes()
+      while len(pending) > 0 or len(self.children) > 0:
+        while len(pending) > 0 and len(self.children) < self.jobs:
+          self.dispatch(pending.popleft(), exitcodes)
+        if len(self.children) > 0:
+          self.collect(exitcodes, pending)
+    finally:
+      self.stop_sandboxes()
+      if self.journal is not None:
+        self.journal.close()
+    self.elapsed = time.time() - start_time
+    return exitcodes
+
+  def summary(self, exitcodes, slowest=5):
+    '''Return a description of the outcome of the batch graded by grade, which
+    returned 'exitcodes', listing the 'slowest' submissions that took the
+    longest and the submissions that failed.'''
+    failed = sorted(r for r, e in exitcodes.items() if e != 0)
+    retried = [r for r, a in self.attempts.items() if a > 1]
+    # The submissions skipped when resuming are those that succeeded, and
+    # those that failed with no retries left
+    resumed_failures = [r for r in self.resumed if exitcodes.get(r) != 0]
+    lines = [('Graded {0} submissions in {1:.1f} s with {2} jobs: ' +
+        '{3} succeeded ({4} cached, {5} resumed), {6} failed ' +
+        '({7} resumed), {8} retried').format(len(exitcodes), self.elapsed,
+        self.jobs, len(exitcodes) - len(failed), len(self.cached),
+        len(self.resumed) - len(resumed_failures), len(failed),
+        len(resumed_failures), len(retried)),
+      'Total grading time: {0:.1f} s ({1:.1f}x speedup)'.format(self.busy,
+        self.busy / self.elapsed if self.elapsed > 0 else 0.0)]
+    if len(self.durations) > 0:
+      lines.append('Slowest submissions:')
+      for r in sorted(self.durations, key=lambda r: -self.durations[r])[
+          :slowest]:
+        lines.append('  {0:.1f} s  {1}'.format(self.durations[r], r))
+    if len(failed) > 0:
+      lines.append('Failed submissions:')
+      lines.extend('  {0} (exit code {1}, {2} attempts)'.format(r,
+          exitcodes[r], self.attempts[r]) for r in failed)
+    return '\n'.join(lines)
+
+
+def run_batch(batch_root, module, preload=(), jobs=None, retries=0, jail=None,
+    journal=None, resume=False, metrics_args=None, **options):
+  '''Grade the submissions in the subdirectories of 'batch_root' with the
+  tests in 'module' using a BatchScheduler, display its summary, and return
+  the dictionary of exit codes returned by BatchScheduler.grade. If
+  'metrics_args', the arguments added by metrics.add_metrics_arguments as
+  parsed, are specified, the live metrics of the batch are reported as they
+  configure. 'options' are the keyword arguments passed to BatchScheduler,
+  and to runner.process_one_submission.'''
+  scheduler = BatchScheduler(module, preload, jobs, retries, jail, journal,
+      **options)
+  reporter = None
+  if metrics_args is not None:
+    scheduler.metrics = metrics.BatchMetrics(scheduler.jobs)
+    reporter = metrics.reporter_from_args(scheduler.metrics, metrics_args)
+    reporter.start()
+  try:
+    exitcodes = scheduler.grade(forkserver.submission_dirs(batch_root),
+        resume)
+  finally:
+    if reporter is not None:
+      reporter.stop()
+  print(scheduler.summary(exitcodes))
+  return exitcodes
 
 
 if __name__ == '__main__':
@@ -67,20 +538,105 @@ if __name__ == '__main__':
 
   parser.add_argument('module', help='The module containing tests to be run.')
 
-  parser.add_argument('-t', '--timeout', help='The max number of seconds a ' +
-    'test is allowed to run.', default=600, type=float)
+  parser.add_argument('-j', '--jobs', help='The number of submissions to ' +
+    'grade at the same time. Defaults to the number of CPUs.', default=None,
+    type=int)
+
+  parser.add_argument('--retries', help='The number of times a submission ' +
+    'whose grading failed is graded again.', default=0, type=int)
+
+  parser.add_argument('--journal', help='The file in which the state of ' +
+    'each submission is recorded as the batch runs. Defaults to ' +
+    'batch.ndjson in the batch directory, unless the submission directories ' +
+    'are read from the standard input.', default=None)
+
+  parser.add_argument('-R', '--resume', help='Resume an interrupted batch ' +
+    'from its journal: skip the submissions that were graded, retry those ' +
+    'that failed, and resume those that were being graded.',
+    action='store_true', default=False)
+
+  parser.add_argument('-l', '--preload', help='The modules to import once ' +
+    'before grading any submission.', nargs='+', default=[])
+
+  parser.add_argument('-r', '--result-file-path', help='The path to the file, '+
+    'relative to each submission directory, to store the results as JSON ' +
+    'objects.', default='results.json')
+
+  parser.add_argument('-t', '--timeout', help='The max number of seconds ' +
+    'all the tests of a submission together are allowed to run.',
+    default=600, type=float)
+
+  parser.add_argument('-T', '--test-timeout', help='The max number of ' +
+    'seconds a test is allowed to run, unless it declares its own limit.',
+    default=None, type=float)
+
+  parser.add_argument('--timeout-profile', help='The profile of the time ' +
+    'limits of the tests written by calibrate.py.', default=None)
 
   parser.add_argument('-o', '--overwrite-existing-results', help='Indicates ' +
     'what action to take when a result file already exists',
     action='store_true', default=False)
 
+  parser.add_argument('-p', '--processes', help='Run the tests of each ' +
+    'submission in this many worker processes instead of threads.',
+    default=0, type=int)
+
+  parser.add_argument('-n', '--threads', help='The number of worker threads ' +
+    'that run the tests, when not running them in processes.', default=8,
+    type=int)
+
+  parser.add_argument('-C', '--result-cache', help='The directory of the ' +
+    'cache of results. A submission whose files, test module and time ' +
+    'limits are identical to those of a cached run is not graded again.',
+    default=None)
+
+  parser.add_argument('-f', '--fixture-cache', help='The directory in which ' +
+    'the fixtures built with fixtures.cached are shared between runs.',
+    default=None)
+
+  parser.add_argument('--jail', help='Grade the submissions in sandboxes ' +
+    'confined to this directory with chroot, which requires superuser ' +
+    'privileges. The tests may only import the preloaded modules and the ' +
+    'modules in the directory of the test module.', default=None)
+
+  parser.add_argument('--jail-files', help='The files and directories the ' +
+    'tests read, to copy into the jail.', nargs='+', default=[])
+
+  parser.add_argument('--recycle', help='The number of submissions a ' +
+    'sandbox grades before it is replaced by a fresh one.', default=100,
+    type=int)
+
+  runner.add_resource_limit_arguments(parser)
+  metrics.add_metrics_arguments(parser)
+
   if len(sys.argv) == 1:
     parser.print_help()
     exit(-2)
 
   args = parser.parse_args()
 
-  run_batch(args.module, args.batch_test_root, args.timeout,
-      args.overwrite_existing_results)
+  if args.fixture_cache is not None:
+    import fixtures
+    fixtures.CACHE_DIR = args.fixture_cache
+
+  # The test module is imported relative to the working directory, as
+  # runner.py does
+  sys.path.append(os.getcwd())
+
+  journal = args.journal
+  if journal is None and args.batch_test_root != '-':
+    journal = os.path.join(args.batch_test_root, 'batch.ndjson')
+
+  exitcodes = run_batch(args.batch_test_root, args.module, args.preload,
+      args.jobs, args.retries, args.jail, journal, args.resume, args,
+      jail_files=args.jail_files, recycle=args.recycle,
+      result_file_path=args.result_file_path, timeout=args.timeout,
+      overwrite_existing_results=args.overwrite_existing_results,
+      processes=args.processes, threads=args.threads,
+      test_timeout=args.test_timeout, cache_dir=args.result_cache,
+      resource_limits=runner.resource_limits_from_args(args),
+      timeout_profile=args.timeout_profile)
+  if any(e != 0 for e in exitcodes.values()):
+    exit(1)
 
 # vim: set ts=2 sw=2 expandtab:
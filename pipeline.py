@@ -0,0 +1,456 @@
+from __future__ import print_function
+import argparse
+import collections
+import os
+import shlex
+import sys
+import threading
+import time
+import traceback
+import analysis
+import extract
+import forkserver
+import metrics
+import parallel
+import runner
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+
+# The number of seconds the grading stage waits for a submission to be
+# extracted before it checks on the submissions being graded
+POLL_INTERVAL = 0.05
+
+# The command that grades a submission in a container, as runtests.sh did. The
+# fields are the absolute paths of the submission, of the directory of the
+# tests (the working directory) and of the autograder, and the image.
+CONTAINER_COMMAND = ('docker run --rm -v {submission}:/submission ' +
+    '-v {tests}:/tests:ro -v {autograder}:/autograder:ro {image} ' +
+    'sh /tests/docker.sh')
+
+BACKENDS = ('process', 'sandbox', 'container')
+
+# The number of graded submissions after which the grade file is written again,
+# since the whole file is rewritten each time
+WRITE_INTERVAL = 50
+
+
+class ContainerScheduler(parallel.BatchScheduler):
+  '''A BatchScheduler that grades every submission in its own container,
+  running 'command', see CONTAINER_COMMAND, with the 'image' of the container.
+  The tests, their options and the path of the result file are set by the
+  script the container runs, so the results are not cached.'''
+
+  def __init__(self, module, image, command=CONTAINER_COMMAND, jobs=None,
+      retries=0, **options):
+    parallel.BatchScheduler.__init__(self, module, jobs=jobs, retries=retries,
+        **options)
+    self.image = image
+    self.command = shlex.split(command)
+    self.cache = None
+
+  def launch(self, test_root, **options):
+    fields = dict(submission=os.path.abspath(test_root), tests=os.getcwd(),
+        autograder=os.path.dirname(os.path.abspath(runner.__file__)),
+        image=self.image)
+    # The command is not run through a subprocess.Popen, whose bookkeeping
+    # would race with ForkServer.wait to reap it
+    pid = os.spawnvp(os.P_NOWAIT, self.command[0],
+        [a.format(**fields) for a in self.command])
+    self.children[pid] = test_root
+    return pid
+
+  def reap(self, pid=-1, block=True):
+    return forkserver.ForkServer.wait(self, pid, block)
+
+
+class Aggregator(object):
+  '''Gathers the results of the submissions as they are graded. If
+  'csv_files' are specified, the grade of each group and a summary of its
+  results are recorded as soon as they are known, as analysis.py does, keeping
+  the max of the grades in 'csv_files', and written to the CMS grade file
+  'output' every 'write_interval' submissions and once all are added.'''
+
+  def __init__(self, result_file_path='results.json', csv_files=None,
+      output=None, column='Grade', weight=1, offset=0,
+      write_interval=WRITE_INTERVAL):
+    self.result_file_path = result_file_path
+    self.write_interval = write_interval
+    # The number of submissions whose grades are not written yet
+    self.unwritten = 0
+    self.stats = analysis.StatisticsSet([])
+    self.column = column
+    self.weight = weight
+    self.offset = offset
+    self.grades = None
+    self.sources = []
+    self.output = output
+    if csv_files:
+      self.grades = analysis.GradeFileProcessor(csv_files[0])
+      self.sources = [analysis.GradeFileProcessor(f) for f in csv_files]
+      if self.output is None:
+        self.output = csv_files[0]
+
+  def add(self, test_root, exitcode):
+    '''Add the results of the submission in 'test_root', graded with the
+    exit code 'exitcode', and update the grades.'''
+    path = os.path.join(test_root, self.result_file_path)
+    if not os.path.isfile(path):
+      runner.displayln('{0}: no results (exit code {1})'.format(test_root,
+          exitcode))
+      return
+    group = analysis.GroupStatistics.from_file(path)
+    self.stats.instances.append(group)
+    runner.displayln('[{0}] {1}: {2}/{3} tests successful'.format(
+        len(self.stats.instances), group.format_group(),
+        group.success_count(), group.test_count()))
+    if self.grades is None:
+      return
+    try:
+      self.grades.update_records(group.members,
+          {self.column: group.get_grade(self.weight, self.offset),
+          'Add Comments': str(group)}, self.sources)
+    except KeyError as err:
+      runner.displayln('{0} is not in the grade file'.format(err))
+      return
+    self.unwritten += 1
+    if self.unwritten >= self.write_interval:
+      self.write()
+
+  def write(self):
+    '''Write the grades that were updated since the last write to the grade
+    file.'''
+    if self.grades is not None and self.unwritten > 0:
+      self.grades.dump(self.output)
+      self.unwritten = 0
+
+
+class Pipeline(object):
+  '''Streams the submissions in a CMS submission zip file through three
+  stages, connected by queues of at most 'queue_size' submissions:
+
+    extract    'extract_jobs' threads extract the submissions of the
+               students one at a time, see extract.extract_student
+    grade      the 'scheduler', a parallel.BatchScheduler, grades the
+               extracted submissions as soon as they are available, running
+               'scheduler.jobs' of them at a time
+    aggregate  a thread adds the results of each graded submission to the
+               'aggregator', an Aggregator
+
+  Grading thus starts as soon as the first submission is extracted, while
+  extraction keeps ahead of it, but no further than the size of the queue.
+  The grading stage runs in the calling thread since it forks.'''
+
+  def __init__(self, scheduler, aggregator, extract_jobs=2, queue_size=16):
+    self.scheduler = scheduler
+    self.aggregator = aggregator
+    self.extract_jobs = extract_jobs
+    self.extracted = queue.Queue(queue_size)
+    self.graded = queue.Queue(queue_size)
+
+    # The students whose submission could not be extracted, along with the
+    # error, the exit code of every graded submission, and the error that
+    # stopped the aggregation, if any
+    self.extract_errors = {}
+    self.exitcodes = {}
+    self.aggregate_error = None
+
+  def extract_stage(self, students, submission, destination, **options):
+    '''Extract the submissions of the 'students', a queue of their names,
+    until it is empty, handing each to the grading stage. 'options' are the
+    keyword arguments of extract.extract_student.'''
+    try:
+      while True:
+        try:
+          student = students.get_nowait()
+        except queue.Empty:
+          break
+        try:
+          test_root = extract.extract_student(submission, student, destination,
+              **options)
+          # The submissions that are left empty are not graded
+          self.extracted.put((student, test_root if os.path.isdir(test_root)
+              else None, None))
+        except Exception:
+          self.extracted.put((student, None, traceback.format_exc()))
+    finally:
+      self.extracted.put(None)
+
+  def aggregate_stage(self):
+    '''Add the graded submissions to the aggregator as they arrive, until None
+    is received, and then write the grades. The first error stops the
+    aggregation and is kept in 'aggregate_error', while the graded
+    submissions are still received so that the grading does not block.'''
+    try:
+      for test_root, exitcode in iter(self.graded.get, None):
+        self.aggregator.add(test_root, exitcode)
+      self.aggregator.write()
+    except Exception:
+      self.aggregate_error = traceback.format_exc()
+      runner.displayln('Failed to aggregate the grades:\n{0}'.format(
+          self.aggregate_error))
+      for _ in iter(self.graded.get, None):
+        pass
+
+  def grade_stage(self):
+    '''Grade the extracted submissions until all are graded, handing each to
+    the aggregation stage.'''
+    scheduler = self.scheduler
+    retries = collections.deque()
+    extracting = self.extract_jobs
+    while extracting > 0 or len(retries) > 0 or len(scheduler.children) > 0:
+      while len(retries) > 0 and len(scheduler.children) < scheduler.jobs:
+        scheduler.dispatch(retries.popleft(), self.exitcodes)
+      while extracting > 0 and len(scheduler.children) < scheduler.jobs:
+        try:
+          item = self.extracted.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+          break
+        if item is None:
+          extracting -= 1
+          continue
+        student, test_root, error = item
+        if test_root is None and scheduler.metrics is not None:
+          scheduler.metrics.total -= 1
+        if error is not None:
+          runner.displayln('Failed to extract {0}:\n{1}'.format(student,
+              error))
+          self.extract_errors[student] = error
+        elif test_root is None:
+          continue
+        elif scheduler.dispatch(test_root, self.exitcodes):
+          self.graded.put((test_root, 0))
+      if len(scheduler.children) > 0:
+        # Only wait for a submission to be graded when there is nothing else
+        # to do
+        block = extracting == 0 or \
+            len(scheduler.children) >= scheduler.jobs
+        finished = scheduler.collect(self.exitcodes, retries, block)
+        if finished is not None:
+          self.graded.put(finished)
+
+  def run(self, submission, destination, **options):
+    '''Extract, grade and aggregate the submissions in the CMS 'submission'
+    zip file, extracting them to 'destination'. 'options' are the keyword
+    arguments of extract.extract_student. Return the dictionary mapping each
+    graded submission to its exit code.'''
+    start_time = time.time()
+    if not os.path.exists(destination):
+      os.makedirs(destination)
+    students = queue.Queue()
+    for student in extract.student_dirs(submission):
+      students.put(student)
+    if self.scheduler.metrics is not None:
+      self.scheduler.metrics.total = students.qsize()
+
+    extractors = [threading.Thread(target=self.extract_stage,
+        args=(students, submission, destination), kwargs=options)
+        for _ in range(self.extract_jobs)]
+    aggregator = threading.Thread(target=self.aggregate_stage)
+    for t in extractors + [aggregator]:
+      # The stages stop with the grading if it is interrupted
+      t.daemon = True
+      t.start()
+    try:
+      self.scheduler.start_sandboxes()
+      self.grade_stage()
+    finally:
+      self.scheduler.stop_sandboxes()
+    self.graded.put(None)
+    aggregator.join()
+    self.scheduler.elapsed = time.time() - start_time
+    return self.exitcodes
+
+
+def make_scheduler(backend, module, jobs=None, retries=0, preload=(),
+    jail=None, jail_files=(), recycle=100, image=None,
+    container_command=CONTAINER_COMMAND, **options):
+  '''Return the parallel.BatchScheduler of the grading 'backend', one of
+  BACKENDS: 'process' forks a child that grades each submission, 'sandbox'
+  grades the submissions in a pool of sandboxes confined to 'jail', and
+  'container' grades each submission in a container of 'image'. 'options'
+  are the keyword arguments passed to runner.process_one_submission.'''
+  if backend == 'container':
+    if image is None:
+      raise Exception('The container backend requires an image')
+    return ContainerScheduler(module, image, container_command, jobs, retries,
+        **options)
+  if backend == 'sandbox' and jail is None:
+    raise Exception('The sandbox backend requires a jail')
+  return parallel.BatchScheduler(module, preload, jobs, retries,
+      jail if backend == 'sandbox' else None, jail_files=jail_files,
+      recycle=recycle, **options)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Extract the submissions ' +
+    'downloaded from CMS, grade them and fill in the CMS grade file, with ' +
+    'the three stages running at the same time: each submission is graded ' +
+    'as soon as it is extracted, and its grade is recorded as soon as it is ' +
+    'graded.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  parser.add_argument('submission', help='The zip file from CMS that ' +
+    'contains all the students\' submitted files.')
+
+  parser.add_argument('destination', help='The directory to which the ' +
+    'submissions are extracted, and in which they are graded.')
+
+  parser.add_argument('module', help='The module containing tests to be ' +
+    'run, unless the tests are set by the script of the container.')
+
+  parser.add_argument('-c', '--csv-result-file', help='One or more template ' +
+    'files downloaded from CMS for adding grades. The max of the grades ' +
+    'will be written to the first of them, or to --csv-result-output-file.',
+    nargs='+', default=None)
+
+  parser.add_argument('--csv-result-output-file', help='The CSV file to ' +
+    'write the grades to.', default=None)
+
+  parser.add_argument('-k', '--column-name', help='The name of the column ' +
+    'in the CSV file that contains students\' grades.', default='Grade')
+
+  parser.add_argument('-w', '--weight-per-test', help='The weight assigned ' +
+    'to each test to compute the grade.', default=1, type=float)
+
+  parser.add_argument('-q', '--offset-points', help='Points added to a total ' +
+    'grade.', default=0, type=float)
+
+  parser.add_argument('-e', '--clean-empty-directories', help='Remove the ' +
+    'empty directories from the extracted submissions.', action='store_true',
+    default=False)
+
+  parser.add_argument('--list-of-files-to-collect', help='The list of ' +
+    'files to collect from the submissions.', nargs='+', default=['*'])
+
+  parser.add_argument('-x', '--extract-jobs', help='The number of ' +
+    'submissions to extract at the same time.', default=2, type=int)
+
+  parser.add_argument('-j', '--jobs', help='The number of submissions to ' +
+    'grade at the same time. Defaults to the number of CPUs.', default=None,
+    type=int)
+
+  parser.add_argument('--queue-size', help='The max number of submissions ' +
+    'extracted ahead of the grading, and graded ahead of the aggregation.',
+    default=16, type=int)
+
+  parser.add_argument('-b', '--backend', help='Where the submissions are ' +
+    'graded: in a child process each, in a pool of sandboxes confined to ' +
+    '--jail, or in a container of --image each.', choices=BACKENDS,
+    default='process')
+
+  parser.add_argument('--retries', help='The number of times a submission ' +
+    'whose grading failed is graded again.', default=0, type=int)
+
+  parser.add_argument('-l', '--preload', help='The modules to import once ' +
+    'before grading any submission.', nargs='+', default=[])
+
+  parser.add_argument('--jail', help='The directory the sandboxes are ' +
+    'confined to, see parallel.py.', default=None)
+
+  parser.add_argument('--jail-files', help='The files and directories the ' +
+    'tests read, to copy into the jail.', nargs='+', default=[])
+
+  parser.add_argument('--recycle', help='The number of submissions a ' +
+    'sandbox grades before it is replaced by a fresh one.', default=100,
+    type=int)
+
+  parser.add_argument('--image', help='The image of the containers.',
+    default=None)
+
+  parser.add_argument('--container-command', help='The command that grades ' +
+    'a submission in a container.', default=CONTAINER_COMMAND)
+
+  parser.add_argument('-r', '--result-file-path', help='The path to the file, '+
+    'relative to each submission directory, to store the results as JSON ' +
+    'objects.', default='results.json')
+
+  parser.add_argument('-t', '--timeout', help='The max number of seconds ' +
+    'all the tests of a submission together are allowed to run.',
+    default=600, type=float)
+
+  parser.add_argument('-T', '--test-timeout', help='The max number of ' +
+    'seconds a test is allowed to run, unless it declares its own limit.',
+    default=None, type=float)
+
+  parser.add_argument('--timeout-profile', help='The profile of the time ' +
+    'limits of the tests written by calibrate.py.', default=None)
+
+  parser.add_argument('-o', '--overwrite-existing-results', help='Overwrite ' +
+    'the submissions that were already extracted, and their results.',
+    action='store_true', default=False)
+
+  parser.add_argument('-p', '--processes', help='Run the tests of each ' +
+    'submission in this many worker processes instead of threads.',
+    default=0, type=int)
+
+  parser.add_argument('-n', '--threads', help='The number of worker threads ' +
+    'that run the tests, when not running them in processes.', default=8,
+    type=int)
+
+  parser.add_argument('-C', '--result-cache', help='The directory of the ' +
+    'cache of results. A submission whose files, test module and time ' +
+    'limits are identical to those of a cached run is not graded again.',
+    default=None)
+
+  parser.add_argument('-f', '--fixture-cache', help='The directory in which ' +
+    'the fixtures built with fixtures.cached are shared between runs.',
+    default=None)
+
+  runner.add_resource_limit_arguments(parser)
+  metrics.add_metrics_arguments(parser)
+
+  if len(sys.argv) == 1:
+    parser.print_help()
+    exit(-2)
+
+  args = parser.parse_args()
+
+  if args.fixture_cache is not None:
+    import fixtures
+    fixtures.CACHE_DIR = args.fixture_cache
+
+  # The test module is imported relative to the working directory, as
+  # runner.py does
+  sys.path.append(os.getcwd())
+
+  scheduler = make_scheduler(args.backend, args.module, args.jobs,
+      args.retries, args.preload, args.jail, args.jail_files, args.recycle,
+      args.image, args.container_command,
+      result_file_path=args.result_file_path, timeout=args.timeout,
+      overwrite_existing_results=args.overwrite_existing_results,
+      processes=args.processes, threads=args.threads,
+      test_timeout=args.test_timeout, cache_dir=args.result_cache,
+      resource_limits=runner.resource_limits_from_args(args),
+      timeout_profile=args.timeout_profile)
+  aggregator = Aggregator(args.result_file_path, args.csv_result_file,
+      args.csv_result_output_file, args.column_name, args.weight_per_test,
+      args.offset_points)
+  pipeline = Pipeline(scheduler, aggregator, args.extract_jobs,
+      args.queue_size)
+  scheduler.metrics = metrics.BatchMetrics(scheduler.jobs)
+  reporter = metrics.reporter_from_args(scheduler.metrics, args)
+  reporter.start()
+  try:
+    exitcodes = pipeline.run(args.submission, args.destination,
+        clean_empty=args.clean_empty_directories,
+        overwrite=args.overwrite_existing_results,
+        file_pattern=args.list_of_files_to_collect)
+  finally:
+    reporter.stop()
+  print(scheduler.summary(exitcodes))
+  if len(pipeline.extract_errors) > 0:
+    print('Failed to extract {0} submissions:'.format(
+        len(pipeline.extract_errors)))
+    for student in sorted(pipeline.extract_errors):
+      print('  ' + student)
+  if pipeline.aggregate_error is not None:
+    print('Failed to aggregate the grades, the grade file is incomplete')
+  if len(pipeline.extract_errors) > 0 or \
+      pipeline.aggregate_error is not None or \
+      any(e != 0 for e in exitcodes.values()):
+    exit(1)
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,138 @@
+from __future__ import print_function
+import argparse
+import collections
+import os
+import pstats
+import sys
+import cache
+import runner
+
+
+# The directories of the standard library and of the installed packages
+LIBRARY_DIRS = tuple(set(os.path.abspath(p) + os.sep for p in
+    (sys.prefix, sys.exec_prefix, os.path.dirname(os.__file__))))
+
+# The places the profiled functions come from, see location
+LOCATIONS = ('submission', 'tests', 'library', 'builtin')
+
+
+def location(func):
+  '''Return where the function 'func', a (filename, line, name) key of the
+  pstats statistics, comes from: 'submission' for the student's code,
+  'builtin' for the functions implemented in C, 'library' for the standard
+  library and the installed packages, and 'tests' for the rest, i.e. the test
+  modules, their helpers and the runner.'''
+  filename = func[0]
+  if filename.startswith(cache.ROOT_PLACEHOLDER):
+    return 'submission'
+  if filename == '~':
+    return 'builtin'
+  if os.path.abspath(filename).startswith(LIBRARY_DIRS):
+    return 'library'
+  return 'tests'
+
+
+def find_profiles(batch_root, result_file_path='results.json'):
+  '''Return the number of submissions in the subdirectories of 'batch_root'
+  that have profiles, along with a dictionary mapping the name of each
+  profiled test and class fixture to the paths of its profiles.'''
+  paths = collections.defaultdict(list)
+  count = 0
+  for d in sorted(os.listdir(batch_root)):
+    directory = runner.profile_dir_for(os.path.join(batch_root, d,
+        result_file_path))
+    if not os.path.isdir(directory):
+      continue
+    count += 1
+    for f in sorted(os.listdir(directory)):
+      if f.endswith('.prof'):
+        paths[f[:-len('.prof')]].append(os.path.join(directory, f))
+  return count, paths
+
+
+def top_functions(stats, count):
+  '''Return the 'count' functions of the pstats.Stats 'stats' with the highest
+  cumulative time, as (cumulative time, total time, calls, function) tuples.'''
+  rows = [(ct, tt, nc, pstats.func_std_string(func))
+      for func, (cc, nc, tt, ct, callers) in stats.stats.items()]
+  rows.sort(reverse=True)
+  return rows[:count]
+
+
+def time_by_location(stats):
+  '''Return a dictionary mapping each of LOCATIONS to the time spent in the
+  functions that come from it, according to the pstats.Stats 'stats'.'''
+  times = dict.fromkeys(LOCATIONS, 0.0)
+  for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+    times[location(func)] += tt
+  return times
+
+
+def format_profile(title, stats, functions):
+  '''Format the pstats.Stats 'stats' as the time it covers, split by location,
+  followed by its 'functions' functions with the highest cumulative time.'''
+  times = time_by_location(stats)
+  lines = ['{0}: {1:.3f} s ({2})'.format(title, stats.total_tt,
+      ', '.join('{0} {1:.3f} s'.format(k, times[k]) for k in LOCATIONS)),
+    '  {0:>10} {1:>10} {2:>10}  {3}'.format('Cumul. (s)', 'Total (s)', 'Calls',
+      'Function')]
+  for ct, tt, nc, func in top_functions(stats, functions):
+    lines.append('  {0:>10.3f} {1:>10.3f} {2:>10}  {3}'.format(ct, tt, nc,
+        func))
+  return '\n'.join(lines)
+
+
+def format_report(count, paths, functions=20, tests=None):
+  '''Format a report of the profiles of a batch of 'count' submissions, where
+  'paths' is as returned by find_profiles: the profile of all the tests and
+  class fixtures together, followed by that of every test and class fixture,
+  or of the 'tests' slowest ones, each merged across the submissions.'''
+  if len(paths) == 0:
+    return 'No profiles found'
+  merged = {name: pstats.Stats(*p) for name, p in paths.items()}
+  names = sorted(merged, key=lambda n: -merged[n].total_tt)[:tests]
+  sections = ['Profiles of {0} submissions'.format(count),
+      format_profile('All tests and class fixtures',
+      pstats.Stats(*[p for ps in paths.values() for p in ps]), functions)]
+  sections.extend(format_profile(n, merged[n], functions) for n in names)
+  return '\n\n'.join(sections)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Merge the profiles written ' +
+      'by runner.py --profile for a batch of submissions into a report of ' +
+      'the functions that take the most time, overall and in each test.',
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+  parser.add_argument('batch_root', help='The directory containing one ' +
+      'subdirectory per submission.')
+
+  parser.add_argument('-r', '--result-file-path', help='The path to the ' +
+      'result file, relative to each submission directory, next to which the ' +
+      'profiles were written.', default='results.json')
+
+  parser.add_argument('-n', '--functions', help='The number of functions ' +
+      'to list for each test.', default=20, type=int)
+
+  parser.add_argument('-t', '--tests', help='Only list the profiles of this ' +
+      'many tests and class fixtures, the slowest first.', default=None,
+      type=int)
+
+  parser.add_argument('-o', '--output', help='The file to write the report ' +
+      'to, instead of the standard output.', default=None)
+
+  if len(sys.argv) == 1:
+    parser.print_help()
+    exit(-2)
+
+  args = parser.parse_args()
+
+  count, paths = find_profiles(args.batch_root, args.result_file_path)
+  report = format_report(count, paths, args.functions, args.tests)
+  if args.output is None:
+    print(report)
+  else:
+    with open(args.output, 'w') as output:
+      output.write(report + '\n')
+
+# vim: set ts=2 sw=2 expandtab:
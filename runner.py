@@ -1,16 +1,37 @@
 import time
 import argparse
+import cProfile
+import collections
+import errno
+import importlib
+import linecache
+import marshal
+import math
 import os
+import platform
+import socket
+import tempfile
 import threading
+import multiprocessing
+import multiprocessing.connection
+import select
+import signal
 import unittest
 import traceback
 import random
+import resource
 import sys
 import json
 
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
 
 # Set the random seed so that the tests are consistent across all runs
-random.seed(20150219)
+RANDOM_SEED = 20150219
+random.seed(RANDOM_SEED)
 
 # Preserve the original output stream
 console = sys.stdout
@@ -18,18 +39,205 @@ console = sys.stdout
 # Protects the output stream
 console_lock = threading.Lock()
 
-
-def redirect_console(where=None):
+# The number of iterations of the loop timed by host_speed, the number of
+# times it is timed, and its result
+SPEED_BENCHMARK_ITERATIONS = 500000
+SPEED_BENCHMARK_RUNS = 10
+_host_speed = None
+
+# The file the speeds of the hosts are cached in, shared by every process on
+# the host, and the number of seconds after which a speed is measured again
+HOST_SPEED_FILE = os.path.join(tempfile.gettempdir(),
+    'cuautograde-host-speed.json')
+HOST_SPEED_MAX_AGE = 24 * 60 * 60
+
+# The resource.getrusage target for the calling thread, which older versions
+# of the resource module do not name
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+# Maps the names of the resource limits that can be placed on a test to the
+# corresponding limit of the resource module: the size of the address space
+# and of the files written, in bytes, the CPU time, in seconds, and the number
+# of open files
+RLIMITS = collections.OrderedDict([
+  ('memory', resource.RLIMIT_AS),
+  ('cpu', resource.RLIMIT_CPU),
+  ('fileSize', resource.RLIMIT_FSIZE),
+  ('openFiles', resource.RLIMIT_NOFILE)
+])
+
+
+class SubmissionImports(object):
+  '''A context manager that scopes the imports of a submission, so that many
+  submissions can be graded one after the other in the same process. On entry
+  it adds the directories in 'paths' to the end of the import path, and on
+  exit it restores the import path and unloads the modules that were imported
+  from those directories in between, i.e. the test module, its helpers and
+  the student's modules. Everything else that was imported, such as the
+  installed packages the tests depend on, remains loaded.'''
+
+  def __init__(self, paths):
+    self.paths = list(paths)
+
+  def __enter__(self):
+    self.path = list(sys.path)
+    self.modules = set(sys.modules)
+    sys.path.extend(self.paths)
+    if hasattr(importlib, 'invalidate_caches'):
+      importlib.invalidate_caches()
+    return self
+
+  def scoped(self, module):
+    '''Return True if 'module' was loaded from one of the directories of
+    the scope, or is a placeholder left in sys.modules by Python 2 relative
+    imports.'''
+    if module is None:
+      return True
+    path = getattr(module, '__file__', None)
+    if path is None:
+      return False
+    path = os.path.abspath(path)
+    return any(path.startswith(os.path.join(os.path.abspath(p), ''))
+        for p in self.paths)
+
+  def __exit__(self, *exc_info):
+    sys.path[:] = self.path
+    for name in set(sys.modules) - self.modules:
+      if self.scoped(sys.modules[name]):
+        del sys.modules[name]
+    for p in self.paths:
+      sys.path_importer_cache.pop(p, None)
+    # The next submission may have different files at the same paths
+    linecache.clearcache()
+    return False
+
+
+def redirect_console(where=None, output_limit=None):
   '''Send all prints and error prints to the specified stream or to
-  the platform's equivalent of the Unix /dev/null.'''
+  the platform's equivalent of the Unix /dev/null. If 'output_limit' is
+  specified, what the tests print is instead captured separately for each
+  test, see ConsoleRouter.'''
   if where is None:
     f = open(os.devnull, 'w')
   else:
     f = open(where, 'w')
+  if output_limit is not None:
+    f = ConsoleRouter(f, output_limit)
   sys.stdout = f
   sys.stderr = f
 
 
+class OutputCapture(object):
+  '''A bounded buffer of what a test prints. It keeps the first and the last
+  'limit' / 2 characters written to it, and only counts those written in
+  between, so that a test that prints without end costs neither memory nor
+  disk space.'''
+
+  def __init__(self, limit):
+    self.head_limit = limit // 2
+    self.tail_limit = limit - self.head_limit
+    self.head = []
+    self.head_size = 0
+    # The tail is a ring of the chunks written last
+    self.tail = collections.deque()
+    self.tail_size = 0
+    self.dropped = 0
+    self.lock = threading.Lock()
+
+  def write(self, text):
+    if isinstance(text, bytes):
+      text = text.decode('utf-8', 'replace')
+    with self.lock:
+      if self.head_size < self.head_limit:
+        chunk = text[:self.head_limit - self.head_size]
+        self.head.append(chunk)
+        self.head_size += len(chunk)
+        text = text[len(chunk):]
+      if len(text) == 0:
+        return
+      if len(text) >= self.tail_limit:
+        self.dropped += self.tail_size + len(text) - self.tail_limit
+        self.tail = collections.deque([text[len(text) - self.tail_limit:]])
+        self.tail_size = self.tail_limit
+        return
+      self.tail.append(text)
+      self.tail_size += len(text)
+      while self.tail_size > self.tail_limit:
+        excess = self.tail_size - self.tail_limit
+        if len(self.tail[0]) <= excess:
+          excess = len(self.tail.popleft())
+        else:
+          self.tail[0] = self.tail[0][excess:]
+        self.tail_size -= excess
+        self.dropped += excess
+
+  def flush(self):
+    pass
+
+  def getvalue(self):
+    '''Return a dictionary holding the 'text' that was kept, with a marker
+    in place of the 'dropped' characters, if any, or None if nothing was
+    written.'''
+    with self.lock:
+      if self.head_size == 0:
+        return None
+      text = ''.join(self.head)
+      if self.dropped > 0:
+        text += '\n[... {0} characters dropped ...]\n'.format(self.dropped)
+      return {'text': text + ''.join(self.tail), 'dropped': self.dropped}
+
+
+class ConsoleRouter(object):
+  '''A replacement for sys.stdout and sys.stderr that sends what is printed
+  to the OutputCapture of the test that printed it, so that the output of
+  tests running at the same time does not interleave. The test is identified
+  by the thread that writes, or is the only one running in the process when a
+  capture covers the whole process, as in a worker process. What is printed
+  outside of any test, e.g. by the class fixtures, goes to 'fallback'.'''
+
+  def __init__(self, fallback, limit):
+    self.fallback = fallback
+    self.limit = limit
+
+    # Maps the identifiers of the threads running tests to their captures
+    self.captures = {}
+    self.process_capture = None
+
+  def start_capture(self, whole_process=False):
+    '''Return a new OutputCapture for what the calling thread, or the whole
+    process, prints until stop_capture is called.'''
+    capture = OutputCapture(self.limit)
+    if whole_process:
+      self.process_capture = capture
+    else:
+      self.captures[threading.current_thread().ident] = capture
+    return capture
+
+  def stop_capture(self, whole_process=False):
+    if whole_process:
+      self.process_capture = None
+    else:
+      self.captures.pop(threading.current_thread().ident, None)
+
+  def write(self, text):
+    capture = self.captures.get(threading.current_thread().ident,
+        self.process_capture)
+    (self.fallback if capture is None else capture).write(text)
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    self.fallback.flush()
+
+  def isatty(self):
+    return False
+
+  def __getattr__(self, name):
+    return getattr(self.fallback, name)
+
+
 def displayln(s):
   '''Write the specified string to the original console output stream.'''
   with console_lock:
@@ -41,6 +249,12 @@ def iter_not_string(i):
   return hasattr(i, '__iter__')
 
 
+def class_id(cls):
+  '''Return the identifier of a TestCase class, in the same format as the
+  identifiers of its tests.'''
+  return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+
 def doc_for(test):
   '''Return the docstring for a given test identifier.'''
   mod_name, class_name, func_name = test.id().split('.')
@@ -57,152 +271,896 @@ def list_of_tests_gen(s):
         yield t
 
 
-class InterruptibleThreadGroup(threading.Thread):
-  '''This class allows a user to run a list of tasks in different threads,
-  and respond to requests for stoping, such as due to timeouts.
+def time_limit(seconds):
+  '''A decorator for the test methods of a unittest.TestCase that sets the
+  number of seconds the test is allowed to run. A whole TestCase can be given
+  a limit with a class attribute of the same name, 'time_limit'.'''
+  def decorator(func):
+    func.time_limit = seconds
+    return func
+  return decorator
+
+
+def time_limit_for(test, default=None):
+  '''Return the number of seconds 'test' is allowed to run, as declared on its
+  test method or on its class, or 'default' if neither declares a limit.'''
+  func = getattr(test, test._testMethodName, None)
+  limit = getattr(func, 'time_limit', None)
+  if limit is None:
+    limit = getattr(test, 'time_limit', None)
+  return default if limit is None else limit
+
+
+def host_speed():
+  '''Return the number of seconds a fixed CPU-bound loop takes on this host
+  with this interpreter, the best of SPEED_BENCHMARK_RUNS runs. It is measured
+  at most once every HOST_SPEED_MAX_AGE seconds and cached in HOST_SPEED_FILE
+  for the other processes on the host, and inherited by the processes this one
+  forks. The time limits calibrated on a host are scaled by the ratio of the
+  speeds of the hosts, see load_timeout_profile.'''
+  global _host_speed
+  if _host_speed is None:
+    key = '{0} {1} {2}'.format(socket.gethostname(),
+        platform.python_implementation(), platform.python_version())
+    speeds = read_host_speeds()
+    cached = speeds.get(key)
+    if (isinstance(cached, dict) and
+        0 <= time.time() - cached.get('time', 0) < HOST_SPEED_MAX_AGE):
+      _host_speed = cached['seconds']
+    else:
+      _host_speed = measure_host_speed()
+      speeds[key] = {'seconds': _host_speed, 'time': time.time()}
+      write_host_speeds(speeds)
+  return _host_speed
+
+
+def measure_host_speed():
+  '''Return the best of SPEED_BENCHMARK_RUNS timings of the loop of
+  host_speed.'''
+  times = []
+  for _ in range(SPEED_BENCHMARK_RUNS):
+    start_time = time.time()
+    i = total = 0
+    while i < SPEED_BENCHMARK_ITERATIONS:
+      total += i * i % 7
+      i += 1
+    times.append(time.time() - start_time)
+  return min(times)
+
+
+def read_host_speeds():
+  '''Return the speeds cached in HOST_SPEED_FILE, or an empty dictionary if
+  there are none or they cannot be read.'''
+  try:
+    with open(HOST_SPEED_FILE) as f:
+      speeds = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  return speeds if isinstance(speeds, dict) else {}
 
-  Note that this class intentionally uses the Python threading module
-  instead of the multiprocessing module. The typical use-case of this
-  class is to provide a way to execute tasks in a relatively
-  starvation-proof manner, that is, to allow all rest of the tasks to
-  make progress even if a few of the tasks are not making progress. It
-  specifically does not provide any guarentees as to whether the tasks will
-  actually be executed in parallel (which, in case if CPython, is well-known to
-  not be true).'''
 
-  def __init__(self, tasks, args, finalizers=None):
-    ''''tasks' is a list of single parameter functions corresponding to a
-    single interruptible task to be performed by this thread group.
-    'args' is a list (same size as 'tasks') of arguments corresponding to
-    those expected by the respective task. 'finalizers' are single parameter
-    functions called after the task, and receives the same parameter as the
-    corresponding task.'''
-
-    # The thread group is itself managed by a thread
-    threading.Thread.__init__(self, name='Controller',
-        target=self.start_and_wait)
-
-    self.threads = []
-
-    # When the count goes to zero, the thread group is shutdown
-    self.tasks_running_count = len(tasks)
-
-    # This lock protects the state of the thread group
-    self.running_status_lock = threading.Lock()
-
-    # This signals a change of the state of the thread group from running to
-    # shutdown
-    self.running_status_changed = threading.Condition(self.running_status_lock)
-
-    # The running/not running state of the thread group
-    self.is_running = False
-
-    if finalizers is None:
-      finalizers = [None] * len(tasks)
-
-    assert len(tasks) == len(args), 'Length of \'tasks\' must be the same ' +\
-      'as length of \'args\''
-
-    assert len(tasks) == len(finalizers), 'Length of \'tasks\' must be the ' +\
-      'same as length of \'finalizers\''
-
-    for task, arg, finalizer in zip (tasks, args, finalizers):
-      # Define what each thread in the thread group is supposed to do
-      def unit_work(param):
-        task(param) # First perform the task
-        if finalizer is not None: # Then if finalizer is not None, execute it
-          finalizer(param)
-        with self.running_status_lock: # Finally update the active thread count
-          self.tasks_running_count -= 1
-          if self.tasks_running_count == 0: # If the count goes to zero, signal
-            self.is_running = False
-            self.running_status_changed.notify_all()
-
-      thread = threading.Thread(target=unit_work, args=(arg,))
-      # The individual tasks are daemon, so they terminate as soon the the
-      # group controller terminates
-      thread.daemon = True
-      self.threads.append(thread)
-
-  def start_and_wait(self):
-    '''Start the daemon threads and wait for a signal to stop.'''
-    for t in self.threads:
-      t.start()
-    with self.running_status_lock:
-      self.is_running = True
-      while self.is_running:
-        self.running_status_changed.wait()
-
-  def stop_all_tasks(self):
-    '''Signals the controlling thread to stop. Provided that the controlling
-    thread is the only non-daemon thread, stopping it should force all the
-    daemon task threads to die as well.'''
-    with self.running_status_lock:
-      self.is_running = False
-      self.running_status_changed.notify_all()
-
-  def set_timeout(self, timeout_in_seconds):
-    '''Set a timeout monitor that waits for the specified number of seconds
-    before signalling the thread group controller to terminate.'''
-    # Define the task of the timeout monitor
-    def task():
-      start_time = time.time()
-      while time.time() - start_time < timeout_in_seconds:
-        time.sleep(timeout_in_seconds - (time.time() - start_time))
-      self.stop_all_tasks()
-    thread = threading.Thread(target=task)
-    thread.daemon = True # Daemon so that it dies when the tasks threads die
-    thread.start()
+def write_host_speeds(speeds):
+  '''Replace the speeds cached in HOST_SPEED_FILE by 'speeds', atomically so
+  that the processes reading it concurrently never see a partial file. The
+  cache is only an optimization, so failing to write it is ignored.'''
+  try:
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(HOST_SPEED_FILE),
+        prefix='.host-speed-')
+  except (IOError, OSError):
+    return
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(speeds, f)
+    os.rename(temporary, HOST_SPEED_FILE)
+  except (IOError, OSError):
+    os.remove(temporary)
+
+
+def load_timeout_profile(path):
+  '''Return the time limits of the tests calibrated in the timeout profile at
+  'path', written by calibrate.py, as a dictionary mapping the identifiers of
+  the tests to their limits: the given percentile of the runtime of each test
+  times the given factor, but no less than the given floor, scaled by how much
+  slower this host is than the one the profile was calibrated on.'''
+  with open(path) as profile_file:
+    profile = json.load(profile_file)
+  scale = host_speed() / profile['hostSpeed']
+  return {test_id: scale * max(profile['floor'],
+      profile['factor'] * test['percentile'])
+      for test_id, test in profile['tests'].items()}
+
+
+def depends_on(*names):
+  '''A decorator for the test methods of a unittest.TestCase that declares the
+  tests that must pass for the test to be worth running, named by their method
+  names for the tests of the same class, or by their identifiers otherwise,
+  e.g. @depends_on('test_constructor'). A test is skipped if one of its
+  prerequisites did not pass. A whole TestCase can be given prerequisites with
+  a class attribute of the same name, 'depends_on', holding a list of names.'''
+  def decorator(func):
+    func.depends_on = names
+    return func
+  return decorator
+
+
+def dependencies_for(test):
+  '''Return the identifiers of the tests that 'test' depends on, as declared
+  on its class and on its test method.'''
+  func = getattr(test, test._testMethodName, None)
+  names = list(getattr(test, 'depends_on', None) or []) + \
+      list(getattr(func, 'depends_on', None) or [])
+  ids = [n if '.' in n else '{0}.{1}'.format(class_id(type(test)), n)
+      for n in names]
+  # A class attribute also names the tests of the class it applies to
+  return [i for i in ids if i != test.id()]
+
+
+def order_by_dependencies(tests, dependencies):
+  '''Return 'tests' reordered so that each test comes after the tests it
+  depends on, and otherwise in the same order. 'dependencies' maps the
+  identifier of each test to the identifiers of its prerequisites. Raises an
+  exception if tests depend on each other in a cycle.'''
+  by_id = collections.OrderedDict((t.id(), t) for t in tests)
+  ordered = []
+  visited = {}
+  def visit(test_id, path):
+    if visited.get(test_id) == 'done':
+      return
+    if visited.get(test_id) == 'visiting':
+      raise Exception('Circular dependency between tests: {0}'.format(
+          ' -> '.join(path + [test_id])))
+    visited[test_id] = 'visiting'
+    for prerequisite in dependencies.get(test_id, []):
+      if prerequisite in by_id:
+        visit(prerequisite, path + [test_id])
+    visited[test_id] = 'done'
+    ordered.append(by_id[test_id])
+  for test_id in by_id:
+    visit(test_id, [])
+  return ordered
+
+
+def resource_limits(**limits):
+  '''A decorator for the test methods of a unittest.TestCase that sets the
+  resource limits of the test, named as in RLIMITS, e.g.
+  @resource_limits(memory=2 ** 30, cpu=10). A whole TestCase can be given
+  limits with a class attribute of the same name, 'resource_limits', holding a
+  dictionary. Resource limits only apply when the tests run in processes.'''
+  def decorator(func):
+    func.resource_limits = limits
+    return func
+  return decorator
+
+
+def resource_limits_for(test, default=None):
+  '''Return the dictionary of the resource limits of 'test': those in
+  'default', overridden by those declared on its class, overridden by those
+  declared on its test method.'''
+  limits = dict(default or {})
+  limits.update(getattr(test, 'resource_limits', None) or {})
+  func = getattr(test, test._testMethodName, None)
+  limits.update(getattr(func, 'resource_limits', None) or {})
+  return {k: v for k, v in limits.items() if v is not None}
+
+
+def apply_resource_limits(limits, original):
+  '''Lower the soft limits of the calling process to 'limits', a dictionary
+  of resource limits named as in RLIMITS, and restore the others to their
+  'original' values, a dictionary mapping the same names to the (soft, hard)
+  pairs of resource.getrlimit. The CPU time limit is relative to the CPU time
+  used so far.'''
+  for name, which in RLIMITS.items():
+    soft, hard = original[name]
+    value = limits.get(name)
+    if value is not None:
+      if name == 'cpu':
+        value = int(math.ceil(process_cpu_time() + value))
+      soft = value if hard == resource.RLIM_INFINITY else min(value, hard)
+    resource.setrlimit(which, (soft, hard))
+
+
+def limit_violation(exception, limits):
+  '''Return a description of the resource limit that was exceeded if
+  'exception' was caused by exceeding one of 'limits', and None otherwise.'''
+  if isinstance(exception, MemoryError) and 'memory' in limits:
+    return 'Exceeded the memory limit of {0} bytes'.format(limits['memory'])
+  code = getattr(exception, 'errno', None)
+  if code == errno.EFBIG and 'fileSize' in limits:
+    return 'Exceeded the file size limit of {0} bytes'.format(
+        limits['fileSize'])
+  if code == errno.EMFILE and 'openFiles' in limits:
+    return 'Exceeded the limit of {0} open files'.format(limits['openFiles'])
+  return None
+
+
+def wait_for_connections(connections, timeout):
+  '''Return the subset of 'connections' that are ready to be read, waiting
+  at most 'timeout' seconds for one of them to become ready.'''
+  if hasattr(multiprocessing.connection, 'wait'):
+    return multiprocessing.connection.wait(connections, timeout)
+  readable, _, _ = select.select(connections, [], [], timeout)
+  return readable
+
+
+def thread_cpu_time():
+  '''Return the number of CPU seconds consumed by the calling thread.'''
+  if hasattr(time, 'thread_time'):
+    return time.thread_time()
+  usage = resource.getrusage(RUSAGE_THREAD)
+  return usage.ru_utime + usage.ru_stime
+
+
+def process_cpu_time():
+  '''Return the number of CPU seconds consumed by the calling process.'''
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss():
+  '''Return the peak resident set size of the calling process in kilobytes.'''
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+  '''Reset the peak resident set size of the calling process to its current
+  resident set size, on platforms that support it.'''
+  try:
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+      clear_refs.write('5')
+  except (IOError, OSError):
+    pass
+
+
+def run_one_test(test, cpu_time=thread_cpu_time, limits=None,
+    whole_process=False, profile=False):
+  '''Run 'test' on its own and return an (outcome, detail, timing, output,
+  stats) tuple describing how it completed, where 'timing' is a dictionary
+  holding the wall time and the CPU time, as measured by 'cpu_time', it took,
+  and the peak resident set size of the process when it completed. If the
+  test runs under the resource 'limits', the errors caused by exceeding them
+  are reported as the limitExceeded outcome. If the console is routed by a
+  ConsoleRouter, 'output' is what the test printed from the calling thread,
+  or from any thread if 'whole_process' is True, see OutputCapture.getvalue,
+  and None otherwise. If 'profile' is True, the calling thread runs the test
+  under cProfile, and 'stats' are the resulting statistics in the format of
+  pstats, otherwise it is None.'''
+  if limits:
+    result = LimitedTestResult(limits)
+  else:
+    result = SynchronizedTestResult()
+  router = sys.stdout if isinstance(sys.stdout, ConsoleRouter) else None
+  capture = router and router.start_capture(whole_process)
+  profiler = cProfile.Profile() if profile else None
+  start_wall, start_cpu = time.time(), cpu_time()
+  try:
+    if profiler is not None:
+      profiler.enable()
+    try:
+      test.run(result)
+    finally:
+      if profiler is not None:
+        profiler.disable()
+  finally:
+    if router is not None:
+      router.stop_capture(whole_process)
+  timing = {
+    'wall': time.time() - start_wall,
+    'cpu': cpu_time() - start_cpu,
+    'maxRss': peak_rss()
+  }
+  output = capture and capture.getvalue()
+  return result.getOutcome(test) + (timing, output, profile_stats(profiler))
+
+
+def profile_stats(profiler):
+  '''Return the statistics collected by the cProfile.Profile 'profiler', in
+  the format of the 'stats' attribute of pstats.Stats, or None if
+  'profiler' is None.'''
+  if profiler is None:
+    return None
+  profiler.create_stats()
+  return profiler.stats
+
+
+class InterruptiblePool(object):
+  '''This class runs a list of tests in a fixed number of workers that pull
+  the tests one at a time, and enforces both a time limit on each test and a
+  time limit on the whole list of tests.
+
+  A worker whose test exceeds its time limit is stopped and replaced by a
+  fresh worker, so that the rest of the tests keep making progress. Tests that
+  run out of time are left unrecorded in the result, and hence are reported as
+  aborted. Subclasses define what a worker is by implementing the
+  start_worker, send, kill_worker and receive methods.'''
+
+  def __init__(self, tests, result, workers, time_limits, timeout,
+      finalizer=None, resource_limits=None, profile=False, dependencies=None):
+    ''''tests' is the list of tests to run, and 'result' the
+    SynchronizedTestResult to merge their outcomes into. 'workers' is the
+    number of workers, 'time_limits' is a list (same size as 'tests') of the
+    number of seconds each test is allowed to run, or None for no limit, and
+    'timeout' is the number of seconds all the tests are allowed to run.
+    'finalizer' is a single parameter function called with each test once its
+    outcome is known, including when it was aborted. 'resource_limits' is an
+    optional list (same size as 'tests') of the resource limits of each test,
+    for the workers that support them. If 'profile' is True, each test is
+    run under cProfile, and its statistics are recorded in 'result'.
+    'dependencies' is an optional list (same size as 'tests') of the
+    identifiers of the tests each test depends on, see depends_on. The tests
+    must be ordered so that each comes after its prerequisites in 'tests'; a
+    test is only started once they have all passed, and is skipped as soon as
+    one of them has not.'''
+    assert len(tests) == len(time_limits), 'Length of \'tests\' must be the ' +\
+      'same as length of \'time_limits\''
+    if resource_limits is None:
+      resource_limits = [{}] * len(tests)
+    if dependencies is None:
+      dependencies = [[]] * len(tests)
+    self.tests = tests
+    self.result = result
+    self.size = max(1, min(workers, len(tests)))
+    self.time_limits = time_limits
+    self.resource_limits = resource_limits
+    self.timeout = timeout
+    self.finalizer = finalizer
+    self.profile = profile
+    self.dependencies = dependencies
+
+    # The indices of the tests that have not been handed to a worker yet
+    self.pending = collections.deque(range(len(tests)))
+
+    # Maps each busy worker to the index and start time of its test
+    self.running = {}
+
+    # The workers waiting for the prerequisites of the pending tests
+    self.idle = []
+
+    # The identifiers of the tests that are either pending or running
+    self.unfinished = set(t.id() for t in tests)
+
+  def start_worker(self):
+    '''Start a new worker and return it.'''
+    raise NotImplementedError()
+
+  def send(self, worker, index):
+    '''Hand the test at 'index' to 'worker', or ask it to exit if 'index' is
+    None.'''
+    raise NotImplementedError()
+
+  def kill_worker(self, worker):
+    '''Stop 'worker' without waiting for its test to complete.'''
+    raise NotImplementedError()
+
+  def receive(self, timeout):
+    '''Wait up to 'timeout' seconds for workers to complete their tests, and
+    return a list of (worker, index, outcome, detail, timing, output, stats,
+    alive) tuples, where 'timing', 'output' and 'stats' are as returned by
+    run_one_test, and 'alive' is False if the worker died while running the
+    test.'''
+    raise NotImplementedError()
+
+  def skip(self, index, prerequisite):
+    '''Record that the test at 'index' was skipped because its 'prerequisite'
+    did not pass.'''
+    test = self.tests[index]
+    self.unfinished.discard(test.id())
+    self.result.addCompletion(test, 'skipped',
+        'Skipped because {0} did not pass'.format(prerequisite),
+        self.time_limits[index], 0.0, {'wall': 0.0})
+    if self.finalizer is not None:
+      self.finalizer(test)
+
+  def next_ready_test(self):
+    '''Remove the first pending test whose prerequisites have all passed from
+    the pending tests and return its index, or return None if there is none.
+    The pending tests with a prerequisite that did not pass are skipped along
+    the way.'''
+    for index in list(self.pending):
+      waiting = False
+      for prerequisite in self.dependencies[index]:
+        if prerequisite in self.unfinished:
+          waiting = True
+        elif self.result.getOutcomeById(prerequisite)[0] not in \
+            PASSING_OUTCOMES:
+          self.pending.remove(index)
+          self.skip(index, prerequisite)
+          break
+      else:
+        if not waiting:
+          self.pending.remove(index)
+          return index
+    return None
+
+  def assign_next_test(self, worker):
+    '''Hand the next pending test that is ready to run to 'worker', keep the
+    worker idle if the pending tests are waiting for their prerequisites, or
+    ask it to exit if there are no more tests.'''
+    index = self.next_ready_test()
+    if index is not None:
+      self.running[worker] = (index, time.time())
+      self.result.addStart(self.tests[index], self.time_limits[index])
+      self.send(worker, index)
+    elif len(self.pending) > 0:
+      self.idle.append(worker)
+    else:
+      self.send(worker, None)
+
+  def complete(self, worker, outcome=None, detail=None, timing=None,
+      output=None, stats=None):
+    '''Record the outcome of the test run by 'worker', along with the time
+    it took, what it printed and its profile, and mark the worker as idle.'''
+    index, started = self.running.pop(worker)
+    test = self.tests[index]
+    self.unfinished.discard(test.id())
+    elapsed = time.time() - started
+    self.result.addCompletion(test, outcome, detail, self.time_limits[index],
+        elapsed, timing or {'wall': elapsed}, output)
+    if stats is not None:
+      self.result.addProfile(test.id(), stats)
+    if self.finalizer is not None:
+      self.finalizer(test)
+
+  def next_deadline(self, suite_deadline):
+    '''Return the earliest time at which a running test or the whole list of
+    tests runs out of time.'''
+    deadlines = [started + self.time_limits[index]
+        for index, started in self.running.values()
+        if self.time_limits[index] is not None]
+    return min(deadlines + [suite_deadline])
+
+  def run(self):
+    '''Run all the tests, and return once every test has either completed or
+    has been aborted.'''
+    start_time = time.time()
+    suite_deadline = start_time + self.timeout
+    for _ in range(self.size):
+      self.assign_next_test(self.start_worker())
+    while len(self.running) > 0:
+      timeout = max(0, self.next_deadline(suite_deadline) - time.time())
+      for worker, index, outcome, detail, timing, output, stats, alive in \
+          self.receive(timeout):
+        # Ignore late outcomes of the tests that have already been aborted
+        if self.running.get(worker, (None,))[0] != index:
+          continue
+        self.complete(worker, outcome, detail, timing, output, stats)
+        self.assign_next_test(worker if alive else self.start_worker())
+      # The completed tests may have been the prerequisites that the idle
+      # workers were waiting for
+      idle, self.idle = self.idle, []
+      for worker in idle:
+        self.assign_next_test(worker)
+      now = time.time()
+      for worker, (index, started) in list(self.running.items()):
+        if now >= suite_deadline:
+          self.complete(worker)
+          self.kill_worker(worker)
+        elif self.time_limits[index] is not None and \
+            now - started >= self.time_limits[index]:
+          self.complete(worker)
+          self.kill_worker(worker)
+          self.assign_next_test(self.start_worker())
+    for worker in self.idle:
+      self.send(worker, None)
+    self.result.addSuiteTime(self.timeout, time.time() - start_time)
 
   @classmethod
-  def run_tasks_until_timeout(cls, tasks, args, finalizers, timeout):
-    '''This function takes in a list of tasks and runs them up to timeout
+  def run_tests_until_timeout(cls, tests, result, workers, time_limits, timeout,
+      finalizer=None, resource_limits=None, profile=False, dependencies=None):
+    '''This function takes in a list of tests and runs them in 'workers'
+    workers, each for up to its time limit, and all for up to 'timeout'
     seconds.'''
-    tg = cls(tasks, args, finalizers)
-    tg.start()
-    tg.set_timeout(timeout)
-    tg.join()
+    if len(tests) > 0:
+      cls(tests, result, workers, time_limits, timeout, finalizer,
+          resource_limits, profile, dependencies).run()
+    else:
+      result.addSuiteTime(timeout, 0.0)
+
+
+class InterruptibleThreadPool(InterruptiblePool):
+  '''An InterruptiblePool whose workers are daemon threads of this process.
+
+  Note that this class intentionally uses the Python threading module instead
+  of the multiprocessing module. Threads cannot be killed, so a worker that
+  runs out of time is merely abandoned: its outcome is ignored, it exits as
+  soon as its test returns, and it dies with the process if it never does. It
+  specifically does not provide any guarentees as to whether the tests will
+  actually be executed in parallel (which, in case if CPython, is well-known to
+  not be true).'''
+
+  def __init__(self, *args, **kwargs):
+    InterruptiblePool.__init__(self, *args, **kwargs)
+
+    # All the workers report the outcomes of their tests to this queue
+    self.outcomes = queue.Queue()
+
+    # The workers that were asked to exit once idle, rather than abandoned
+    self.stopping = []
+
+  def run(self):
+    InterruptiblePool.run(self)
+    # Only the abandoned workers, whose tests are still running, are left
+    # once the pool returns, so that the caller can tell whether they are
+    for worker in self.stopping:
+      worker.join()
+
+  def work(self, tasks):
+    '''The body of each worker thread. Runs the tests whose indices are put in
+    'tasks', until it receives None.'''
+    worker = threading.current_thread()
+    while True:
+      index = tasks.get()
+      if index is None:
+        break
+      try:
+        outcome = run_one_test(self.tests[index], profile=self.profile)
+      except Exception:
+        # The pool waits for an outcome of every test, so an error while
+        # running one is reported as its outcome rather than killing the
+        # worker silently
+        outcome = ('errors', traceback.format_exc(), None, None, None)
+      self.outcomes.put((worker, index) + outcome + (True,))
+
+  def start_worker(self):
+    tasks = queue.Queue()
+    worker = threading.Thread(target=self.work, args=(tasks,))
+    worker.tasks = tasks
+    # The workers are daemon, so that the ones that were abandoned terminate
+    # as soon as the main thread terminates
+    worker.daemon = True
+    worker.start()
+    return worker
+
+  def send(self, worker, index):
+    worker.tasks.put(index)
+    if index is None:
+      self.stopping.append(worker)
+
+  def kill_worker(self, worker):
+    worker.tasks.put(None)
+
+  def receive(self, timeout):
+    try:
+      received = [self.outcomes.get(timeout=timeout)]
+    except queue.Empty:
+      return []
+    while True:
+      try:
+        received.append(self.outcomes.get_nowait())
+      except queue.Empty:
+        return received
+
+
+def process_worker(tests, connection, profile=False):
+  '''The body of a worker process of an InterruptibleProcessPool. Receives
+  pairs of an index into 'tests' and of resource limits over 'connection',
+  runs the corresponding test under those limits, and under cProfile if
+  'profile' is True, and sends back its outcome, until it receives None.'''
+  original = {k: resource.getrlimit(v) for k, v in RLIMITS.items()}
+  # Writing past the file size limit fails with EFBIG instead of killing the
+  # worker, so that it is reported as the outcome of the test
+  signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+  while True:
+    task = connection.recv()
+    if task is None:
+      break
+    index, limits = task
+    # Each test is charged only for the memory it uses itself, rather than for
+    # the memory used by the tests this worker ran before it
+    reset_peak_rss()
+    apply_resource_limits(limits, original)
+    try:
+      outcome = run_one_test(tests[index], process_cpu_time, limits, True,
+          profile)
+    except Exception:
+      # Report the error to the pool rather than dying with it, so that the
+      # test is not mistaken for a crash of the worker
+      outcome = ('errors', traceback.format_exc(), None, None, None)
+    finally:
+      apply_resource_limits({}, original)
+    connection.send((index,) + outcome)
+  connection.close()
+
+
+class InterruptibleProcessPool(InterruptiblePool):
+  '''An InterruptiblePool whose workers are processes.
+
+  Unlike with threads, a worker whose test runs out of time is killed, so a
+  runaway test stops consuming CPU time as soon as it exceeds its limit, and
+  CPU-bound tests are not serialized by the global interpreter lock. The
+  workers are forked after the test classes have been set up, so they inherit
+  the loaded test module and the class fixtures. The outcomes of the tests are
+  sent back to this process and merged into its SynchronizedTestResult.'''
+
+  def __init__(self, *args, **kwargs):
+    InterruptiblePool.__init__(self, *args, **kwargs)
+
+    # Maps the connection to each live worker to the worker process
+    self.processes = {}
+
+  def start_worker(self):
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=process_worker,
+        args=(self.tests, child_connection, self.profile))
+    process.daemon = True
+    process.start()
+    child_connection.close()
+    self.processes[connection] = process
+    return connection
+
+  def send(self, connection, index):
+    if index is None:
+      connection.send(None)
+    else:
+      connection.send((index, self.resource_limits[index]))
+    if index is None:
+      connection.close()
+      self.processes.pop(connection).join()
+
+  def kill_worker(self, connection):
+    process = self.processes.pop(connection)
+    if process.is_alive():
+      os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    connection.close()
+
+  def receive(self, timeout):
+    received = []
+    for connection in wait_for_connections(list(self.processes.keys()),
+        timeout):
+      try:
+        received.append((connection,) + connection.recv() + (True,))
+      except EOFError:
+        # The worker died while running a test, e.g. due to a crash in an
+        # extension module or a call to os._exit
+        process = self.processes[connection]
+        self.kill_worker(connection)
+        index = self.running[connection][0]
+        limits = self.resource_limits[index]
+        if 'cpu' in limits and process.exitcode in (-signal.SIGXCPU,
+            -signal.SIGKILL):
+          outcome, detail = 'limitExceeded', 'Exceeded the CPU time limit ' +\
+              'of {0} seconds'.format(limits['cpu'])
+        else:
+          outcome, detail = 'errors', 'Worker process exited unexpectedly ' +\
+              'with code {0}'.format(process.exitcode)
+        received.append((connection, index, outcome, detail, None, None,
+            None, False))
+    return received
+
+
+def time_budget(limit, elapsed):
+  '''Return a dictionary describing how much of a time limit of 'limit'
+  seconds was used by something that ran for 'elapsed' seconds.'''
+  remaining = None
+  if limit is not None and elapsed is not None:
+    remaining = max(0.0, limit - elapsed)
+  return {'limit': limit, 'elapsed': elapsed, 'remaining': remaining}
+
+
+# The outcomes that unittest.TestResult records as lists of tests, rather than
+# as lists of (test, detail) pairs
+LIST_OUTCOMES = ('successes', 'unexpectedSuccesses')
+
+# The outcomes that are recorded as lists of (test, detail) pairs, as
+# unittest.TestResult does, including that of the tests that exceeded their
+# resource limits
+DETAILED_OUTCOMES = ('errors', 'failures', 'skipped', 'expectedFailures',
+    'limitExceeded')
+
+# The outcomes of the tests that count as passed for the tests that depend on
+# them
+PASSING_OUTCOMES = ('successes', 'expectedFailures', 'unexpectedSuccesses')
+
+# Maps each outcome, or None for tests that did not complete, to the format of
+# the status displayed for its tests
+STATUS_FORMATS = {
+  'errors': 'Completed with error: {0}',
+  'failures': 'Completed with failure: {0}',
+  'successes': 'Completed with success: {0}',
+  'skipped': 'Skipped: {0}',
+  'expectedFailures': 'Completed with expected failure: {0}',
+  'unexpectedSuccesses': 'Completed with unexpected success: {0}',
+  'limitExceeded': 'Exceeded a resource limit: {0}',
+  None: 'Not completed: {0}'
+}
+
+
+def summarize_records(all_tests, records, suite_time, fixture_timings,
+    fingerprints=None):
+  '''Return the summary of a run of the tests in 'all_tests', a dictionary
+  mapping the identifier of each test to its docstring. 'records',
+  'suite_time', 'fixture_timings' and 'fingerprints' are in the format of
+  the attributes of the same name of SynchronizedTestResult.'''
+  s = {k: [] for k in LIST_OUTCOMES}
+  s.update({k: {} for k in DETAILED_OUTCOMES})
+  s['allTests'] = dict(all_tests)
+  s['timeBudget'] = {'suite': time_budget(*suite_time), 'tests': {}}
+  s['timings'] = {'tests': {}}
+  s['output'] = {}
+  for test_id, record in records.items():
+    outcome = record['outcome']
+    if outcome in LIST_OUTCOMES:
+      s[outcome].append(test_id)
+    elif outcome is not None:
+      s[outcome][test_id] = record['detail']
+    if 'elapsed' in record:
+      s['timeBudget']['tests'][test_id] = time_budget(record['timeLimit'],
+          record['elapsed'])
+    if 'timing' in record:
+      s['timings']['tests'][test_id] = record['timing']
+    if record.get('output') is not None:
+      s['output'][test_id] = record['output']
+  for func_name in ('setUpClass', 'tearDownClass'):
+    s['timings'][func_name] = dict(fixture_timings.get(func_name, {}))
+  s['aborted'] = [t for t in s['allTests']
+      if records.get(t, {}).get('outcome') is None]
+  if fingerprints is not None:
+    s['fingerprints'] = dict(fingerprints)
+  return s
 
 
 class SynchronizedTestResult(unittest.TestResult):
   '''A simple test result aggregator that build on top of unittest.TestResult
-  to account for concurrent updates.'''
+  to account for concurrent updates.
 
-  def __init__(self):
+  Besides the outcome lists of unittest.TestResult, it keeps a record of
+  everything known about each test, indexed by the test's identifier, so that
+  the outcome of a test can be looked up without scanning the lists.'''
+
+  def __init__(self, events=None):
+    ''''events' is the EventStream to which the progress of the suite is
+    written as it happens, if any.'''
     unittest.TestResult.__init__(self)
     self.lock = threading.Lock()
+    self.events = events
     self.frozen = False
     self.successes = []
+    self.limitExceeded = []
+
+    # Maps the identifier of each test to a dictionary holding its 'outcome'
+    # and 'detail', its 'timeLimit' and the number of seconds it ran for
+    # ('elapsed'), the resources it consumed ('timing', see run_one_test) and
+    # what it printed ('output'), in the order in which the tests were first
+    # recorded
+    self.records = collections.OrderedDict()
+
+    # The time limit and the number of seconds the whole suite ran for
+    self.suite_time = (None, None)
+
+    # Maps the names of the class fixtures, such as setUpClass, to dictionaries
+    # mapping the identifier of each TestCase class to the number of seconds
+    # its fixture took
+    self.fixture_timings = collections.defaultdict(dict)
+
+    # Maps the identifier of each test to the fingerprint of its code, if known
+    self.fingerprints = None
+
+    # Maps the identifiers of the profiled tests and class fixtures to their
+    # statistics, see run_one_test. These are too large for the event stream.
+    self.profiles = {}
+
+  def write_event(self, event):
+    '''Write 'event' to the event stream, if any. The caller must hold the
+    lock, so that the events are written in the order they are recorded.'''
+    if self.events is not None:
+      self.events.write(event)
+
+  def record_for(self, test):
+    '''Return the record of 'test', creating it if needed. The caller must
+    hold the lock.'''
+    test_id = test.id()
+    if test_id not in self.records:
+      self.records[test_id] = {'outcome': None, 'detail': None}
+    return self.records[test_id]
+
+  def append_outcome(self, test, outcome, detail):
+    '''Append 'test' to the unittest list of 'outcome'. The caller must hold
+    the lock.'''
+    if outcome in LIST_OUTCOMES:
+      getattr(self, outcome).append(test)
+    else:
+      getattr(self, outcome).append((test, detail))
 
   def addError(self, test, err):
-    with self.lock:
-      if not self.frozen:
-        self.errors.append((test, traceback.format_exc(err)))
+    self.addOutcome(test, 'errors', self._exc_info_to_string(err, test))
 
   def addFailure(self, test, err):
-    with self.lock:
-      if not self.frozen:
-        self.failures.append((test, traceback.format_exc(err)))
+    self.addOutcome(test, 'failures', self._exc_info_to_string(err, test))
 
   def addSuccess(self, test):
-    with self.lock:
-      if not self.frozen:
-        self.successes.append(test)
+    self.addOutcome(test, 'successes')
 
   def addSkip(self, test, reason):
-    with self.lock:
-      if not self.frozen:
-        self.skipped.append((test, reason))
+    self.addOutcome(test, 'skipped', reason)
 
   def addExpectedFailure(self, test, err):
-    with self.lock:
-      if not self.frozen:
-        self.expectedFailures.append((test, err))
+    self.addOutcome(test, 'expectedFailures',
+        self._exc_info_to_string(err, test))
 
   def addUnexpectedSuccess(self, test):
+    self.addOutcome(test, 'unexpectedSuccesses')
+
+  def addOutcome(self, test, outcome, detail=None):
+    '''Record an outcome of 'test'. 'outcome' is the name of one of the outcome
+    lists (e.g. 'errors' or 'successes') and 'detail' is the traceback or the
+    reason that accompanies it, if any. This is also used to merge outcomes
+    that were observed elsewhere, such as in a worker process.'''
+    with self.lock:
+      if not self.frozen:
+        self.append_outcome(test, outcome, detail)
+        record = self.record_for(test)
+        record['outcome'] = outcome
+        record['detail'] = detail
+
+  def getOutcome(self, test):
+    '''Return the (outcome, detail) pair recorded for 'test', or (None, None)
+    if the test has not completed.'''
+    return self.getOutcomeById(test.id())
+
+  def getOutcomeById(self, test_id):
+    '''Return the (outcome, detail) pair recorded for the test whose
+    identifier is 'test_id', or (None, None) if it has not completed.'''
+    with self.lock:
+      record = self.records.get(test_id)
+      if record is None:
+        return None, None
+      return record['outcome'], record['detail']
+
+  def addSuiteStart(self, all_tests, limit, fingerprints=None):
+    '''Record that the suite made of the list of tests 'all_tests', which is
+    allowed to run for 'limit' seconds, is starting. 'fingerprints' maps the
+    identifier of each test to the fingerprint of its code, if known.'''
+    with self.lock:
+      self.fingerprints = fingerprints
+      self.write_event({'event': 'suite', 'limit': limit,
+          'allTests': collections.OrderedDict((t.id(), doc_for(t))
+          for t in all_tests), 'fingerprints': fingerprints})
+
+  def addStart(self, test, limit):
+    '''Record that 'test', which is allowed to run for 'limit' seconds (or None
+    if unlimited), is starting.'''
+    with self.lock:
+      if not self.frozen:
+        self.write_event({'event': 'start', 'test': test.id(),
+            'timeLimit': limit})
+
+  def addCompletion(self, test, outcome, detail, limit, elapsed, timing,
+      output=None):
+    '''Record the outcome of 'test' (None if it was aborted) and its 'detail',
+    and that it ran for 'elapsed' out of 'limit' seconds, consumed the
+    resources in 'timing' and printed 'output', see run_one_test.'''
+    with self.lock:
+      if not self.frozen:
+        if outcome is not None:
+          self.append_outcome(test, outcome, detail)
+        record = self.record_for(test)
+        record.update(outcome=outcome, detail=detail, timeLimit=limit,
+            elapsed=elapsed, timing=timing, output=output)
+        self.write_event(dict(record, event='finish', test=test.id()))
+
+  def addSuiteTime(self, limit, elapsed):
+    '''Record that the suite, which was allowed to run for 'limit' seconds,
+    ran for 'elapsed' seconds.'''
     with self.lock:
       if not self.frozen:
-        self.unexpectedSuccesses.append(test)
+        self.suite_time = (limit, elapsed)
+        self.write_event({'event': 'end', 'limit': limit, 'elapsed': elapsed})
+
+  def addFixtureTiming(self, func_name, cls, elapsed):
+    '''Record that the class fixture 'func_name' of the TestCase class 'cls'
+    took 'elapsed' seconds. Unlike the outcomes of the tests, these can be
+    recorded after the result has been frozen.'''
+    with self.lock:
+      self.fixture_timings[func_name][class_id(cls)] = elapsed
+      self.write_event({'event': 'fixture', 'name': func_name,
+          'class': class_id(cls), 'elapsed': elapsed})
+
+  def addProfile(self, name, stats):
+    '''Record the profile 'stats' of the test or class fixture 'name'. Like
+    the timings of the fixtures, these can be recorded after the result has
+    been frozen.'''
+    with self.lock:
+      self.profiles[name] = stats
 
   def freeze(self):
     with self.lock:
@@ -211,88 +1169,398 @@ class SynchronizedTestResult(unittest.TestResult):
   def getStatusAsString(self, test):
     assert test != None
     mod_name, class_name, func_name = test.id().split('.')
-    if len(self.errors) > 0 and test in zip(*self.errors)[0]:
-      return 'Completed with error: {0}'.format(func_name)
-    elif len(self.failures) > 0 and test in zip(*self.failures)[0]:
-      return 'Completed with failure: {0}'.format(func_name)
-    elif len(self.successes) > 0 and test in self.successes:
-      return 'Completed with success: {0}'.format(func_name)
-    elif len(self.skipped) > 0 and test in zip(*self.skipped)[0]:
-      return 'Skipped: {0}'.format(func_name)
-    elif len(self.expectedFailures) > 0 and \
-        test in zip(*self.expectedFailures)[0]:
-      return 'Completed with expected failure: {0}'.format(func_name)
-    elif len(self.unexpectedSuccesses) > 0 and test in self.unexpectedSuccesses:
-      return 'Completed with unexpected success: {0}'.format(func_name)
-    else:
-      return 'Not completed: {0}'.format(func_name)
+    outcome, _ = self.getOutcome(test)
+    return STATUS_FORMATS[outcome].format(func_name)
 
   def summarize(self, all_tests):
     all_tests = list(list_of_tests_gen(all_tests))
-    s = {
-      'errors': {k.id(): v for k, v in self.errors},
-      'failures': {k.id(): v for k, v in self.failures},
-      'successes': [t.id() for t in self.successes],
-      'skipped': {k.id(): v for k, v in self.skipped},
-      'expectedFailures': {k.id(): v for k, v in self.expectedFailures},
-      'unexpectedSuccesses': [t.id() for t in self.unexpectedSuccesses],
-      'allTests': {t.id(): doc_for(t) for t in all_tests}
-    }
-    processed_union = set().union(s['errors'].keys(), s['failures'].keys(),
-        s['successes'], s['skipped'].keys(), s['expectedFailures'].keys(),
-        s['unexpectedSuccesses'])
-    s['aborted'] = list(set(x.id() for x in all_tests) - processed_union)
-    return s
+    with self.lock:
+      return summarize_records({t.id(): doc_for(t) for t in all_tests},
+          self.records, self.suite_time, self.fixture_timings,
+          self.fingerprints)
+
+
+class LimitedTestResult(SynchronizedTestResult):
+  '''A SynchronizedTestResult for a test that runs under resource limits,
+  which reports the errors caused by exceeding them as a limitExceeded
+  outcome rather than as errors.'''
+
+  def __init__(self, limits):
+    SynchronizedTestResult.__init__(self)
+    self.limits = limits
+
+  def addError(self, test, err):
+    violation = limit_violation(err[1], self.limits)
+    if violation is None:
+      SynchronizedTestResult.addError(self, test, err)
+    else:
+      self.addOutcome(test, 'limitExceeded', '{0}\n{1}'.format(violation,
+          self._exc_info_to_string(err, test)))
+
+
+class EventStream(object):
+  '''An append-only file of newline-delimited JSON events, one per line, that
+  records the progress of a suite as it happens. Each event is flushed as soon
+  as it is written, so the stream survives the death of the process that
+  writes it, and can be followed by other processes while it grows.'''
+
+  def __init__(self, path, mode='a'):
+    if mode == 'a' and os.path.isfile(path):
+      EventStream.truncate_partial_event(path)
+    self.file = open(path, mode)
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def truncate_partial_event(path):
+    '''Remove the partially written last event, if any, from the stream at
+    'path', so that the events appended to it start on a line of their own.'''
+    with open(path, 'rb+') as stream:
+      contents = stream.read()
+      stream.truncate(contents.rfind(b'\n') + 1)
+
+  def write(self, event):
+    '''Append the dictionary 'event' to the stream.'''
+    line = json.dumps(event) + '\n'
+    with self.lock:
+      self.file.write(line)
+      self.file.flush()
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+
+def events_path_for(result_file_path):
+  '''Return the path of the event stream that accompanies a result file.'''
+  return os.path.splitext(result_file_path)[0] + '.ndjson'
+
+
+def read_events(path):
+  '''A generator of the events in the event stream at 'path'. Partially
+  written events, as left by a process that died while writing one, are
+  ignored.'''
+  with open(path) as stream:
+    for line in stream:
+      try:
+        event = json.loads(line)
+      except ValueError:
+        continue
+      if isinstance(event, dict):
+        yield event
+
+
+def replay_events(events):
+  '''Rebuild the state of a SynchronizedTestResult from a sequence of events,
+  which may stop at any point of a run. Return the arguments of
+  summarize_records. When the sequence covers several runs, the later events
+  take precedence. Each record also holds the 'fingerprint' of the test as of
+  the run in which it completed.'''
+  all_tests = {}
+  records = collections.OrderedDict()
+  suite_time = (None, None)
+  fixture_timings = collections.defaultdict(dict)
+  fingerprints = None
+  for event in events:
+    kind = event.get('event')
+    if kind == 'suite':
+      all_tests = event['allTests']
+      suite_time = (event['limit'], None)
+      fingerprints = event.get('fingerprints')
+    elif kind == 'start':
+      records.setdefault(event['test'], {'outcome': None, 'detail': None})
+      records[event['test']]['timeLimit'] = event['timeLimit']
+    elif kind == 'finish':
+      records[event['test']] = {k: v for k, v in event.items()
+          if k not in ('event', 'test')}
+      records[event['test']]['fingerprint'] = (fingerprints or {}).get(
+          event['test'])
+    elif kind == 'fixture':
+      fixture_timings[event['name']][event['class']] = event['elapsed']
+    elif kind == 'end':
+      suite_time = (event['limit'], event['elapsed'])
+  return all_tests, records, suite_time, fixture_timings, fingerprints
+
+
+def profile_dir_for(result_file_path):
+  '''Return the path of the directory of the profiles that accompany a result
+  file.'''
+  return os.path.splitext(result_file_path)[0] + '.profile'
+
+
+def output_paths(result_file_path):
+  '''Return the paths, relative to a submission directory, of the files and
+  directories the runner writes there.'''
+  return [result_file_path, events_path_for(result_file_path),
+      profile_dir_for(result_file_path)]
+
+
+def relocate_stats(stats, root, placeholder):
+  '''Return a copy of the pstats statistics 'stats' in which the files in
+  the directory 'root' are named relative to 'placeholder' instead, so that
+  the profiles of different submissions name their files alike.'''
+  root = os.path.abspath(root) + os.sep
+  def relocate(func):
+    filename, line, name = func
+    if os.path.abspath(filename).startswith(root):
+      filename = os.path.join(placeholder,
+          os.path.abspath(filename)[len(root):])
+    return filename, line, name
+  return {relocate(func): (cc, nc, tt, ct, {relocate(k): v
+      for k, v in callers.items()})
+      for func, (cc, nc, tt, ct, callers) in stats.items()}
+
+
+def write_profiles(profiles, directory, test_root, placeholder):
+  '''Write each of the 'profiles' of a SynchronizedTestResult to a file of
+  the same name with the .prof extension in 'directory', which pstats can
+  load, replacing the profiles of any earlier run. The files of the
+  submission in 'test_root' are named relative to 'placeholder'.'''
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  for f in os.listdir(directory):
+    if f.endswith('.prof'):
+      os.remove(os.path.join(directory, f))
+  for name, stats in profiles.items():
+    with open(os.path.join(directory, name + '.prof'), 'wb') as f:
+      marshal.dump(relocate_stats(stats, test_root, placeholder), f)
+
+
+def summarize_events(path):
+  '''Return the summary of the run recorded in the event stream at 'path', in
+  the same format as SynchronizedTestResult.summarize. Tests that never
+  completed, including those of a run that was interrupted, are reported as
+  aborted.'''
+  return summarize_records(*replay_events(read_events(path)))
 
 
 class TimeoutTestRunner(object):
   '''A unit test runner with support for timeouts built on top of the
-  InterruptibleThreadGroup.'''
-
-  def __init__(self, timeout):
+  InterruptibleThreadPool, or of the InterruptibleProcessPool when the tests
+  are to be run in worker processes.'''
+
+  def __init__(self, timeout, processes=0, threads=8, test_timeout=None,
+      resource_limits=None, profile=False, timeout_profile=None):
+    ''''timeout' is the number of seconds the whole suite is allowed to run,
+    and 'test_timeout' the number of seconds each test is allowed to run
+    unless it declares its own time limit. If 'processes' is 0, the tests run
+    in 'threads' threads of this process, otherwise they run in that many
+    worker processes. 'resource_limits' are the limits, named as in RLIMITS,
+    of each test that does not declare its own, which can only be enforced
+    in worker processes. If 'profile' is True, the tests and the class
+    fixtures are run under cProfile.
+
+    If 'timeout_profile' is specified, it is the path of the profile of the
+    time limits of the tests, see load_timeout_profile, which applies to the
+    calibrated tests that do not declare their own limit. When all the tests
+    have a limit, the suite is given no more time than their sum.'''
+    if resource_limits and processes == 0:
+      raise Exception('Resource limits require running the tests in ' +
+          'worker processes')
     self.timeout = timeout
+    self.processes = processes
+    self.threads = threads
+    self.test_timeout = test_timeout
+    self.resource_limits = resource_limits
+    self.profile = profile
+    self.calibrated_limits = {}
+    if timeout_profile is not None:
+      self.calibrated_limits = load_timeout_profile(timeout_profile)
+
+  def time_limit(self, test):
+    '''Return the number of seconds 'test' is allowed to run.'''
+    return time_limit_for(test, self.calibrated_limits.get(test.id(),
+        self.test_timeout))
 
   @staticmethod
-  def process_test_cases(entity, func_name, already_processed=set()):
+  def process_test_cases(entity, func_name, already_processed=None,
+      result=None, profile=False):
     '''Runs the specified class function of the TestCase object encountered,
     recusively starting at root, ensuring that each class is processed exactly
-    once.'''
+    once. The time each call takes, and its profile if 'profile' is True, are
+    recorded in 'result', if specified.'''
+    if already_processed is None:
+      already_processed = set()
     if isinstance(entity, unittest.TestSuite):
       for t in entity:
         if isinstance(t, unittest.TestCase):
           if not t.__class__ in already_processed:
+            profiler = cProfile.Profile() if profile else None
+            start_time = time.time()
             try:
+              if profiler is not None:
+                profiler.enable()
               getattr(t.__class__, func_name)()
             except:
               pass
+            finally:
+              if profiler is not None:
+                profiler.disable()
+            if result is not None:
+              result.addFixtureTiming(func_name, t.__class__,
+                  time.time() - start_time)
+              if profiler is not None:
+                result.addProfile('{0}.{1}'.format(class_id(t.__class__),
+                    func_name), profile_stats(profiler))
             already_processed.add(t.__class__)
         else:
-          TimeoutTestRunner.process_test_cases(t, func_name, already_processed)
+          TimeoutTestRunner.process_test_cases(t, func_name, already_processed,
+              result, profile)
     else:
       raise Exception('Unknow object encountered in the TestSuite!')
 
-  def run(self, test_entity, verbose=False):
-    '''Executes the given test suite and returns the collected results.'''
-    result = SynchronizedTestResult()
-    TimeoutTestRunner.process_test_cases(test_entity, 'setUpClass')
+  def run(self, test_entity, verbose=False, events=None, previous=None,
+      fingerprints=None):
+    '''Executes the given test suite and returns the collected results. The
+    progress of the suite is written to the EventStream 'events', if any.
+    'fingerprints' optionally maps the identifier of each test to the
+    fingerprint of its code. 'previous' optionally maps the identifiers of
+    tests to the records, in the format of SynchronizedTestResult.records, of
+    an earlier run; the tests that completed in that run are not run again,
+    and their records are merged into the results instead, unless their
+    fingerprints have changed since or one of their prerequisites runs again.
+    The tests run after their prerequisites, see depends_on.'''
+    result = SynchronizedTestResult(events)
     tests = list(list_of_tests_gen(test_entity))
-    test_tasks = [lambda t: t.run(result)] * len(tests)
-    disp_tasks = [lambda t: displayln(result.getStatusAsString(t))] * len(tests)
-    if not verbose:
-      disp_tasks = None
-    InterruptibleThreadGroup.run_tasks_until_timeout(test_tasks, tests,
-        disp_tasks, self.timeout)
+    timeout = self.timeout
+    if len(self.calibrated_limits) > 0:
+      limits = [self.time_limit(t) for t in tests]
+      if None not in limits:
+        timeout = min(timeout, sum(limits))
+    result.addSuiteStart(tests, timeout, fingerprints)
+    dependencies = {t.id(): dependencies_for(t) for t in tests}
+    for test_id, prerequisites in dependencies.items():
+      for p in prerequisites:
+        if p not in dependencies:
+          raise Exception('Unknown prerequisite {0} of {1}'.format(p, test_id))
+    tests = order_by_dependencies(tests, dependencies)
+    def reusable(test):
+      record = previous.get(test.id(), {})
+      if fingerprints is not None and (fingerprints.get(test.id()) is None or
+          record.get('fingerprint') != fingerprints.get(test.id())):
+        return False
+      return record.get('outcome') is not None
+    if previous is not None:
+      # A test runs again along with its prerequisites, which come first
+      reused = set()
+      for t in tests:
+        if reusable(t) and all(p in reused for p in dependencies[t.id()]):
+          reused.add(t.id())
+          record = previous[t.id()]
+          result.addCompletion(t, record['outcome'], record.get('detail'),
+              record.get('timeLimit'), record.get('elapsed'),
+              record.get('timing'), record.get('output'))
+      tests = [t for t in tests if t.id() not in reused]
+    TimeoutTestRunner.process_test_cases(test_entity, 'setUpClass',
+        result=result, profile=self.profile)
+    time_limits = [self.time_limit(t) for t in tests]
+    prerequisites = [dependencies[t.id()] for t in tests]
+    display = None
+    if verbose:
+      display = lambda t: displayln(result.getStatusAsString(t))
+    if self.processes > 0:
+      InterruptibleProcessPool.run_tests_until_timeout(tests, result,
+          self.processes, time_limits, timeout, display,
+          [resource_limits_for(t, self.resource_limits) for t in tests],
+          self.profile, prerequisites)
+    else:
+      InterruptibleThreadPool.run_tests_until_timeout(tests, result,
+          self.threads, time_limits, timeout, display,
+          profile=self.profile, dependencies=prerequisites)
     result.freeze()
-    TimeoutTestRunner.process_test_cases(test_entity, 'tearDownClass')
+    TimeoutTestRunner.process_test_cases(test_entity, 'tearDownClass',
+        result=result, profile=self.profile)
     return result
 
 
+def format_timings(timings):
+  '''Format the 'timings' section of a summary as a table, listing the class
+  fixtures and then the tests, slowest first.'''
+  def cell(value, scale=1.0):
+    return '-' if value is None else '{0:.3f}'.format(value / scale)
+  rows = []
+  for func_name in ('setUpClass', 'tearDownClass'):
+    for k, v in timings[func_name].items():
+      rows.append(('{0} ({1})'.format(k, func_name), v, None, None))
+  for k, v in timings['tests'].items():
+    rows.append((k, v.get('wall'), v.get('cpu'), v.get('maxRss')))
+  rows.sort(key=lambda r: -(r[1] or 0))
+  width = max([len(r[0]) for r in rows] + [4])
+  lines = ['{0:<{1}} {2:>10} {3:>10} {4:>14}'.format('Test', width, 'Wall (s)',
+      'CPU (s)', 'Peak RSS (MB)')]
+  for name, wall, cpu, max_rss in rows:
+    lines.append('{0:<{1}} {2:>10} {3:>10} {4:>14}'.format(name, width,
+        cell(wall), cell(cpu), cell(max_rss, 1024.0)))
+  return '\n'.join(lines)
+
+
+def add_resource_limit_arguments(parser):
+  '''Add the command line options that set the default resource limits of the
+  tests to the argparse 'parser'.'''
+  parser.add_argument('--memory-limit', help='The max number of megabytes ' +
+    'of address space of the process running a test.', default=None,
+    type=float)
+
+  parser.add_argument('--cpu-limit', help='The max number of CPU seconds a ' +
+    'test is allowed to use.', default=None, type=float)
+
+  parser.add_argument('--file-size-limit', help='The max number of ' +
+    'megabytes a test is allowed to write to a single file, including the ' +
+    'redirected console.', default=None, type=float)
+
+  parser.add_argument('--open-files-limit', help='The max number of files ' +
+    'the process running a test is allowed to have open.', default=None,
+    type=int)
+
+
+def resource_limits_from_args(args):
+  '''Return the dictionary of the default resource limits of the tests set by
+  the options of add_resource_limit_arguments, or None if there are none.'''
+  megabyte = 1024 * 1024
+  limits = {
+    'memory': args.memory_limit and int(args.memory_limit * megabyte),
+    'cpu': args.cpu_limit,
+    'fileSize': args.file_size_limit and int(args.file_size_limit * megabyte),
+    'openFiles': args.open_files_limit
+  }
+  limits = {k: v for k, v in limits.items() if v is not None}
+  return limits or None
+
+
+def write_summary(summary, result_file_path):
+  '''Write 'summary' as a JSON file at 'result_file_path', in a way that
+  leaves either the complete file or no file at all.'''
+  with open(result_file_path + '.tmp', 'w') as result_file:
+    json.dump(summary, result_file, indent=True)
+  os.rename(result_file_path + '.tmp', result_file_path)
+
+
+def display_summary(name, summary, timings=False):
+  '''Display a summary of the students' results to let the test runner know
+  the test runner is making progress, along with the timings table if
+  'timings' is True.'''
+  displayln(('{0}: Successful={1}/{6}, Errors={2}/{6}, Failed={3}/{6}, ' +
+    'Aborted={4}/{6}, Skipped={5}/{6}, Exceeded limits={7}/{6}').format(name,
+    len(summary['successes']), len(summary['errors']),
+    len(summary['failures']), len(summary['aborted']),
+    len(summary['skipped']), len(summary['allTests']),
+    len(summary.get('limitExceeded', {}))))
+
+  if timings:
+    displayln(format_timings(summary['timings']))
+
+
 def process_one_submission(module, test_root, result_file_path='results.json',
     timeout=600.0, overwrite_existing_results=False, verbose=False,
-    redir_console=None):
+    redir_console=None, processes=0, threads=8, test_timeout=None,
+    timings=False, resume=False, cache_dir=None, incremental=False,
+    resource_limits=None, output_limit=None, profile=False,
+    timeout_profile=None):
 
   # Redirect console only once the arguments have been parsed
-  redirect_console(redir_console)
+  redirect_console(redir_console, output_limit)
 
   # Check if the module name was accidentally specified with .py extension
   # and if so, correct it
@@ -302,39 +1570,82 @@ def process_one_submission(module, test_root, result_file_path='results.json',
   # First check if the result file exists
   result_file_path = os.path.join(test_root, result_file_path)
   basename = os.path.basename(os.path.abspath(test_root))
-  if os.path.isfile(result_file_path) and not overwrite_existing_results:
+  if os.path.isfile(result_file_path) and not (overwrite_existing_results or
+      incremental):
     raise Exception('Results already exist for {0}'.format(basename))
 
-  # Typically, this module will be run in the same directory so we need to
-  # make the symlinks in those directory accessible by adding the current
-  # working directory to the path
-  sys.path.append(os.getcwd())
-
   # Check if the specified test root is valid
   if not os.path.isdir(test_root):
-    raise Exception('Invalid \'test_root\': {0}'.format(args.test_root))
+    raise Exception('Invalid \'test_root\': {0}'.format(test_root))
 
-  # Append the test root to the python path so that the test module can be
-  # imported directly
-  sys.path.append(test_root)
+  import cache
 
-  # Import the test module and run the tests contained in it
-  m = __import__(module)
-  tests = unittest.defaultTestLoader.loadTestsFromModule(m)
-  result = TimeoutTestRunner(timeout).run(tests, verbose)
-  summary = result.summarize(tests)
-
-  # Write the test results as a JSON file
-  with open(result_file_path, 'w') as result_file:
-    json.dump(summary, result_file, indent=True)
-
-  # Display a summary of the students' results to let the test runner know
-  # the test runner is making progress
-  displayln(('{0}: Successful={1}/{6}, Errors={2}/{6}, Failed={3}/{6}, ' +
-    'Aborted={4}/{6}, Skipped={5}/{6}').format(basename,
-    len(summary['successes']), len(summary['errors']),
-    len(summary['failures']), len(summary['aborted']),
-    len(summary['skipped']), len(summary['allTests'])))
+  # Typically, this module will be run in the same directory so we need to
+  # make the symlinks in those directory accessible by adding the current
+  # working directory to the path. The test root is also added to the path
+  # so that the test module can be imported directly. Both are only on the
+  # path, and the modules imported from them only loaded, while grading this
+  # submission.
+  with SubmissionImports([os.getcwd(), test_root]):
+    events_path = events_path_for(result_file_path)
+    ignored = cache.written_paths(test_root, os.path.abspath(result_file_path),
+        redir_console, cache_dir)
+
+    # Identical submissions graded with the same tests get the cached results,
+    # unless the tests are to be profiled
+    if cache_dir is not None:
+      result_cache = cache.ResultCache(cache_dir, module, timeout=timeout,
+          test_timeout=test_timeout, resource_limits=resource_limits,
+          output_limit=output_limit, timeout_profile=timeout_profile)
+      cache_key = result_cache.submission_key(test_root,
+          os.path.abspath(result_file_path), redir_console)
+      summary = None if profile else result_cache.load(cache_key, test_root)
+      if summary is not None:
+        write_summary(summary, result_file_path)
+        display_summary(basename + ' (cached)', summary, timings)
+        return
+
+    # Stream the progress of the tests as they run, so that it survives the
+    # death of this process. When resuming, the tests that completed in the
+    # interrupted run are not run again.
+    previous = None
+    if resume and os.path.isfile(events_path):
+      previous = replay_events(read_events(events_path))[1]
+
+    # When regrading incrementally, the results of the tests whose code has not
+    # changed are taken from the previous results of the same submission
+    submission_digest = cache.hash_tree(test_root, ignored)
+    if incremental and os.path.isfile(result_file_path):
+      with open(result_file_path) as result_file:
+        old_summary = json.load(result_file)
+      if old_summary.get('submissionDigest') == submission_digest:
+        previous = dict(cache.records_from_summary(old_summary),
+            **(previous or {}))
+    events = EventStream(events_path, 'a' if resume else 'w')
+
+    # Import the test module and run the tests contained in it
+    try:
+      m = __import__(module)
+      tests = unittest.defaultTestLoader.loadTestsFromModule(m)
+      fingerprints = cache.test_fingerprints(m, list(list_of_tests_gen(tests)))
+      result = TimeoutTestRunner(timeout, processes, threads, test_timeout,
+          resource_limits, profile, timeout_profile).run(tests, verbose,
+          events, previous, fingerprints)
+    finally:
+      events.close()
+
+  if profile:
+    write_profiles(result.profiles, profile_dir_for(result_file_path),
+        test_root, cache.ROOT_PLACEHOLDER)
+
+  # Write the test results as a JSON file, compacted from the event stream
+  summary = summarize_events(events_path)
+  summary['submissionDigest'] = submission_digest
+  write_summary(summary, result_file_path)
+  if cache_dir is not None:
+    result_cache.store(cache_key, test_root, summary)
+
+  display_summary(basename, summary, timings)
 
   if len(summary['aborted']) > 0:
     raise Exception('Aborted some tests for {0}'.format(basename))
@@ -344,9 +1655,11 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='This module is used to run ' +
     'tests on a single instance. The tests must be contained in a single ' +
     'module, and must use the Python\'s unittest framework. This module  ' +
-    'runs the tests in separate threads (not processes) and optionally ' +
+    'runs the tests in separate threads (or worker processes) and optionally ' +
     'enforces timeouts on the tests. The results it generates are stored ' +
-    'in a JSON file relative to the student\'s code directory.',
+    'in a JSON file relative to the student\'s code directory, and their ' +
+    'progress is streamed to a file of the same name with the .ndjson ' +
+    'extension as they run.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
   parser.add_argument('module', help='The module containing tests to be run.')
@@ -358,8 +1671,16 @@ if __name__ == '__main__':
     'relative to test_root, to store the results as JSON objects.',
     default='results.json')
 
-  parser.add_argument('-t', '--timeout', help='The max number of seconds a ' +
-    'test is allowed to run.', default=600, type=float)
+  parser.add_argument('-t', '--timeout', help='The max number of seconds ' +
+    'all the tests together are allowed to run.', default=600, type=float)
+
+  parser.add_argument('-T', '--test-timeout', help='The max number of ' +
+    'seconds a test is allowed to run, unless it declares its own limit with ' +
+    'the time_limit decorator or class attribute.', default=None, type=float)
+
+  parser.add_argument('--timeout-profile', help='The profile of the time ' +
+    'limits of the tests written by calibrate.py, which applies to the ' +
+    'tests that do not declare their own limit.', default=None)
 
   parser.add_argument('-o', '--overwrite-existing-results', help='Indicates ' +
     'what action to take when a result file already exists',
@@ -371,6 +1692,48 @@ if __name__ == '__main__':
   parser.add_argument('-c', '--redir-console', help='Redirect console to this '+
     'instead of null device.', default=None)
 
+  parser.add_argument('-p', '--processes', help='Run the tests in this many ' +
+    'worker processes instead of threads. A worker whose test runs for ' +
+    'longer than its time limit is killed and replaced.', default=0, type=int)
+
+  parser.add_argument('-n', '--threads', help='The number of worker threads ' +
+    'that run the tests, when not running them in processes.', default=8,
+    type=int)
+
+  parser.add_argument('-R', '--resume', help='Only run the tests that did ' +
+    'not complete in an interrupted run, as recorded in the event stream ' +
+    'that accompanies the result file.', action='store_true', default=False)
+
+  add_resource_limit_arguments(parser)
+
+  parser.add_argument('-I', '--incremental', help='Only run the tests whose ' +
+    'code changed, or that were aborted, since the existing result file was ' +
+    'written, and reuse the results of the others.', action='store_true',
+    default=False)
+
+  parser.add_argument('-C', '--result-cache', help='The directory of the ' +
+    'cache of results. A submission whose files, test module and time ' +
+    'limits are identical to those of a cached run is not graded again.',
+    default=None)
+
+  parser.add_argument('-f', '--fixture-cache', help='The directory in which ' +
+    'the fixtures built with fixtures.cached are shared between runs.',
+    default=None)
+
+  parser.add_argument('--output-limit', help='Capture what each test ' +
+    'prints, keeping at most this many characters from the start and the ' +
+    'end of it, and store it in the result file instead of the console.',
+    default=None, type=int)
+
+  parser.add_argument('--profile', help='Run every test and class fixture ' +
+    'under cProfile, and write their profiles to a directory of the same ' +
+    'name as the result file with the .profile extension. See profiles.py ' +
+    'to merge the profiles of a batch.', action='store_true', default=False)
+
+  parser.add_argument('--timings', help='Show the time and memory taken by ' +
+    'every test and class fixture once the tests complete.',
+    action='store_true', default=False)
+
   # if the user runs the module without any arguments then display the help menu
   if len(sys.argv) == 1:
     parser.print_help()
@@ -379,11 +1742,19 @@ if __name__ == '__main__':
 
   args = parser.parse_args()
 
+  if args.fixture_cache is not None:
+    import fixtures
+    fixtures.CACHE_DIR = args.fixture_cache
+
   exitcode = -1
   try:
     exitcode = process_one_submission(
       args.module, args.test_root, args.result_file_path, args.timeout,
-      args.overwrite_existing_results, args.verbose, args.redir_console
+      args.overwrite_existing_results, args.verbose, args.redir_console,
+      args.processes, args.threads, args.test_timeout, args.timings,
+      args.resume, args.result_cache, args.incremental,
+      resource_limits_from_args(args), args.output_limit, args.profile,
+      args.timeout_profile
     )
   except:
     traceback.print_exc(file=sys.stdout)
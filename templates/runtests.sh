@@ -14,17 +14,13 @@ DEST="$2"
 # This is the path to the CSV from CMS into which the grades are entered.
 CSV_FILE="$3"
 
-# First extract student submissions. The submissions will be extracted such that
-# the actual files are in a folder $DEST/<group NetIDs>/, after repeatedly
-# extracting any nested zips.
-python cuautograde/extract.py -s "$SUBMISSION_FILE" -d "$DEST" -e
-
-# Mount the docker volumes as explained in docker.sh and run the bootstrap
-# script.
-for d in $DEST/* ; do
-    echo "Processing $d"
-    docker run -v "$d":/submission -v $(pwd):/tests:ro -v $(realpath ../../modules/cuautograde):/autograder:ro dhruvs/cs4670 sh /tests/docker.sh
-done
-
-# Finally all the results to the CMS grade and comment script.
-python cuautograde/analysis.py "$DEST" -c "$CSV_FILE"
+# Extract the student submissions, grade them and enter their grades into the
+# CSV, all at the same time: each submission is graded as soon as it is
+# extracted, and its grade is entered as soon as it is graded. The submissions
+# are extracted such that the actual files are in a folder $DEST/<group
+# NetIDs>/, after repeatedly extracting any nested zips. Each submission is
+# graded in its own docker container, with the docker volumes mounted as
+# explained in docker.sh, and the bootstrap script run in it.
+python cuautograde/pipeline.py "$SUBMISSION_FILE" "$DEST" test -e \
+    -c "$CSV_FILE" -b container --image dhruvs/cs4670 \
+    --container-command "docker run --rm -v {submission}:/submission -v {tests}:/tests:ro -v $(realpath ../../modules/cuautograde):/autograder:ro {image} sh /tests/docker.sh"
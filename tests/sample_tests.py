@@ -0,0 +1,85 @@
+'''Test cases graded by the tests of the runner. The name of this module does
+not match the pattern of the test modules, so that these are not collected
+themselves.'''
+import tempfile
+import time
+import unittest
+import runner
+
+
+class Outcomes(unittest.TestCase):
+  def test_pass(self):
+    pass
+
+  def test_fail(self):
+    self.assertEqual(1, 2)
+
+  def test_error(self):
+    raise ValueError('broken')
+
+  @unittest.expectedFailure
+  def test_expected_failure(self):
+    self.assertEqual(1, 2)
+
+
+class Unrunnable(unittest.TestCase):
+  '''A test whose run raises rather than recording its outcome, as tests did
+  when recording the outcome failed.'''
+
+  def run(self, result=None):
+    raise RuntimeError('cannot run')
+
+  def test_unrunnable(self):
+    pass
+
+
+class Limited(unittest.TestCase):
+  '''Tests that exceed their resource limits, and one that does not.'''
+
+  @runner.resource_limits(cpu=1)
+  def test_cpu(self):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+      pass
+
+  @runner.resource_limits(fileSize=1024)
+  def test_file_size(self):
+    with tempfile.TemporaryFile() as f:
+      f.write(b'x' * 4096)
+      f.flush()
+
+  @runner.resource_limits(fileSize=1024)
+  def test_within_limits(self):
+    with tempfile.TemporaryFile() as f:
+      f.write(b'x' * 512)
+      f.flush()
+
+
+class Dependencies(unittest.TestCase):
+  '''Tests that depend on a test that fails and sorts after them.'''
+
+  @runner.depends_on('test_setup')
+  def test_dependent(self):
+    pass
+
+  @runner.depends_on('test_dependent')
+  def test_chain(self):
+    pass
+
+  def test_independent(self):
+    pass
+
+  def test_setup(self):
+    self.assertEqual(1, 2)
+
+
+class Cycle(unittest.TestCase):
+  @runner.depends_on('test_b')
+  def test_a(self):
+    pass
+
+  @runner.depends_on('test_a')
+  def test_b(self):
+    pass
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,43 @@
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+import runner
+
+
+class BenchmarkTest(unittest.TestCase):
+  '''Times every stage once on a corpus of two synthetic submissions.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.console = runner.console
+    runner.console = open(os.devnull, 'w')
+
+  def tearDown(self):
+    runner.console.close()
+    runner.console = self.console
+    shutil.rmtree(self.directory)
+
+  def test_stages(self):
+    results = benchmark.run_benchmark([2], jobs=2, keep=self.directory,
+        repeat=1, nested=0.5, mix={'pass': 1, 'fail': 1})
+    self.assertEqual([(r['stage'], r['size']) for r in results['results']],
+        [(stage, 2) for stage in benchmark.STAGES])
+    for r in results['results']:
+      self.assertEqual(sum(r['kinds'].values()), 2)
+      self.assertEqual(len(r['samples']), 1)
+    breakdown, = glob.glob(os.path.join(self.directory, '*', 'breakdown.txt'))
+    with open(breakdown) as f:
+      self.assertIn('bench_tests.SolutionTest.test_small', f.read())
+    self.assertFalse(benchmark.compare(results, results)[1])
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
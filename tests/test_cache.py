@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cache
+import forkserver
+import runner
+
+
+class ResultCacheTest(unittest.TestCase):
+  '''Stores summaries in a ResultCache and loads them back.'''
+
+  maxDiff = None
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.directory = os.path.realpath(tempfile.mkdtemp())
+    with open(os.path.join(self.directory, 'round_trip.py'), 'w') as f:
+      f.write('import unittest\n')
+    self.submission = os.path.join(self.directory, 'group_of_ab1_cd2')
+    os.makedirs(self.submission)
+    self.cache = cache.ResultCache(os.path.join(self.directory, 'cache'),
+        'round_trip', [self.directory])
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def summary(self, root):
+    '''Return a summary of tests whose traceback names a file in 'root'.'''
+    test_id = 'round_trip.Test.test_1'
+    return {'allTests': {test_id: None}, 'successes': [],
+        'unexpectedSuccesses': [], 'aborted': [], 'skipped': {},
+        'failures': {}, 'expectedFailures': {}, 'limitExceeded': {},
+        'errors': {test_id: ('Traceback (most recent call last):\n' +
+            '  File "{0}", line 1.5, in test_1\nValueError: 0.25\n').format(
+            os.path.join(root, 'student.py'))},
+        'timings': {'tests': {test_id: {'wall': 0.5}}},
+        'output': {test_id: 'See ../notes.txt and {0}\n'.format(
+            os.path.join(root, 'data.txt'))}}
+
+  def assert_round_trip(self, root):
+    summary = self.summary(root)
+    self.cache.store('ab12', root, summary)
+    with open(self.cache.path_for('ab12')) as cached:
+      self.assertNotIn(self.submission, cached.read())
+    self.assertEqual(self.cache.load('ab12', root),
+        self.summary(os.path.abspath(root)))
+
+  def test_absolute_root(self):
+    self.assert_round_trip(self.submission)
+
+  def test_relative_root(self):
+    os.chdir(self.directory)
+    self.assert_round_trip('group_of_ab1_cd2')
+
+  def test_current_directory(self):
+    os.chdir(self.submission)
+    summary = self.summary('.')
+    self.cache.store('ab12', '.', summary)
+    loaded = self.cache.load('ab12', '.')
+    self.assertEqual(loaded['timings'], summary['timings'])
+    self.assertEqual(loaded['allTests'], summary['allTests'])
+    self.assertEqual(loaded['errors'], self.summary(self.submission)['errors'])
+    self.assertIn('../notes.txt', loaded['output']['round_trip.Test.test_1'])
+
+  def test_missing(self):
+    self.assertIsNone(self.cache.load('cd34', self.submission))
+
+  def test_corrupt(self):
+    self.cache.store('ab12', self.submission, self.summary(self.submission))
+    with open(self.cache.path_for('ab12'), 'w') as cached:
+      cached.write('{"allTests": {')
+    self.assertIsNone(self.cache.load('ab12', self.submission))
+
+  def test_entry_points_share_keys(self):
+    # The test module is imported from the working directory, as the command
+    # line tools do
+    os.chdir(self.directory)
+    sys.path.append(self.directory)
+    self.addCleanup(sys.path.remove, self.directory)
+    console = runner.console
+    runner.console = open(os.devnull, 'w')
+    self.addCleanup(setattr, runner, 'console', console)
+    self.addCleanup(runner.console.close)
+    cache_dir = os.path.join(self.directory, 'cache')
+    worker = forkserver.Worker('round_trip', cache_dir=cache_dir,
+        redir_console=os.path.join(self.submission, 'console.txt'),
+        overwrite_existing_results=True)
+    # The runner stores the results under its key, which the worker finds
+    self.assertEqual(worker.grade_one(self.submission), 0)
+    stored = os.listdir(cache_dir)
+    self.assertEqual(len(stored), 1)
+    self.assertTrue(worker.restore(self.submission))
+    # The worker stores them under the key of the runner
+    shutil.rmtree(cache_dir)
+    worker.store(self.submission)
+    self.assertEqual(os.listdir(cache_dir), stored)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import distributed
+import forkserver
+import runner
+
+TEST_MODULE = '''import unittest
+import solution
+
+
+class SolutionTest(unittest.TestCase):
+  def test_add(self):
+    print('adding')
+    self.assertEqual(solution.add(1, 2), 3)
+'''
+
+TOKEN = 'secret'
+
+
+class CoordinatorTest(unittest.TestCase):
+  '''Talks to a coordinator of a batch of two submissions over HTTP.'''
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'remote_tests.py'), 'w') as f:
+      f.write(TEST_MODULE)
+    for name in ('ab1', 'cd2'):
+      os.makedirs(os.path.join(self.directory, 'batch', name))
+      with open(os.path.join(self.directory, 'batch', name, 'solution.py'),
+          'w') as f:
+        f.write('def add(a, b):\n  return a + b\n')
+    os.chdir(self.directory)
+    self.console = runner.console
+    runner.console = open(os.devnull, 'w')
+    self.coordinator = None
+
+  def tearDown(self):
+    if self.coordinator is not None:
+      self.coordinator.server.server_close()
+    runner.console.close()
+    runner.console = self.console
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def start(self, **options):
+    '''Start a coordinator of the batch with 'options', and return the URL
+    it listens on.'''
+    self.coordinator = distributed.Coordinator('remote_tests',
+        forkserver.submission_dirs('batch'), ('127.0.0.1', 0),
+        heartbeat=0.2, token=TOKEN, overwrite_existing_results=True,
+        **options)
+    self.url = 'http://127.0.0.1:{0}'.format(
+        self.coordinator.server.server_address[1])
+    return self.url
+
+  def serve_in_background(self):
+    '''Serve the requests of the tests, without waiting for the batch.'''
+    server = threading.Thread(target=self.coordinator.server.serve_forever)
+    server.daemon = True
+    server.start()
+    self.addCleanup(self.coordinator.server.shutdown)
+
+  def grade(self, **options):
+    '''Grade the batch with a coordinator of 'options' and a worker of two
+    slots, and return the exit codes of the submissions.'''
+    self.start(**options)
+    return self.serve_batch()
+
+  def serve_batch(self):
+    '''Grade the batch of the started coordinator with a worker of two
+    slots, and return the exit codes of the submissions.'''
+    url = self.url
+    worker = threading.Thread(target=lambda: distributed.RemoteWorker(url,
+        TOKEN, 2, workdir=os.path.join(self.directory, 'work')).serve())
+    worker.daemon = True
+    worker.start()
+    exitcodes = self.coordinator.serve()
+    worker.join(10)
+    self.assertFalse(worker.is_alive())
+    return exitcodes
+
+  def results(self, name):
+    with open(os.path.join('batch', name, 'results.json')) as f:
+      return json.load(f)
+
+  def call(self, path, body=None, headers=None):
+    '''Send a request for 'path' with the token, unless 'headers' replace it,
+    and return its status code and the body of its reply.'''
+    request = distributed.Request(self.url + path, body,
+        dict({'X-Token': TOKEN, 'X-Worker': 'w-0'}, **(headers or {})))
+    try:
+      response = distributed.urlopen(request)
+      return response.getcode(), response.read()
+    except distributed.HTTPError as e:
+      return e.code, e.read()
+
+  def next_job(self):
+    status, data = self.call('/jobs/next', json.dumps(
+        {'worker': 'w-0'}).encode('utf-8'))
+    self.assertEqual(status, 200)
+    return json.loads(data.decode('utf-8'))['job']
+
+  def test_grade(self):
+    self.assertEqual(self.grade(), {os.path.join('batch', name): 0
+        for name in ('ab1', 'cd2')})
+    for name in ('ab1', 'cd2'):
+      self.assertEqual(len(self.results(name)['successes']), 1)
+
+  def test_limits(self):
+    test_id = 'remote_tests.SolutionTest.test_add'
+    with open('profile.json', 'w') as f:
+      json.dump({'hostSpeed': runner.host_speed(), 'floor': 2.0,
+          'factor': 3.0, 'tests': {test_id: {'percentile': 1.0}}}, f)
+    self.start(timeout_profile='profile.json', output_limit=100)
+    # The workers do not read the profile from the coordinator's files
+    os.remove('profile.json')
+    self.serve_batch()
+    for name in ('ab1', 'cd2'):
+      results = self.results(name)
+      self.assertAlmostEqual(
+          results['timeBudget']['tests'][test_id]['limit'], 3.0)
+      self.assertEqual(results['output'][test_id]['text'], 'adding\n')
+
+  def test_token_required(self):
+    self.start()
+    self.serve_in_background()
+    self.assertEqual(self.call('/batch', headers={'X-Token': 'wrong'})[0],
+        403)
+    self.assertEqual(self.call('/batch')[0], 200)
+
+  def test_exit_code_required(self):
+    self.start()
+    self.serve_in_background()
+    job_id = self.next_job()
+    path = '/jobs/{0}/result'.format(job_id)
+    self.assertEqual(self.call(path, distributed.zip_files('.', []))[0], 400)
+    self.assertEqual(self.call(path, distributed.zip_files('.', []),
+        {'X-Exit-Code': 'zero'})[0], 400)
+    # The job is still assigned to the worker
+    self.assertEqual(self.call('/jobs/{0}/heartbeat'.format(job_id),
+        b'')[0], 200)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
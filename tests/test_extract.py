@@ -0,0 +1,130 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import extract
+
+
+def zip_bytes(files):
+  '''Return a zip archive of 'files', a dictionary mapping paths to
+  contents.'''
+  data = io.BytesIO()
+  with zipfile.ZipFile(data, 'w', zipfile.ZIP_STORED) as archive:
+    for path, contents in sorted(files.items()):
+      archive.writestr(path, contents)
+  return data.getvalue()
+
+
+class ProcessSubmissionTest(unittest.TestCase):
+  '''Extracts CMS submission zip files with nested zips.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.destination = os.path.join(self.directory, 'code')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def submission(self, students):
+    '''Write a CMS submission zip file of 'students', a dictionary mapping the
+    name of each to its files, and return its path.'''
+    path = os.path.join(self.directory, 'submissions.zip')
+    with open(path, 'wb') as f:
+      f.write(zip_bytes({'{0}/{1}/{2}'.format(extract.SUBMISSION_DIR_NAME,
+          student, p): contents for student, files in students.items()
+          for p, contents in files.items()}))
+    return path
+
+  def files(self):
+    '''Return a dictionary mapping the path of each extracted file, relative
+    to the destination, to its contents.'''
+    files = {}
+    for root, _, names in os.walk(self.destination):
+      for name in names:
+        path = os.path.join(root, name)
+        with open(path, 'rb') as f:
+          files[os.path.relpath(path, self.destination)] = f.read()
+    return files
+
+  def test_nested(self):
+    inner = zip_bytes({'solution.py': b'x = 1\n', 'data/input.txt': b'1 2\n'})
+    path = self.submission({
+        'ab1': {'outer.zip': zip_bytes({'inner.zip': inner}),
+            'fake.zip': b'not a zip'},
+        'cd2': {'solution.py': b'x = 2\n'}})
+    self.assertEqual(extract.process_submission(path, self.destination, False,
+        True, ['*']), {})
+    self.assertEqual(self.files(), {
+        os.path.join('ab1', 'solution.py'): b'x = 1\n',
+        os.path.join('ab1', 'input.txt'): b'1 2\n',
+        os.path.join('ab1', 'fake.zip'): b'not a zip',
+        os.path.join('cd2', 'solution.py'): b'x = 2\n'})
+
+  def test_max_depth(self):
+    inner = zip_bytes({'solution.py': b'x = 1\n'})
+    path = self.submission({'ab1': {'outer.zip': zip_bytes(
+        {'inner.zip': inner})}})
+    extract.process_submission(path, self.destination, False, True, ['*'],
+        max_depth=1)
+    self.assertEqual(self.files(), {os.path.join('ab1', 'inner.zip'): inner})
+
+  def test_file_pattern(self):
+    path = self.submission({'ab1': {
+        'src/solution.py': b'x = 1\n', 'README.txt': b'hello\n',
+        'tests.zip': zip_bytes({'test_solution.py': b'y = 1\n',
+            'notes.txt': b'notes\n'})}})
+    extract.process_submission(path, self.destination, False, True,
+        ['*.py'])
+    self.assertEqual(self.files(), {
+        os.path.join('ab1', 'solution.py'): b'x = 1\n',
+        os.path.join('ab1', 'test_solution.py'): b'y = 1\n'})
+
+  def test_overwrite(self):
+    path = self.submission({'ab1': {'solution.py': b'x = 1\n'}})
+    os.makedirs(os.path.join(self.destination, 'ab1'))
+    with open(os.path.join(self.destination, 'ab1', 'old.py'), 'w') as f:
+      f.write('x = 0\n')
+    extract.process_submission(path, self.destination, False, False, ['*'])
+    self.assertEqual(self.files(), {os.path.join('ab1', 'old.py'): b'x = 0\n'})
+    extract.process_submission(path, self.destination, False, True, ['*'])
+    self.assertEqual(self.files(),
+        {os.path.join('ab1', 'solution.py'): b'x = 1\n'})
+
+  def assert_jobs(self, jobs):
+    students = {'{0}{1}'.format(name, i): {'solution.py':
+        'x = {0}\n'.format(i).encode('utf-8')}
+        for i, name in enumerate(('ab', 'cd', 'ef', 'gh'))}
+    students['ij4'] = {'solution.py': b'A' * 64}
+    path = self.submission(students)
+    # Corrupt the file of a single student, whose extraction fails
+    with open(path, 'rb') as f:
+      data = f.read()
+    with open(path, 'wb') as f:
+      f.write(data.replace(b'A' * 64, b'B' * 64))
+    errors = extract.process_submission(path, self.destination, False, True,
+        ['*'], jobs=jobs)
+    self.assertEqual(list(errors), ['ij4'])
+    self.assertIn('CRC', errors['ij4'])
+    self.assertEqual(self.files(), {os.path.join(student, 'solution.py'):
+        files['solution.py'] for student, files in students.items()
+        if student != 'ij4'})
+    # The partial extraction of the student is left out of the destination
+    self.assertEqual(sorted(os.listdir(self.destination)),
+        sorted(s for s in students if s != 'ij4'))
+
+  def test_one_job(self):
+    self.assert_jobs(1)
+
+  def test_parallel_jobs(self):
+    self.assert_jobs(3)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fixtures
+import sample_tests
+
+
+class CachedTest(unittest.TestCase):
+  '''Builds fixtures of a test module and loads them back.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.built = []
+
+  def tearDown(self):
+    for path in list(fixtures.loaded):
+      if path.startswith(self.directory):
+        del fixtures.loaded[path]
+    shutil.rmtree(self.directory)
+
+  def cached(self, name, value):
+    def build():
+      self.built.append(name)
+      return value
+    return fixtures.cached(sample_tests, name, build, self.directory)
+
+  def test_pickled_copies(self):
+    first = self.cached('table', {'rows': [1, 2]})
+    first['rows'].append(3)
+    self.assertEqual(self.cached('table', None), {'rows': [1, 2]})
+    self.assertEqual(self.built, ['table'])
+
+  def test_bytes(self):
+    self.assertEqual(self.cached('raw', b'abc')[:], b'abc')
+    self.assertEqual(self.cached('raw', None)[:], b'abc')
+    self.assertEqual(self.built, ['raw'])
+
+  def test_empty_bytes(self):
+    self.assertEqual(self.cached('empty', b''), b'')
+    self.assertEqual(self.cached('empty', None), b'')
+
+  def test_other_process(self):
+    self.cached('table', [1])
+    fixtures.loaded.clear()
+    self.assertEqual(self.cached('table', None), [1])
+    self.assertEqual(self.built, ['table'])
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import forkserver
+import runner
+
+TEST_MODULE = '''import unittest
+import solution
+
+
+class SolutionTest(unittest.TestCase):
+  def test_add(self):
+    self.assertEqual(solution.add(1, 2), 3)
+
+  def test_negative(self):
+    self.assertEqual(solution.add(-1, -2), -3)
+'''
+
+SOLUTIONS = {
+  'a_right': 'def add(a, b):\n  return a + b\n',
+  'b_wrong': 'def add(a, b):\n  return a - b\n'}
+
+
+class WorkerTest(unittest.TestCase):
+  '''Grades a passing and then a failing submission in one process.'''
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'worker_tests.py'), 'w') as f:
+      f.write(TEST_MODULE)
+    for name, source in SOLUTIONS.items():
+      os.makedirs(os.path.join(self.directory, 'batch', name))
+      with open(os.path.join(self.directory, 'batch', name, 'solution.py'),
+          'w') as f:
+        f.write(source)
+    # The test module is imported from the working directory, as the command
+    # line tools do
+    os.chdir(self.directory)
+    self.console = runner.console
+    runner.console = open(os.devnull, 'w')
+
+  def tearDown(self):
+    runner.console.close()
+    runner.console = self.console
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def results(self, name):
+    with open(os.path.join('batch', name, 'results.json')) as f:
+      return json.load(f)
+
+  def assert_graded(self, worker):
+    start_time = time.time()
+    exitcodes = worker.grade(forkserver.submission_dirs('batch'))
+    self.assertLess(time.time() - start_time, 10)
+    self.assertEqual(exitcodes, {os.path.join('batch', name): 0
+        for name in SOLUTIONS})
+    right = self.results('a_right')
+    self.assertEqual(len(right['successes']), 2)
+    self.assertEqual(right['failures'], {})
+    wrong = self.results('b_wrong')
+    self.assertEqual(wrong['successes'], [])
+    self.assertEqual(len(wrong['failures']), 2)
+    for detail in wrong['failures'].values():
+      self.assertIn('AssertionError', detail)
+    self.assertEqual(wrong['aborted'], [])
+
+  def test_threads(self):
+    self.assert_graded(forkserver.Worker('worker_tests', timeout=30,
+        overwrite_existing_results=True))
+
+  def test_processes(self):
+    self.assert_graded(forkserver.Worker('worker_tests', timeout=30,
+        overwrite_existing_results=True, processes=1))
+
+  def test_fork_server(self):
+    self.assert_graded(forkserver.ForkServer('worker_tests', timeout=30,
+        overwrite_existing_results=True))
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
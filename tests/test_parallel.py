@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import forkserver
+import parallel
+import runner
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEST_MODULE = '''import unittest
+import solution
+
+
+class SolutionTest(unittest.TestCase):
+  def test_add(self):
+    self.assertEqual(solution.add(1, 2), 3)
+'''
+
+SOLUTIONS = {
+  'right': 'def add(a, b):\n  return a + b\n',
+  'wrong': 'def add(a, b):\n  return a - b\n'}
+
+# The max number of seconds a batch of the smoke tests takes
+BATCH_TIMEOUT = 60
+
+# A test module that logs each submission it grades and takes a second
+SLOW_MODULE = '''import os
+import time
+import unittest
+import solution
+
+
+class SolutionTest(unittest.TestCase):
+  def test_add(self):
+    with open('runs.txt', 'a') as f:
+      f.write(os.path.basename(os.path.dirname(solution.__file__)) + '\\n')
+    time.sleep(1.0)
+    self.assertEqual(solution.add(1, 2), 3)
+'''
+
+# The submissions graded with SLOW_MODULE, one of which kills the process
+# that grades it
+SLOW_SOLUTIONS = {
+  'ab1': 'def add(a, b):\n  return a + b\n',
+  'cd2': 'def add(a, b):\n  return a + b\n',
+  'ef3': 'def add(a, b):\n  return a - b\n',
+  'gh4': 'import os\nos._exit(3)\n'}
+
+
+class BatchSchedulerTest(unittest.TestCase):
+  '''Grades a small batch with a BatchScheduler, in child processes.'''
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'slow_tests.py'), 'w') as f:
+      f.write(SLOW_MODULE)
+    for name, source in SLOW_SOLUTIONS.items():
+      os.makedirs(os.path.join(self.directory, 'batch', name))
+      with open(os.path.join(self.directory, 'batch', name, 'solution.py'),
+          'w') as f:
+        f.write(source)
+    # The test module is imported from the working directory, as the command
+    # line tools do
+    os.chdir(self.directory)
+    sys.path.append(self.directory)
+    self.console = runner.console
+    runner.console = open(os.devnull, 'w')
+
+  def tearDown(self):
+    runner.console.close()
+    runner.console = self.console
+    sys.path.remove(self.directory)
+    os.chdir(self.cwd)
+    shutil.rmtree(self.directory)
+
+  def grade(self, retries=0, resume=False):
+    '''Grade the batch with a scheduler of four jobs, and return it along
+    with the exit codes of the submissions.'''
+    scheduler = parallel.BatchScheduler('slow_tests', jobs=4, retries=retries,
+        journal='batch.ndjson', overwrite_existing_results=True)
+    exitcodes = scheduler.grade(forkserver.submission_dirs('batch'), resume)
+    return scheduler, exitcodes
+
+  def runs(self):
+    '''Return the submissions whose tests ran, and forget them.'''
+    if not os.path.exists('runs.txt'):
+      return []
+    with open('runs.txt') as f:
+      runs = sorted(f.read().split())
+    os.remove('runs.txt')
+    return runs
+
+  def test_parallel(self):
+    scheduler, exitcodes = self.grade(retries=1)
+    crashed = os.path.join('batch', 'gh4')
+    self.assertEqual({r: e for r, e in exitcodes.items() if r != crashed},
+        {os.path.join('batch', name): 0 for name in ('ab1', 'cd2', 'ef3')})
+    self.assertNotEqual(exitcodes[crashed], 0)
+    self.assertEqual(scheduler.attempts[crashed], 2)
+    # The three submissions that each take a second were graded together
+    self.assertLess(scheduler.elapsed, 2.5)
+    self.assertEqual(self.runs(), ['ab1', 'cd2', 'ef3'])
+    with open(os.path.join('batch', 'ef3', 'results.json')) as f:
+      self.assertEqual(len(json.load(f)['failures']), 1)
+
+  def test_resume(self):
+    exitcodes = self.grade()[1]
+    self.runs()
+    # The batch is interrupted while a submission is graded again
+    with open('batch.ndjson', 'a') as f:
+      f.write(json.dumps({'job': os.path.join('batch', 'ab1'),
+          'state': 'running', 'attempt': 2}) + '\n')
+    for name in ('results.json', 'results.ndjson'):
+      os.remove(os.path.join('batch', 'ab1', name))
+    scheduler, resumed = self.grade(resume=True)
+    self.assertEqual(resumed, exitcodes)
+    self.assertEqual(self.runs(), ['ab1'])
+    self.assertEqual(scheduler.interrupted, {os.path.join('batch', 'ab1')})
+    # The submission that failed is not retried, as it has no retries left
+    self.assertEqual(scheduler.resumed, {os.path.join('batch', name)
+        for name in ('cd2', 'ef3', 'gh4')})
+
+    # Nothing is left to grade
+    scheduler, resumed = self.grade(resume=True)
+    self.assertEqual(resumed, exitcodes)
+    self.assertEqual(self.runs(), [])
+    self.assertEqual(len(scheduler.resumed), len(SLOW_SOLUTIONS))
+
+
+class JailedBatchTest(unittest.TestCase):
+  '''Grades a small batch in sandboxes confined to a jail, which requires
+  superuser privileges, as parallel.py does.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'smoke_tests.py'), 'w') as f:
+      f.write(TEST_MODULE)
+    self.batch = os.path.join(self.directory, 'batch')
+    for name, source in SOLUTIONS.items():
+      os.makedirs(os.path.join(self.batch, name))
+      with open(os.path.join(self.batch, name, 'solution.py'), 'w') as f:
+        f.write(source)
+    self.jail = os.path.join(self.directory, 'jail')
+    os.makedirs(self.jail)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_batch(self, *args):
+    '''Run parallel.py on the batch with 'args', killing it if it hangs, and
+    return its exit code and output.'''
+    # The script runs in its own process group, so that its sandboxes are
+    # killed along with it
+    process = subprocess.Popen([sys.executable,
+        os.path.join(ROOT, 'parallel.py'), self.batch, 'smoke_tests', '-o',
+        '--jail', self.jail, '--status-interval', '0'] + list(args),
+        cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        preexec_fn=os.setsid)
+    timer = threading.Timer(BATCH_TIMEOUT,
+        lambda: os.killpg(process.pid, signal.SIGKILL))
+    timer.start()
+    try:
+      output = process.communicate()[0]
+    finally:
+      timer.cancel()
+    return process.returncode, output.decode('utf-8', 'replace')
+
+  def assert_graded(self, *args):
+    exitcode, output = self.run_batch(*args)
+    self.assertEqual(exitcode, 0, output)
+    for name in SOLUTIONS:
+      with open(os.path.join(self.batch, name, 'results.json')) as f:
+        results = json.load(f)
+      self.assertEqual(len(results['allTests']), 1)
+      self.assertEqual(len(results['successes']), 1 if name == 'right' else 0)
+
+  @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+      'chroot requires superuser privileges')
+  def test_threads(self):
+    self.assert_graded('-j', '1', '-p', '0')
+
+  @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+      'chroot requires superuser privileges')
+  def test_processes(self):
+    self.assert_graded('-j', '2', '-p', '1')
+
+  @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+      'chroot requires superuser privileges')
+  def test_metrics(self):
+    self.assert_graded('-j', '1', '--metrics', 'metrics.json')
+    with open(os.path.join(self.directory, 'metrics.json')) as f:
+      snapshot = json.load(f)
+    self.assertEqual(snapshot['completed'], len(SOLUTIONS))
+
+  @unittest.skipUnless(hasattr(os, 'geteuid') and os.geteuid() == 0,
+      'chroot requires superuser privileges')
+  def test_sandbox_reused(self):
+    # The test module is imported from the working directory, as the command
+    # line tools do
+    cwd = os.getcwd()
+    os.chdir(self.directory)
+    self.addCleanup(os.chdir, cwd)
+    sys.path.append(self.directory)
+    self.addCleanup(sys.path.remove, self.directory)
+    console = runner.console
+    runner.console = open(os.devnull, 'w')
+    self.addCleanup(setattr, runner, 'console', console)
+    self.addCleanup(runner.console.close)
+    pool = parallel.SandboxPool(self.jail, forkserver.Worker('smoke_tests',
+        overwrite_existing_results=True, threads=4))
+    try:
+      for i in range(10):
+        test_root = os.path.join(self.batch, sorted(SOLUTIONS)[i % 2])
+        sandbox = pool.start(test_root)
+        self.assertEqual(pool.wait(), (sandbox, 0))
+        # The threads of the tests are gone, so the sandbox is kept
+        self.assertEqual(pool.idle, [sandbox])
+    finally:
+      pool.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
@@ -0,0 +1,90 @@
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analysis
+import pipeline
+import runner
+
+TESTS = ['grading.SolutionTest.test_add', 'grading.SolutionTest.test_negative']
+
+RESULTS = {
+  'ab1': {'successes': TESTS, 'failures': {}},
+  'cd2': {'successes': TESTS[:1],
+      'failures': {TESTS[1]: 'Traceback:\nAssertionError: 1 != -3'}}}
+
+
+class AggregatorTest(unittest.TestCase):
+  '''Aggregates the results of two graded submissions into a grade file.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.grade_file = os.path.join(self.directory, 'grades.csv')
+    with open(self.grade_file, 'w') as f:
+      f.write('Username,Grade,Add Comments\nab1,,\ncd2,,\n')
+    self.roots = []
+    for name, outcomes in sorted(RESULTS.items()):
+      test_root = os.path.join(self.directory, name)
+      os.makedirs(test_root)
+      results = {'errors': {}, 'skipped': {}, 'unexpectedSuccesses': [],
+          'aborted': [], 'expectedFailures': {},
+          'allTests': {t: None for t in TESTS}}
+      results.update(outcomes)
+      with open(os.path.join(test_root, 'results.json'), 'w') as f:
+        json.dump(results, f)
+      self.roots.append(test_root)
+    self.console = runner.console
+    runner.console = open(os.devnull, 'w')
+
+  def tearDown(self):
+    runner.console.close()
+    runner.console = self.console
+    shutil.rmtree(self.directory)
+
+  def grades(self):
+    with analysis.open_csv(self.grade_file, 'r') as f:
+      return {row['Username']: row for row in csv.DictReader(f)}
+
+  def test_written_at_intervals(self):
+    aggregator = pipeline.Aggregator(csv_files=[self.grade_file],
+        write_interval=2)
+    aggregator.add(self.roots[0], 0)
+    self.assertEqual(self.grades()['ab1']['Grade'], '')
+    aggregator.add(self.roots[1], 0)
+    grades = self.grades()
+    self.assertEqual(float(grades['ab1']['Grade']), 2)
+    self.assertEqual(float(grades['cd2']['Grade']), 1)
+    self.assertIn('AssertionError: 1 != -3', grades['cd2']['Add Comments'])
+
+  def test_written_at_the_end(self):
+    aggregator = pipeline.Aggregator(csv_files=[self.grade_file])
+    graded = pipeline.Pipeline(None, aggregator, queue_size=4)
+    for test_root in self.roots:
+      graded.graded.put((test_root, 0))
+    graded.graded.put(None)
+    graded.aggregate_stage()
+    self.assertIsNone(graded.aggregate_error)
+    self.assertEqual(float(self.grades()['cd2']['Grade']), 1)
+
+  def test_error_fails_the_stage(self):
+    aggregator = pipeline.Aggregator(csv_files=[self.grade_file],
+        column='Missing')
+    graded = pipeline.Pipeline(None, aggregator, queue_size=4)
+    for test_root in self.roots:
+      graded.graded.put((test_root, 0))
+    graded.graded.put(None)
+    graded.aggregate_stage()
+    self.assertIn('Column Missing does not exist', graded.aggregate_error)
+    # The submissions that were graded after the error are still received
+    self.assertTrue(graded.graded.empty())
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab:
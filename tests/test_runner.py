@@ -0,0 +1,280 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import runner
+import sample_tests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A test module whose second test kills the process that runs it while the
+# file 'crash' exists in the working directory
+CRASH_MODULE = '''import os
+import signal
+import unittest
+
+
+class CrashTest(unittest.TestCase):
+  def test_a(self):
+    with open('runs.txt', 'a') as f:
+      f.write('a\\n')
+
+  def test_b(self):
+    if os.path.exists('crash'):
+      os.kill(os.getpid(), signal.SIGKILL)
+'''
+
+# A test module of which REGRADE_MODULE_FIXED changes a single test
+REGRADE_MODULE = '''import unittest
+
+
+def log(name):
+  with open('runs.txt', 'a') as f:
+    f.write(name + '\\n')
+
+
+class RegradeTest(unittest.TestCase):
+  def test_same(self):
+    log('same')
+
+  def test_changed(self):
+    log('changed')
+    self.assertEqual(1, 2)
+'''
+
+REGRADE_MODULE_FIXED = REGRADE_MODULE.replace('(1, 2)', '(1, 1)')
+
+
+class TimeoutTestRunnerTest(unittest.TestCase):
+  '''Runs a small suite and checks the outcome recorded for each test.'''
+
+  def run_suite(self, case=sample_tests.Outcomes, **options):
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(case)
+    result = runner.TimeoutTestRunner(10, **options).run(suite)
+    return {t.id().rsplit('.', 1)[1]: t.id() for t in suite}, \
+        result.summarize(suite)
+
+  def assert_outcomes(self, **options):
+    ids, summary = self.run_suite(**options)
+    self.assertEqual(summary['successes'], [ids['test_pass']])
+    self.assertEqual(list(summary['failures']), [ids['test_fail']])
+    self.assertIn('AssertionError', summary['failures'][ids['test_fail']])
+    self.assertIn('Traceback', summary['failures'][ids['test_fail']])
+    self.assertEqual(list(summary['errors']), [ids['test_error']])
+    self.assertIn('ValueError: broken', summary['errors'][ids['test_error']])
+    self.assertEqual(list(summary['expectedFailures']),
+        [ids['test_expected_failure']])
+    self.assertIn('AssertionError',
+        summary['expectedFailures'][ids['test_expected_failure']])
+    self.assertEqual(summary['aborted'], [])
+
+  def test_threads(self):
+    self.assert_outcomes(threads=2)
+
+  def test_processes(self):
+    self.assert_outcomes(processes=2)
+
+  def test_threads_joined(self):
+    threads = threading.active_count()
+    for _ in range(10):
+      self.run_suite(threads=4)
+      self.assertEqual(threading.active_count(), threads)
+
+  def assert_unrunnable(self, **options):
+    start_time = time.time()
+    ids, summary = self.run_suite(sample_tests.Unrunnable, **options)
+    self.assertLess(time.time() - start_time, 5)
+    self.assertEqual(list(summary['errors']), [ids['test_unrunnable']])
+    self.assertIn('RuntimeError: cannot run',
+        summary['errors'][ids['test_unrunnable']])
+    self.assertEqual(summary['aborted'], [])
+
+  def test_unrunnable_threads(self):
+    self.assert_unrunnable(threads=2)
+
+  def test_unrunnable_processes(self):
+    self.assert_unrunnable(processes=1)
+
+  def assert_dependencies(self, **options):
+    ids, summary = self.run_suite(sample_tests.Dependencies, **options)
+    self.assertEqual(summary['successes'], [ids['test_independent']])
+    self.assertEqual(list(summary['failures']), [ids['test_setup']])
+    self.assertEqual(sorted(summary['skipped']),
+        [ids['test_chain'], ids['test_dependent']])
+    self.assertIn('{0} did not pass'.format(ids['test_setup']),
+        summary['skipped'][ids['test_dependent']])
+    self.assertIn('{0} did not pass'.format(ids['test_dependent']),
+        summary['skipped'][ids['test_chain']])
+
+  def test_dependencies_threads(self):
+    self.assert_dependencies(threads=2)
+
+  def test_dependencies_processes(self):
+    self.assert_dependencies(processes=2)
+
+  def test_circular_dependencies(self):
+    with self.assertRaises(Exception) as context:
+      self.run_suite(sample_tests.Cycle)
+    self.assertIn('Circular dependency', str(context.exception))
+
+  def test_resource_limits(self):
+    ids, summary = self.run_suite(sample_tests.Limited, processes=1)
+    self.assertEqual(summary['successes'], [ids['test_within_limits']])
+    self.assertEqual(sorted(summary['limitExceeded']),
+        [ids['test_cpu'], ids['test_file_size']])
+    self.assertIn('CPU time limit of 1 seconds',
+        summary['limitExceeded'][ids['test_cpu']])
+    detail = summary['limitExceeded'][ids['test_file_size']]
+    self.assertIn('file size limit of 1024 bytes', detail)
+    self.assertIn('Traceback', detail)
+    self.assertEqual(summary['errors'], {})
+
+
+class EventStreamTest(unittest.TestCase):
+  '''Kills runner.py in the middle of a suite, reads what its event stream
+  recorded and resumes from it.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'crash_tests.py'), 'w') as f:
+      f.write(CRASH_MODULE)
+    os.makedirs(os.path.join(self.directory, 'sub'))
+    self.events_path = os.path.join(self.directory, 'sub', 'results.ndjson')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_runner(self, *args):
+    '''Run runner.py on the submission with 'args', in one thread so that
+    the tests run in order, and return its exit code.'''
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.call([sys.executable, os.path.join(ROOT, 'runner.py'),
+          'crash_tests', 'sub', '-n', '1'] + list(args), cwd=self.directory,
+          stdout=devnull, stderr=devnull)
+
+  def test_killed(self):
+    open(os.path.join(self.directory, 'crash'), 'w').close()
+    self.assertNotEqual(self.run_runner(), 0)
+    self.assertFalse(os.path.exists(os.path.join(self.directory, 'sub',
+        'results.json')))
+    summary = runner.summarize_events(self.events_path)
+    self.assertEqual(summary['successes'], ['crash_tests.CrashTest.test_a'])
+    self.assertEqual(summary['aborted'], ['crash_tests.CrashTest.test_b'])
+
+    # The process may also die in the middle of writing an event
+    with open(self.events_path, 'a') as f:
+      f.write('{"event": "fin')
+    self.assertEqual(runner.summarize_events(self.events_path), summary)
+
+    os.remove(os.path.join(self.directory, 'crash'))
+    self.assertEqual(self.run_runner('-R'), 0)
+    with open(os.path.join(self.directory, 'sub', 'results.json')) as f:
+      self.assertEqual(sorted(json.load(f)['successes']),
+          ['crash_tests.CrashTest.test_a', 'crash_tests.CrashTest.test_b'])
+    # The test that completed before the crash did not run again
+    with open(os.path.join(self.directory, 'runs.txt')) as f:
+      self.assertEqual(f.read(), 'a\n')
+    # Resuming dropped the partial event before appending to the stream
+    with open(self.events_path) as f:
+      for line in f:
+        json.loads(line)
+
+
+class IncrementalTest(unittest.TestCase):
+  '''Regrades a submission with runner.py after a test of the module
+  changed, and after the submission changed.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.write('regrade_tests.py', REGRADE_MODULE)
+    os.makedirs(os.path.join(self.directory, 'sub'))
+    self.write(os.path.join('sub', 'solution.py'), 'x = 1\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write(self, path, contents):
+    with open(os.path.join(self.directory, path), 'w') as f:
+      f.write(contents)
+
+  def regrade(self):
+    '''Regrade the submission incrementally and return the tests that ran,
+    and the successes recorded.'''
+    runs_path = os.path.join(self.directory, 'runs.txt')
+    if os.path.exists(runs_path):
+      os.remove(runs_path)
+    with open(os.devnull, 'w') as devnull:
+      subprocess.check_call([sys.executable, os.path.join(ROOT, 'runner.py'),
+          'regrade_tests', 'sub', '-I'], cwd=self.directory, stdout=devnull,
+          stderr=devnull)
+    with open(runs_path) as f:
+      ran = sorted(f.read().split())
+    with open(os.path.join(self.directory, 'sub', 'results.json')) as f:
+      successes = sorted(t.rsplit('.', 1)[1] for t in json.load(f)['successes'])
+    return ran, successes
+
+  def test_regrade(self):
+    self.assertEqual(self.regrade(), (['changed', 'same'], ['test_same']))
+    self.write('regrade_tests.py', REGRADE_MODULE_FIXED)
+    self.assertEqual(self.regrade(), (['changed'],
+        ['test_changed', 'test_same']))
+    # A change of the submission invalidates all of its results
+    self.write(os.path.join('sub', 'solution.py'), 'x = 2\n')
+    self.assertEqual(self.regrade(), (['changed', 'same'],
+        ['test_changed', 'test_same']))
+
+
+class HostSpeedTest(unittest.TestCase):
+  '''Measures the speed of the host once and reads it back from the cache.'''
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.saved = (runner.HOST_SPEED_FILE, runner._host_speed,
+        runner.measure_host_speed)
+    runner.HOST_SPEED_FILE = os.path.join(self.directory, 'speed.json')
+    runner._host_speed = None
+    self.measured = []
+    runner.measure_host_speed = lambda: self.measured.append(1) or 0.25
+
+  def tearDown(self):
+    (runner.HOST_SPEED_FILE, runner._host_speed,
+        runner.measure_host_speed) = self.saved
+    shutil.rmtree(self.directory)
+
+  def test_cached(self):
+    self.assertEqual(runner.host_speed(), 0.25)
+    runner._host_speed = None
+    self.assertEqual(runner.host_speed(), 0.25)
+    self.assertEqual(len(self.measured), 1)
+    self.assertEqual(os.listdir(self.directory), ['speed.json'])
+
+  def test_expired(self):
+    self.assertEqual(runner.host_speed(), 0.25)
+    with open(runner.HOST_SPEED_FILE) as f:
+      speeds = json.load(f)
+    for speed in speeds.values():
+      speed['time'] = time.time() - runner.HOST_SPEED_MAX_AGE - 1
+    with open(runner.HOST_SPEED_FILE, 'w') as f:
+      json.dump(speeds, f)
+    runner._host_speed = None
+    runner.host_speed()
+    self.assertEqual(len(self.measured), 2)
+
+  def test_corrupt(self):
+    with open(runner.HOST_SPEED_FILE, 'w') as f:
+      f.write('{')
+    self.assertEqual(runner.host_speed(), 0.25)
+    self.assertEqual(len(self.measured), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+# vim: set ts=2 sw=2 expandtab: